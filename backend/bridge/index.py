@@ -4,16 +4,22 @@ Telegram и MAX. Поддерживает вложения, автосоздан
 import json
 import os
 import re
+import select
 import ssl
-import uuid
+import time
+import threading
 import base64
+import binascii
 import hashlib
+import tempfile
 import html as html_lib
 import smtplib
 import imaplib
 import email as email_lib
 import urllib.request
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.feedparser import BytesFeedParser
 from email.header import decode_header
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -22,7 +28,7 @@ from email.utils import parseaddr, formatdate, make_msgid
 
 import boto3
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 
 
 IMAP_HOST = 'imap.beget.com'
@@ -31,6 +37,32 @@ SMTP_HOST = 'smtp.beget.com'
 SMTP_PORT = 465
 MAX_ATTACH_SIZE = 25 * 1024 * 1024  # 25 МБ на файл
 DEFAULT_MAILBOX_ADDRESS = 'info@sppi.ooo'
+SYNC_BATCH_SIZE = 30  # писем за один проход синхронизации ящика, чтобы уложиться в таймаут функции
+SYNC_FETCH_BYTES = 40 * 1024 * 1024  # сколько байт тел писем скачивается за один проход
+IMPORT_STEP_SECONDS = 20  # сколько длится один шаг задания импорта исторической почты
+IMPORT_CHUNK_SIZE = 200  # UID в одной пачке импорта (одна команда UID FETCH на заголовки)
+IMPORT_FETCH_BYTES = 20 * 1024 * 1024  # байт тел писем на одну пачку импорта
+IMPORT_MAX_ATTEMPTS = 5  # шагов импорта подряд без продвижения, после которых задание считается сломанным
+IMPORT_RETRY_SECONDS = 15  # пауза перед повтором шага после сбоя, растёт с числом попыток
+SYNC_WORKERS = 4  # сколько ящиков синхронизируется одновременно
+ATTACHMENT_UPLOAD_WORKERS = 6  # параллельных загрузок вложений в хранилище
+ATTACHMENT_DOWNLOAD_WORKERS = 6  # параллельных скачиваний вложений по ссылкам перед отправкой письма
+SMTP_IDLE_SECONDS = 30  # SMTP-сессию, простоявшую дольше, перед отправкой проверяем NOOP
+BULK_SEND_LIMIT = 100  # клиентов в одном запросе рассылки, чтобы уложиться в таймаут функции
+OUTBOX_DRAIN_SECONDS = 20  # сколько один вызов drain_outbox отправляет письма из очереди
+OUTBOX_MAX_ATTEMPTS = 6  # попыток доставки письма при временных ошибках SMTP
+OUTBOX_RETRY_SECONDS = 60  # пауза перед первым повтором, дальше удваивается (не больше часа)
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = 5  # одновременных запросов webhook от Telegram при разборе очереди апдейтов
+SEARCH_LIMIT_MAX = 200  # результатов поиска на одной странице
+SEARCH_BACKFILL_BATCH = 500  # старых сообщений, индексируемых для поиска одной транзакцией
+SEARCH_BACKFILL_SECONDS = 2  # сколько запрос поиска тратит на индексацию старой переписки, пока она не закончена
+MESSAGES_POLL_OVERLAP_SECONDS = 60  # на сколько опрос updated_since отступает назад, чтобы подобрать поздно закоммиченные изменения
+BACKFILL_OVERLAP_SECONDS = 300  # запас назад от прошлого прохода привязки писем к клиентам, на поздние коммиты
+NOTIFICATIONS_WAIT_SECONDS = 10  # сколько долгий опрос уведомлений ждёт новое сообщение, пока не ответит пустым списком
+NOTIFICATIONS_MAX_CONNECTION_SHARE = 0.5  # при занятой доле подключений к БД выше этой долгий опрос не ждёт
+HEADER_FIELDS = 'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID FROM DATE SUBJECT)]'
+FETCH_CHUNK_BYTES = 1024 * 1024  # письмо крупнее скачивается частями такого размера, мелкие — пачкой до этого объёма
+ATTACH_SPOOL_BYTES = 256 * 1024  # вложение крупнее держится во временном файле, а не в памяти
 
 
 def handler(event, context):
@@ -72,11 +104,19 @@ def handler(event, context):
                 return get_notifications(conn, params)
             if resource == 'folder_messages':
                 return get_folder_messages(conn, params)
+            if resource == 'import_job':
+                return get_import_job(conn, params)
+            if resource == 'search':
+                return search_messages(conn, params)
             return error_response('Unknown resource', 400)
 
         if method == 'POST':
             if resource == 'send_email':
                 return send_email(conn, body)
+            if resource == 'send_bulk_email':
+                return send_bulk_email(conn, body)
+            if resource == 'drain_outbox':
+                return drain_outbox(conn, body)
             if resource == 'send_telegram':
                 return send_telegram(conn, body)
             if resource == 'sync_email':
@@ -91,12 +131,18 @@ def handler(event, context):
                 return save_folder(conn, body)
             if resource == 'move_message':
                 return move_message(conn, body)
+            if resource == 'save_folder_rule':
+                return save_folder_rule(conn, body)
+            if resource == 'delete_folder_rule':
+                return delete_folder_rule(conn, body)
+            if resource == 'apply_folder_rules':
+                return apply_folder_rules(conn, body)
             if resource == 'save_signature':
                 return save_signature(conn, body)
             if resource == 'upload_signature_image':
-                return upload_signature_image(body)
+                return upload_signature_image(conn, body)
             if resource == 'upload_attachment':
-                return upload_attachment(body)
+                return upload_attachment(conn, body)
             if resource == 'delete_message':
                 return delete_message(conn, body)
             if resource == 'delete_conversation':
@@ -115,16 +161,34 @@ def handler(event, context):
 # ------------------------------------------------------------ conversations --
 
 def get_conversations(conn, params):
-    """Список диалогов партнёра: по одному на клиента, с последним сообщением и счётчиком непрочитанных."""
+    """Список диалогов партнёра: по одному на клиента, с последним сообщением и счётчиком непрочитанных.
+    Читается из сводки bridge_conversations (её ведёт триггер на bridge_messages), упорядочен по
+    последней активности. С limit отдаётся страница и next_cursor для следующей (before=...),
+    с client_id — только диалог этого клиента (открытого из карточки, но не попавшего на страницу)."""
     partner_id = _parse_int(params.get('partner_id'))
     if partner_id is None:
         return error_response('Missing partner_id', 400)
     channel = params.get('channel')  # опциональный фильтр по каналу
     mailbox = params.get('mailbox')  # опциональный фильтр по почтовому ящику
+    limit = _parse_int(params.get('limit'))
+    client_id = _parse_int(params.get('client_id'))
+    if params.get('client_id') and client_id is None:
+        return error_response('Invalid client_id', 400)
+    before = params.get('before')
+    before_key = _parse_cursor(before) if before else None
+    if before and before_key is None:
+        return error_response('Invalid cursor', 400)
+
+    if mailbox:
+        scope = f'mailbox:{mailbox}'
+    elif channel:
+        scope = f'channel:{channel}'
+    else:
+        scope = 'all'
 
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         query = """
-            SELECT DISTINCT ON (c.id)
+            SELECT
                 c.id AS client_id,
                 c.company_name,
                 c.contact_person,
@@ -135,37 +199,93 @@ def get_conversations(conn, params):
                 c.unread_messages_count,
                 c.last_message_at,
                 c.auto_created,
-                m.channel AS last_channel,
-                m.body AS last_message,
-                m.direction AS last_direction,
-                m.mailbox AS last_mailbox,
-                m.created_at AS last_message_created_at
-            FROM crm_clients c
-            JOIN bridge_messages m ON m.client_id = c.id
-            WHERE c.partner_id = %s AND m.is_duplicate = FALSE
+                s.last_channel,
+                s.last_message,
+                s.last_direction,
+                s.last_mailbox,
+                s.last_message_created_at
+            FROM bridge_conversations s
+            JOIN crm_clients c ON c.id = s.client_id
+            WHERE s.partner_id = %s AND s.scope = %s AND c.partner_id = %s
         """
-        args = [partner_id]
-        if channel:
-            query += " AND m.channel = %s"
+        args = [partner_id, scope, partner_id]
+        if mailbox and channel:
+            query += " AND s.last_channel = %s"
             args.append(channel)
-        if mailbox:
-            query += " AND m.mailbox = %s"
-            args.append(mailbox)
-        query += " ORDER BY c.id, m.created_at DESC"
+        if client_id is not None:
+            query += " AND s.client_id = %s"
+            args.append(client_id)
+        if before_key:
+            query += " AND (s.last_message_created_at, s.client_id) < (%s, %s)"
+            args.extend(before_key)
+        query += " ORDER BY s.last_message_created_at DESC, s.client_id DESC"
+        if limit:
+            query += " LIMIT %s"
+            args.append(limit)
 
         cur.execute(query, args)
         rows = cur.fetchall()
 
-    rows.sort(key=lambda r: r['last_message_created_at'] or '', reverse=True)
-    return ok_response({'conversations': rows})
+    result = {'conversations': rows}
+    if limit:
+        last = rows[-1] if len(rows) == limit else None
+        result['next_cursor'] = _make_cursor(last['last_message_created_at'], last['client_id']) if last else None
+    return ok_response(result)
+
+
+def _make_cursor(ts, row_id):
+    """Курсор постраничной выдачи: время + id строки для однозначного порядка"""
+    return f"{ts.isoformat()}|{row_id}"
+
+
+def _parse_cursor(raw):
+    """'2026-05-01T10:00:00.123456|42' -> (datetime, id) или None"""
+    ts, _, row_id = raw.rpartition('|')
+    ts = _parse_timestamp(ts)
+    row_id = _parse_int(row_id)
+    if ts is None or row_id is None:
+        return None
+    return ts, row_id
+
+
+def _parse_timestamp(raw):
+    from datetime import datetime
+    try:
+        return datetime.fromisoformat(raw)
+    except (ValueError, TypeError):
+        return None
+
+
+def _parse_updated_since(raw):
+    """Курсор опроса (updated_at, id); голая метка времени — курсор (метка, 0)"""
+    if '|' in raw:
+        return _parse_cursor(raw)
+    ts = _parse_timestamp(raw)
+    return (ts, 0) if ts else None
 
 
 def get_messages(conn, params):
-    """История сообщений по клиенту (все каналы) или по конкретному каналу, вместе с вложениями"""
+    """История сообщений по клиенту (все каналы) или по конкретному каналу, вместе с вложениями.
+    Без limit отдаётся вся история. С limit — страница от новых к старым: before=<курсор>
+    листает назад, after=<курсор> отдаёт сообщения новее курсора. updated_since=<курсор> —
+    режим опроса: только сообщения, созданные или изменённые после курсора (updated_at, id), и
+    updated_until — курсор для следующего запроса. Пока has_more, курсор указывает сразу за
+    последней строкой страницы; когда изменения выбраны, он ставится на
+    MESSAGES_POLL_OVERLAP_SECONDS раньше момента опроса: updated_at ставит NOW() начала
+    транзакции, и строки транзакции, закоммиченной позже опроса, иначе оказались бы позади
+    курсора. Повторно пришедшие сообщения клиент склеивает по id. Вместо курсора можно передать метку времени."""
     client_id = _parse_int(params.get('client_id'))
     if client_id is None:
         return error_response('Missing client_id', 400)
     channel = params.get('channel')
+    limit = _parse_int(params.get('limit'))
+    before = _parse_cursor(params['before']) if params.get('before') else None
+    after = _parse_cursor(params['after']) if params.get('after') else None
+    updated_since = _parse_updated_since(params['updated_since']) if params.get('updated_since') else None
+    if (params.get('before') and not before) or (params.get('after') and not after):
+        return error_response('Invalid cursor', 400)
+    if params.get('updated_since') and not updated_since:
+        return error_response('Invalid updated_since', 400)
 
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         query = """
@@ -178,13 +298,48 @@ def get_messages(conn, params):
         if channel:
             query += " AND m.channel = %s"
             args.append(channel)
-        query += " ORDER BY m.created_at DESC"
+
+        if updated_since:
+            query += " AND (m.updated_at, m.id) > (%s, %s) ORDER BY m.updated_at ASC, m.id ASC"
+            args.extend(updated_since)
+        elif after:
+            query += " AND (m.created_at, m.id) > (%s, %s) ORDER BY m.created_at ASC, m.id ASC"
+            args.extend(after)
+        else:
+            if before:
+                query += " AND (m.created_at, m.id) < (%s, %s)"
+                args.extend(before)
+            query += " ORDER BY m.created_at DESC, m.id DESC"
+        if limit:
+            query += " LIMIT %s"
+            args.append(limit)
+
         cur.execute(query, args)
         messages = cur.fetchall()
 
         _attach_attachments(cur, messages)
 
-    return ok_response({'messages': messages})
+        if updated_since:
+            # updated_at пишет NOW() транзакции в часовом поясе сессии — тот же отсчёт и здесь
+            cur.execute("SELECT LOCALTIMESTAMP AS now")
+            polled_at = cur.fetchone()['now']
+
+    result = {'messages': messages}
+    if updated_since:
+        from datetime import timedelta
+        result['has_more'] = bool(limit) and len(messages) == limit
+        if result['has_more']:
+            until = (messages[-1]['updated_at'], messages[-1]['id'])
+        else:
+            until = (polled_at - timedelta(seconds=MESSAGES_POLL_OVERLAP_SECONDS), 0)
+        result['updated_until'] = _make_cursor(*until)
+    elif after:
+        messages.reverse()
+        result['has_more'] = bool(limit) and len(messages) == limit
+    elif limit:
+        last = messages[-1] if len(messages) == limit else None
+        result['next_cursor'] = _make_cursor(last['created_at'], last['id']) if last else None
+    return ok_response(result)
 
 
 def get_email_list(conn, params):
@@ -236,24 +391,73 @@ def get_mailboxes():
 
 def get_notifications(conn, params):
     """Новые входящие письма, о которых ещё не показывали уведомление.
-    Возвращает отправителя и название папки, куда письмо попало по правилу сортировки."""
+    Возвращает отправителя и название папки, куда письмо попало по правилу сортировки.
+    wait=<секунды> — долгий опрос: если новых писем нет, запрос ждёт (не дольше
+    NOTIFICATIONS_WAIT_SECONDS) NOTIFY от вставки в bridge_messages и отвечает сразу, как
+    письмо пришло. Пока ждёт, база не опрашивается.
+
+    Цена ожидания — экземпляр функции и подключение к Postgres на каждую открытую вкладку на
+    всё время ожидания. Поэтому ожидание короткое, а если занято больше
+    NOTIFICATIONS_MAX_CONNECTION_SHARE от max_connections, запрос отвечает сразу
+    (long_poll: false) и фронтенд переходит на обычный опрос с паузой: уведомление придёт
+    позже, зато вкладки не выберут подключения у остальных функций."""
     partner_id = _parse_int(params.get('partner_id'))
     if partner_id is None:
         return error_response('Missing partner_id', 400)
+    wait = max(0, min(_parse_int(params.get('wait')) or 0, NOTIFICATIONS_WAIT_SECONDS))
+
+    if wait:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT COUNT(*)::float / current_setting('max_connections')::int FROM pg_stat_activity
+            """)
+            if cur.fetchone()[0] > NOTIFICATIONS_MAX_CONNECTION_SHARE:
+                wait = 0
+        conn.commit()
+
+    if wait:
+        # подписка до первой проверки: письмо, пришедшее между проверкой и ожиданием, не потеряется
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN bridge_messages_{partner_id}")
+        conn.commit()
+
+    deadline = time.monotonic() + wait
+    while True:
+        rows = _claim_notifications(conn, partner_id)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            break
+        if not select.select([conn], [], [], remaining)[0]:
+            break
+        conn.poll()
+        conn.notifies.clear()
+    return ok_response({'notifications': rows, 'long_poll': bool(wait)})
+
+
+def _claim_notifications(conn, partner_id):
+    """Забирает до 20 входящих писем без уведомления и помечает их notified одним запросом.
+    SKIP LOCKED: параллельные опросы (несколько вкладок) не получат одно письмо дважды."""
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute("""
+            WITH claimed AS (
+                UPDATE bridge_messages SET notified = TRUE
+                WHERE id IN (
+                    SELECT id FROM bridge_messages
+                    WHERE partner_id = %s AND direction = 'in' AND notified = FALSE AND is_duplicate = FALSE
+                    ORDER BY created_at ASC LIMIT 20
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, subject, sender_name, email_from, client_id, folder_id, created_at
+            )
             SELECT m.id, m.subject, m.sender_name, m.email_from, m.client_id,
                    f.name AS folder_name, f.color AS folder_color
-            FROM bridge_messages m
+            FROM claimed m
             LEFT JOIN bridge_folders f ON f.id = m.folder_id
-            WHERE m.partner_id = %s AND m.direction = 'in' AND m.notified = FALSE AND m.is_duplicate = FALSE
-            ORDER BY m.created_at ASC LIMIT 20
+            ORDER BY m.created_at ASC, m.id ASC
         """, (partner_id,))
         rows = cur.fetchall()
-        if rows:
-            cur.execute("UPDATE bridge_messages SET notified = TRUE WHERE id = ANY(%s)", ([r['id'] for r in rows],))
-            conn.commit()
-    return ok_response({'notifications': rows})
+        conn.commit()
+    return rows
 
 
 def get_folder_messages(conn, params):
@@ -290,6 +494,110 @@ def mark_read(conn, body):
     return ok_response({'success': True})
 
 
+# ------------------------------------------------------------------- search --
+
+def search_messages(conn, params):
+    """Полнотекстовый поиск по переписке партнёра (письма и Telegram): тема, отправитель, имена
+    вложений и текст, русская и английская морфология. q — строка запроса в синтаксисе
+    websearch ("точная фраза", -исключить, or). Фильтры mailbox, folder_id (или 'none'),
+    channel; limit/offset — страница результатов. Сортировка по релевантности, затем по дате.
+    snippet — фрагменты текста с совпадениями в <mark>…</mark>, остальной текст экранирован.
+    Пока старая переписка не проиндексирована целиком (_backfill_search_documents), ответ
+    содержит indexing: true — результаты могут быть неполными."""
+    partner_id = _parse_int(params.get('partner_id'))
+    if partner_id is None:
+        return error_response('Missing partner_id', 400)
+    q = (params.get('q') or '').strip()
+    if not q:
+        return error_response('Missing q', 400)
+    limit = max(1, min(_parse_int(params.get('limit')) or 50, SEARCH_LIMIT_MAX))
+    offset = max(0, _parse_int(params.get('offset')) or 0)
+    mailbox = params.get('mailbox')
+    folder_id = params.get('folder_id')
+    channel = params.get('channel')
+    if folder_id and folder_id != 'none' and _parse_int(folder_id) is None:
+        return error_response('Invalid folder_id', 400)
+
+    indexing = _backfill_search_documents(conn, SEARCH_BACKFILL_SECONDS)
+
+    filters = ""
+    args = [q, q, partner_id]
+    if mailbox:
+        filters += " AND m.mailbox = %s"
+        args.append(mailbox)
+    if folder_id == 'none':
+        filters += " AND m.folder_id IS NULL"
+    elif folder_id:
+        filters += " AND m.folder_id = %s"
+        args.append(_parse_int(folder_id))
+    if channel:
+        filters += " AND m.channel = %s"
+        args.append(channel)
+    args.extend([limit + 1, offset])
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        # Сначала ранжируется и обрезается страница по индексу, фрагменты (ts_headline —
+        # дорогая операция) строятся только для неё
+        cur.execute(f"""
+            SELECT m.id, m.partner_id, m.client_id, m.channel, m.direction, m.sender_name, m.subject,
+                   m.email_from, m.email_to, m.mailbox, m.folder_id, m.telegram_username,
+                   m.is_read, m.created_at, c.company_name, c.contact_person,
+                   f.name AS folder_name, f.color AS folder_color, hit.rank,
+                   ts_headline('russian',
+                               replace(replace(replace(LEFT(COALESCE(m.body, ''), 20000), '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+                               hit.query,
+                               'StartSel=<mark>, StopSel=</mark>, MaxWords=25, MinWords=8, MaxFragments=2') AS snippet
+            FROM (
+                SELECT s.message_id, ts_rank_cd(s.document, query.q, 32) AS rank, query.q AS query
+                FROM bridge_message_search s
+                JOIN bridge_messages m ON m.id = s.message_id
+                CROSS JOIN (SELECT websearch_to_tsquery('russian', %s) || websearch_to_tsquery('english', %s)) AS query(q)
+                WHERE s.document @@ query.q AND m.partner_id = %s AND m.is_duplicate = FALSE{filters}
+                ORDER BY rank DESC, m.created_at DESC, m.id DESC
+                LIMIT %s OFFSET %s
+            ) hit
+            JOIN bridge_messages m ON m.id = hit.message_id
+            LEFT JOIN crm_clients c ON c.id = m.client_id
+            LEFT JOIN bridge_folders f ON f.id = m.folder_id
+            ORDER BY hit.rank DESC, m.created_at DESC, m.id DESC
+        """, args)
+        messages = cur.fetchall()
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        _attach_attachments(cur, messages)
+
+    result = {'messages': messages, 'has_more': has_more, 'next_offset': offset + limit if has_more else None}
+    if indexing:
+        result['indexing'] = True
+    return ok_response(result)
+
+
+def _backfill_search_documents(conn, seconds):
+    """Индексирует для поиска сообщения, сохранённые до появления поиска: пачками по
+    SEARCH_BACKFILL_BATCH id от новых к старым, каждая пачка — своя короткая транзакция,
+    пока не выйдет время. Пачку забирает один вызов (FOR UPDATE SKIP LOCKED), параллельный
+    поиск её не ждёт. Возвращает True, пока проиндексировано не всё."""
+    deadline = time.monotonic() + seconds
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("SELECT next_id FROM bridge_search_backfill WHERE id = 1 AND next_id > 0 FOR UPDATE SKIP LOCKED")
+            row = cur.fetchone()
+            if not row:
+                conn.commit()
+                cur.execute("SELECT 1 FROM bridge_search_backfill WHERE next_id > 0")
+                pending = cur.fetchone() is not None
+                conn.commit()
+                return pending
+            low = max(row[0] - SEARCH_BACKFILL_BATCH, 0)
+            cur.execute("SELECT bridge_search_refresh(ARRAY(SELECT id FROM bridge_messages WHERE id > %s AND id <= %s))", (low, row[0]))
+            cur.execute("UPDATE bridge_search_backfill SET next_id = %s WHERE id = 1", (low,))
+            conn.commit()
+        if not low:
+            return False
+        if time.monotonic() >= deadline:
+            return True
+
+
 # ------------------------------------------------------------------ folders --
 
 def get_folders(conn, params):
@@ -378,7 +686,8 @@ def move_message(conn, body):
                     UPDATE bridge_messages SET folder_id = %s
                     WHERE partner_id = %s AND channel = 'email'
                       AND (LOWER(email_from) = %s OR LOWER(email_to) = %s)
-                """, (folder_id, partner_id, counterpart, counterpart))
+                      AND folder_id IS DISTINCT FROM %s
+                """, (folder_id, partner_id, counterpart, counterpart, folder_id))
             else:
                 cur.execute("""
                     DELETE FROM bridge_folder_rules WHERE partner_id = %s AND email_address = %s
@@ -387,16 +696,161 @@ def move_message(conn, body):
     return ok_response({'success': True})
 
 
-def _folder_for_address(cur, partner_id, address):
-    """Папка по правилу автосортировки для адреса отправителя (или None)"""
+def save_folder_rule(conn, body):
+    """Добавляет правило автосортировки в папку: точный адрес (ivan@firma.ru), домен
+    (@firma.ru или firma.ru) или шаблон со звёздочкой (*@*.gov.ru, noreply@*).
+    apply=true — сразу разложить по правилам уже сохранённую переписку."""
+    partner_id = body.get('partner_id')
+    folder_id = body.get('folder_id')
+    pattern = _normalize_folder_rule(body.get('pattern'))
+    if not partner_id or not folder_id or not pattern:
+        return error_response('partner_id, folder_id and pattern are required', 400)
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT id FROM bridge_folders WHERE id = %s AND partner_id = %s", (folder_id, partner_id))
+        if not cur.fetchone():
+            return error_response('Папка не найдена', 404)
+        cur.execute("""
+            INSERT INTO bridge_folder_rules (partner_id, folder_id, email_address)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (partner_id, email_address)
+            DO UPDATE SET folder_id = EXCLUDED.folder_id
+            RETURNING *
+        """, (partner_id, folder_id, pattern))
+        rule = cur.fetchone()
+        moved = _apply_folder_rules(cur, partner_id, _load_folder_rules(cur, partner_id)) if body.get('apply') else 0
+        conn.commit()
+    return ok_response({'success': True, 'rule': rule, 'moved': moved})
+
+
+def delete_folder_rule(conn, body):
+    """Удаляет правило автосортировки. Уже разложенные письма остаются в папке."""
+    partner_id = body.get('partner_id')
+    pattern = _normalize_folder_rule(body.get('pattern'))
+    if not partner_id or not pattern:
+        return error_response('partner_id and pattern are required', 400)
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM bridge_folder_rules WHERE partner_id = %s AND email_address = %s", (partner_id, pattern))
+        conn.commit()
+    return ok_response({'success': True})
+
+
+def apply_folder_rules(conn, body):
+    """Раскладывает всю сохранённую почту партнёра по текущим правилам автосортировки одним
+    UPDATE (например, после добавления доменного правила). folder_id — переносить только в эту
+    папку. Письма, не подходящие ни под одно правило, остаются где были."""
+    partner_id = body.get('partner_id')
+    if not partner_id:
+        return error_response('Missing partner_id', 400)
+    folder_id = _parse_int(body.get('folder_id'))
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        moved = _apply_folder_rules(cur, partner_id, _load_folder_rules(cur, partner_id), folder_id)
+        conn.commit()
+    return ok_response({'success': True, 'moved': moved})
+
+
+def _normalize_folder_rule(raw):
+    """Правило в том виде, в каком оно хранится: нижний регистр, без пробелов"""
+    return re.sub(r'\s+', '', str(raw or '')).lower()
+
+
+def _folder_rule_kind(pattern):
+    """Вид правила: 0 — точный адрес, 1 — домен, 2 — шаблон со звёздочкой (порядок = приоритет)"""
+    if '*' in pattern:
+        return 2
+    if '@' not in pattern or pattern.startswith('@'):
+        return 1
+    return 0
+
+
+def _load_folder_rules(cur, partner_id):
+    """Все правила автосортировки партнёра одним запросом, в виде сопоставителя для _match_folder"""
+    cur.execute("""
+        SELECT id, folder_id, email_address FROM bridge_folder_rules
+        WHERE partner_id = %s ORDER BY id
+    """, (partner_id,))
+    return _compile_folder_rules(cur.fetchall())
+
+
+def _compile_folder_rules(rows):
+    """Сопоставитель адресов с папками. Точный адрес важнее домена, домен важнее шаблона;
+    среди шаблонов побеждает более длинный, при равенстве — более раннее правило.
+    rows — те же правила в порядке приоритета (для set-based _apply_folder_rules)."""
+    ordered = sorted(
+        ({'id': r['id'], 'folder_id': r['folder_id'], 'pattern': _normalize_folder_rule(r['email_address'])} for r in rows),
+        key=lambda r: (_folder_rule_kind(r['pattern']), -len(r['pattern']) if '*' in r['pattern'] else 0, r['id']),
+    )
+    exact, domains, wildcards = {}, {}, []
+    for r in ordered:
+        pattern = r['pattern']
+        kind = _folder_rule_kind(pattern)
+        if kind == 0:
+            exact.setdefault(pattern, r['folder_id'])
+        elif kind == 1:
+            domains.setdefault(pattern.lstrip('@'), r['folder_id'])
+        else:
+            regex = re.compile('.*'.join(re.escape(part) for part in pattern.split('*')))
+            wildcards.append((regex, r['folder_id']))
+    return {'exact': exact, 'domains': domains, 'wildcards': wildcards, 'rows': ordered}
+
+
+def _match_folder(rules, address):
+    """Папка по правилам автосортировки для адреса отправителя/получателя (или None)"""
+    address = (address or '').strip().lower()
     if not address:
         return None
+    folder_id = rules['exact'].get(address)
+    if folder_id is None and '@' in address:
+        folder_id = rules['domains'].get(address.split('@')[1])
+    if folder_id is None:
+        folder_id = next((f for regex, f in rules['wildcards'] if regex.fullmatch(address)), None)
+    return folder_id
+
+
+def _apply_folder_rules(cur, partner_id, rules, folder_id=None):
+    """Переносит письма партнёра в папки по правилам одним UPDATE; возвращает число перенесённых.
+    Адрес письма — отправитель у входящих и получатель у исходящих, приоритет правил — как
+    в _match_folder. folder_id — переносить только письма, которым по правилам положена эта папка.
+    Точные адреса и домены соединяются хеш-соединением, шаблоны (их обычно единицы) — LIKE."""
+    if not rules['rows']:
+        return 0
+    kinds, keys, folders = [], [], []
+    for r in rules['rows']:
+        pattern = r['pattern']
+        kind = _folder_rule_kind(pattern)
+        if kind == 1:
+            pattern = pattern.lstrip('@')
+        elif kind == 2:
+            pattern = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace('*', '%')
+        kinds.append(kind)
+        keys.append(pattern)
+        folders.append(r['folder_id'])
     cur.execute("""
-        SELECT folder_id FROM bridge_folder_rules
-        WHERE partner_id = %s AND email_address = %s
-    """, (partner_id, address.strip().lower()))
-    row = cur.fetchone()
-    return row['folder_id'] if row else None
+        WITH rules AS (
+            SELECT * FROM unnest(%(kinds)s::int[], %(keys)s::text[], %(folders)s::int[])
+                WITH ORDINALITY AS r(kind, key, folder_id, priority)
+        ),
+        targets AS (
+            SELECT id, LOWER(TRIM(CASE WHEN direction = 'in' THEN email_from ELSE email_to END)) AS addr
+            FROM bridge_messages
+            WHERE partner_id = %(partner_id)s AND channel = 'email'
+        ),
+        matched AS (
+            SELECT DISTINCT ON (id) id, folder_id
+            FROM (
+                SELECT t.id, r.folder_id, r.priority FROM targets t JOIN rules r ON r.kind = 0 AND t.addr = r.key
+                UNION ALL
+                SELECT t.id, r.folder_id, r.priority FROM targets t JOIN rules r ON r.kind = 1 AND split_part(t.addr, '@', 2) = r.key
+                UNION ALL
+                SELECT t.id, r.folder_id, r.priority FROM targets t JOIN rules r ON r.kind = 2 AND t.addr LIKE r.key
+            ) x
+            ORDER BY id, priority
+        )
+        UPDATE bridge_messages m SET folder_id = matched.folder_id
+        FROM matched
+        WHERE m.id = matched.id AND m.folder_id IS DISTINCT FROM matched.folder_id
+          AND (%(folder_id)s::int IS NULL OR matched.folder_id = %(folder_id)s::int)
+    """, {'partner_id': partner_id, 'kinds': kinds, 'keys': keys, 'folders': folders, 'folder_id': folder_id})
+    return cur.rowcount
 
 
 def delete_folder(conn, body):
@@ -487,7 +941,7 @@ def save_signature(conn, body):
     return ok_response({'success': True, 'signature': signature})
 
 
-def upload_signature_image(body):
+def upload_signature_image(conn, body):
     """Загружает картинку для подписи в хранилище и возвращает публичную ссылку"""
     data_url = body.get('data') or ''
     name = body.get('name') or 'image.png'
@@ -499,11 +953,11 @@ def upload_signature_image(body):
         return error_response('Некорректный файл', 400)
     if len(raw) > 5 * 1024 * 1024:
         return error_response('Картинка больше 5 МБ', 400)
-    url = _upload_bytes(raw, name, mime, prefix='signatures')
+    url = _store_blob(conn, raw, name, mime, prefix='signatures')
     return ok_response({'success': True, 'url': url})
 
 
-def upload_attachment(body):
+def upload_attachment(conn, body):
     """Загружает одно вложение письма в хранилище и возвращает публичную ссылку.
     Файлы для письма с несколькими вложениями загружаются по одному отдельными запросами —
     иначе при отправке письма одним запросом с несколькими base64-файлами тело запроса
@@ -518,7 +972,7 @@ def upload_attachment(body):
         return error_response('Некорректный файл', 400)
     if len(raw) > MAX_ATTACH_SIZE:
         return error_response(f'Файл "{name}" превышает 25 МБ', 400)
-    url = _upload_bytes(raw, name, mime, prefix='bridge-attachments')
+    url = _store_blob(conn, raw, name, mime, prefix='bridge-attachments')
     return ok_response({'success': True, 'url': url, 'name': name, 'mime': mime, 'size': len(raw)})
 
 
@@ -577,20 +1031,98 @@ def _decode_mime_words(s):
     return decoded
 
 
+_HTML_BLOCK_START = re.compile(r'<(?:(!--)|(script|style))', re.IGNORECASE)
+_HTML_RAW_TEXT_START = re.compile(r'<(script|style)', re.IGNORECASE)
+_HTML_BLOCK_END = {
+    '>': re.compile(r'>'),
+    '-->': re.compile(r'-->'),
+    'script': re.compile(r'</script>', re.IGNORECASE),
+    'style': re.compile(r'</style>', re.IGNORECASE),
+}
+_HTML_BREAK_TAG = re.compile(r'<(br|/p|/div|/tr|/li|/h[1-6])\s*/?>', re.IGNORECASE)
+_HTML_TAG = re.compile(r'<[^>]+>')
+
+
 def _html_to_text(html):
     """Превращает HTML-письмо в читаемый текст: убирает <style>/<script> целиком (иначе их
-    содержимое остаётся текстом после вырезания тегов), заменяет теги-разделители на переносы
-    строк, декодирует HTML-сущности (&nbsp;, &amp; и т.п.) и схлопывает лишние пробелы."""
-    text = re.sub(r'<(script|style)[^>]*>.*?</\1>', ' ', html, flags=re.IGNORECASE | re.DOTALL)
-    text = re.sub(r'<!--.*?-->', ' ', text, flags=re.DOTALL)
-    text = re.sub(r'<(br|/p|/div|/tr|/li|/h[1-6])\s*/?>', '\n', text, flags=re.IGNORECASE)
-    text = re.sub(r'<[^>]+>', ' ', text)
+    содержимое остаётся текстом после вырезания тегов) и комментарии, заменяет теги-разделители
+    на переносы строк, декодирует HTML-сущности (&nbsp;, &amp; и т.п.) и схлопывает лишние пробелы.
+    Ни один проход не возвращается назад по документу, поэтому время линейно от размера письма —
+    даже на незакрытых <script> и комментариях или '<' без '>' (см. _strip_html_blocks).
+    html.parser здесь не подходит: у него всё после незакрытого <script> пропадает вместе
+    с текстом письма, а '<' и '>' в тексте («цена < 3000») дают другой результат, чем раньше."""
+    text = _strip_html_blocks(html)
+    text = _HTML_BREAK_TAG.sub('\n', text)
+    # после последнего '>' тегов нет; без этой отсечки каждый '<' в хвосте просматривал бы его до конца
+    last = text.rfind('>')
+    text = _HTML_TAG.sub(' ', text[:last + 1]) + text[last + 1:]
     text = html_lib.unescape(text)
     text = re.sub(r'[ \t]+', ' ', text)
     text = re.sub(r'\n\s*\n+', '\n\n', text)
     return text.strip()
 
 
+def _strip_html_blocks(html):
+    """Заменяет пробелом <script>/<style> вместе с содержимым и комментарии <!-- -->, за один
+    проход по их началам. Регулярное выражение вида '<script>.*?</script>' на каждом незакрытом
+    теге просматривает весь хвост письма, здесь же найденное положение закрывающего тега
+    (и '>' открывающего — у '<script' без '>' поиск тоже шёл бы до конца) запоминается и
+    повторно не ищется. Как и раньше, <script>/<style> имеют приоритет:
+    комментарий не может закончиться внутри них."""
+    found = {}  # закрывающая последовательность -> (откуда искали, позиция ближайшего вхождения или -1)
+
+    def find(closer, start):
+        since, at = found.get(closer, (len(html) + 1, -1))
+        if start < since or 0 <= at < start:
+            m = _HTML_BLOCK_END[closer].search(html, start)
+            at = m.start() if m else -1
+            found[closer] = (start, at)
+        return at
+
+    def raw_text_end(m):
+        """Конец <script>/<style> вместе с содержимым; -1 — блок не закрыт"""
+        name = 'style' if len(m.group(m.lastindex)) == 5 else 'script'
+        open_end = find('>', m.end())
+        if open_end < 0:
+            return -1
+        end = find(name, open_end + 1)
+        return end + len(name) + 3 if end >= 0 else -1
+
+    def comment_end(lt):
+        """Конец комментария; -1 — комментарий не закрыт"""
+        end = find('-->', lt + 4)
+        pos = lt + 4
+        while end >= 0:
+            m = _HTML_RAW_TEXT_START.search(html, pos, end)
+            if not m:
+                return end + 3
+            raw_end = raw_text_end(m)
+            pos = raw_end if raw_end >= 0 else m.start() + 1
+            if raw_end > end:
+                end = find('-->', raw_end)
+        return -1
+
+    out = []
+    pos = 0
+    while True:
+        m = _HTML_BLOCK_START.search(html, pos)
+        if not m:
+            break
+        lt = m.start()
+        end = comment_end(lt) if m.group(1) else raw_text_end(m)
+        if end < 0:
+            out.append(html[pos:lt + 1])
+            pos = lt + 1
+            continue
+        out.append(html[pos:lt])
+        out.append(' ')
+        pos = end
+    if not out:
+        return html
+    out.append(html[pos:])
+    return ''.join(out)
+
+
 def _get_email_body(msg):
     """Извлекает текстовое тело письма (предпочитая text/plain)"""
     if msg.is_multipart():
@@ -631,8 +1163,13 @@ def _get_email_body(msg):
         return text
 
 
-def _extract_email_attachments(msg):
-    """Достаёт вложения письма: [(filename, mime, raw_bytes), ...]"""
+def _spool_attachments(msg):
+    """Достаёт вложения письма по одному во временные файлы: [(filename, mime, spool, size, sha256), ...].
+    Это не потоковый разбор: письмо уже целиком разобрано в памяти вместе с закодированными
+    вложениями, и память ограничена размером одного письма. Экономится другое — раскодированные
+    копии: base64 раскодируется кусками прямо в файл, и после разбора пачки дерево письма можно
+    отпустить. Вложения крупнее MAX_ATTACH_SIZE отбрасываются, не раскодируясь. Вложенное письмо
+    (message/rfc822) и составное вложение сохраняются в исходном MIME-виде."""
     atts = []
     if not msg.is_multipart():
         return atts
@@ -643,38 +1180,208 @@ def _extract_email_attachments(msg):
             continue
         if 'attachment' not in disp and 'inline' not in disp:
             continue
-        filename = _decode_mime_words(filename)
-        try:
-            payload = part.get_payload(decode=True)
-        except Exception:
+        encoded = part.get_payload()
+        if not encoded:
+            continue
+        if isinstance(encoded, str) and len(encoded) * 3 // 4 > MAX_ATTACH_SIZE + 4096:
             continue
-        if not payload:
+        spool = _spool_part(part)
+        size = spool.tell()
+        if not size or size > MAX_ATTACH_SIZE:
+            spool.close()
             continue
-        atts.append((filename, part.get_content_type(), payload))
+        atts.append((_decode_mime_words(filename), part.get_content_type(), spool, size, _spool_digest(spool)))
     return atts
 
 
-def _upload_bytes(raw, filename, mime, prefix='bridge'):
+def _spool_part(part):
+    """Раскодированное содержимое части письма во временном файле. base64 (почти все вложения)
+    раскодируется кусками по 64 КБ; прочие кодировки и битый base64 — штатным get_payload.
+    У вложенного письма и составного вложения содержимое — их MIME-текст (as_bytes)."""
+    spool = tempfile.SpooledTemporaryFile(max_size=ATTACH_SPOOL_BYTES)
+    encoded = part.get_payload()
+    if not isinstance(encoded, str):
+        inner = encoded[0] if part.get_content_type() == 'message/rfc822' and encoded else part
+        try:
+            spool.write(inner.as_bytes())
+        except Exception:
+            spool.seek(0)
+            spool.truncate()
+        return spool
+    if str(part.get('Content-Transfer-Encoding') or '').strip().lower() == 'base64':
+        try:
+            tail = ''
+            for pos in range(0, len(encoded), 65536):
+                chunk = tail + re.sub(r'\s+', '', encoded[pos:pos + 65536])
+                cut = len(chunk) - len(chunk) % 4
+                spool.write(base64.b64decode(chunk[:cut], validate=True))
+                tail = chunk[cut:]
+            if tail:
+                spool.write(base64.b64decode(tail + '=' * (-len(tail) % 4), validate=True))
+            return spool
+        except (binascii.Error, ValueError):
+            spool.seek(0)
+            spool.truncate()
+    try:
+        spool.write(part.get_payload(decode=True) or b'')
+    except Exception:
+        spool.seek(0)
+        spool.truncate()
+    return spool
+
+
+def _spool_digest(spool):
+    h = hashlib.sha256()
+    spool.seek(0)
+    for chunk in iter(lambda: spool.read(65536), b''):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def _close_attachments(attachments):
+    for _, _, spool, _, _ in attachments:
+        spool.close()
+
+
+_s3_client = None
+_s3_lock = threading.Lock()
+
+
+def _s3():
+    """Один S3-клиент на контейнер: создание клиента дороже самой загрузки небольшого файла.
+    Готовый boto3-клиент можно использовать из нескольких потоков, а вот создавать его
+    параллельно нельзя — поэтому создание под блокировкой."""
+    global _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                's3',
+                endpoint_url='https://bucket.poehali.dev',
+                aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            )
+    return _s3_client
+
+
+def _blob_key(prefix, digest, filename):
+    """Ключ объекта в хранилище по содержимому: prefix/sha256.расширение"""
     ext = filename.rsplit('.', 1)[-1].lower()[:8] if '.' in filename else ''
-    key = f"{prefix}/{uuid.uuid4().hex}{('.' + ext) if ext else ''}"
-    s3 = boto3.client(
-        's3',
-        endpoint_url='https://bucket.poehali.dev',
-        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
-    )
-    s3.put_object(Bucket='files', Key=key, Body=raw, ContentType=mime or 'application/octet-stream')
+    return f"{prefix}/{digest}{('.' + ext) if ext else ''}"
+
+
+def _upload_bytes(raw, key, mime):
+    """Кладёт файл в хранилище (raw — байты или открытый временный файл) и возвращает ссылку"""
+    if hasattr(raw, 'seek'):
+        raw.seek(0)
+    _s3().put_object(Bucket='files', Key=key, Body=raw, ContentType=mime or 'application/octet-stream')
     return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
 
 
-def _save_attachment(cur, message_id, filename, mime, raw):
-    if len(raw) > MAX_ATTACH_SIZE:
-        return
-    url = _upload_bytes(raw, filename, mime)
+def _stored_blob_urls(cur, keys):
+    """Ссылки на уже загруженные объекты: {ключ: url}"""
+    keys = list(set(keys))
+    if not keys:
+        return {}
+    cur.execute("SELECT s3_key, url FROM storage_blobs WHERE s3_key = ANY(%s)", (keys,))
+    return {r[0]: r[1] for r in cur.fetchall()}
+
+
+def _remember_blob(cur, key, digest, url, size, mime):
     cur.execute("""
-        INSERT INTO bridge_attachments (message_id, file_name, mime, size_bytes, url)
+        INSERT INTO storage_blobs (sha256, s3_key, url, size_bytes, mime)
         VALUES (%s, %s, %s, %s, %s)
-    """, (message_id, filename, mime, len(raw), url))
+        ON CONFLICT (s3_key) DO NOTHING
+    """, (digest, key, url, size, mime))
+
+
+def _store_blob(conn, raw, filename, mime, prefix):
+    """Загружает один файл в хранилище; если этот объект уже загружен, возвращает его ссылку"""
+    digest = hashlib.sha256(raw).hexdigest()
+    key = _blob_key(prefix, digest, filename)
+    with conn.cursor() as cur:
+        url = _stored_blob_urls(cur, [key]).get(key)
+        if url:
+            return url
+        url = _upload_bytes(raw, key, mime)
+        _remember_blob(cur, key, digest, url, len(raw), mime)
+        conn.commit()
+    return url
+
+
+def _queue_attachment(pending, message_id, filename, mime, body, size=None, digest=None):
+    """Откладывает загрузку вложения до фиксации строк писем (см. _flush_attachments).
+    body — байты или временный файл из _spool_attachments (тогда size и digest уже посчитаны)."""
+    if size is None:
+        size = len(body)
+    if size > MAX_ATTACH_SIZE:
+        if hasattr(body, 'close'):
+            body.close()
+        return
+    if digest is None:
+        digest = hashlib.sha256(body).hexdigest()
+    pending.append((message_id, filename, mime, body, size, digest))
+
+
+def _flush_attachments(conn, pending):
+    """Загружает отложенные вложения в хранилище параллельно (до ATTACHMENT_UPLOAD_WORKERS
+    одновременно) и записывает строку bridge_attachments по готовности каждого файла.
+    Вызывается после commit писем, поэтому долгие put_object не держат открытой транзакцию.
+    Файлы, которые уже есть в storage_blobs (тот же договор в двадцати цепочках писем),
+    не загружаются повторно, а одинаковые файлы внутри пачки загружаются один раз.
+    Вложение, которое не удалось загрузить, пропускается — само письмо уже сохранено.
+    Временные файлы вложений закрываются здесь же. Возвращает количество сохранённых вложений."""
+    if not pending:
+        return 0
+    items = [(_blob_key('bridge', item[5], item[1]),) + item for item in pending]
+    pending.clear()
+
+    saved = 0
+    try:
+        with conn.cursor() as cur:
+            urls = _stored_blob_urls(cur, [item[0] for item in items])
+            for key, url in urls.items():
+                saved += _insert_attachment_rows(cur, items, key, url)
+            conn.commit()
+
+            uploads = {}
+            for key, message_id, filename, mime, body, size, digest in items:
+                if key not in urls and key not in uploads:
+                    uploads[key] = (mime, body, size, digest)
+            if not uploads:
+                return saved
+
+            with ThreadPoolExecutor(max_workers=min(ATTACHMENT_UPLOAD_WORKERS, len(uploads))) as pool:
+                futures = {
+                    pool.submit(_upload_bytes, body, key, mime): (key, mime, size, digest)
+                    for key, (mime, body, size, digest) in uploads.items()
+                }
+                for future in as_completed(futures):
+                    key, mime, size, digest = futures[future]
+                    try:
+                        url = future.result()
+                    except Exception:
+                        continue
+                    _remember_blob(cur, key, digest, url, size, mime)
+                    saved += _insert_attachment_rows(cur, items, key, url)
+                    conn.commit()
+    finally:
+        for item in items:
+            if hasattr(item[4], 'close'):
+                item[4].close()
+    return saved
+
+
+def _insert_attachment_rows(cur, items, key, url):
+    """Строки bridge_attachments для всех вложений пачки, попавших в этот объект"""
+    count = 0
+    for item_key, message_id, filename, mime, _, size, _ in items:
+        if item_key == key:
+            cur.execute("""
+                INSERT INTO bridge_attachments (message_id, file_name, mime, size_bytes, url)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (message_id, filename, mime, size, url))
+            count += 1
+    return count
 
 
 def _get_default_stage_key(cur, partner_id):
@@ -688,31 +1395,36 @@ def _get_default_stage_key(cur, partner_id):
     return row['stage_key'] if row else 'new'
 
 
-def _find_client_or_create(cur, partner_id, clients_by_email, counterpart_addr, counterpart_name, own_addresses, default_stage_key):
-    """Находит клиента по email; если не найден и адрес не наш собственный — создаёт новый лид
-    на первой стадии воронки партнёра."""
-    if not counterpart_addr:
-        return None
-    client_id = clients_by_email.get(counterpart_addr)
-    if client_id:
-        return client_id
-    if counterpart_addr in own_addresses:
-        return None
-
-    company_name = counterpart_name or counterpart_addr
-    cur.execute("""
+def _create_leads(cur, partner_id, senders, clients_by_email, default_stage_key):
+    """Создаёт лиды на первой стадии воронки для неизвестных отправителей пачки писем одним
+    INSERT ... ON CONFLICT: senders — {адрес: имя}. Если лид с тем же адресом уже создан
+    параллельной синхронизацией (уникальный индекс по partner_id, lower(email) среди
+    auto_created), возвращается его id, а не второй лид. Найденные id дописываются
+    в clients_by_email; возвращает число действительно созданных лидов."""
+    if not senders:
+        return 0
+    # адреса в одном порядке во всех процессах — параллельные вставки не взаимоблокируются
+    rows = [
+        (partner_id, name or addr, name or '', addr, default_stage_key)
+        for addr, name in sorted(senders.items())
+    ]
+    leads = execute_values(cur, """
         INSERT INTO crm_clients (partner_id, company_name, contact_person, email, stage, auto_created)
-        VALUES (%s, %s, %s, %s, %s, TRUE)
-        RETURNING id
-    """, (partner_id, company_name, counterpart_name or '', counterpart_addr, default_stage_key))
-    new_id = cur.fetchone()['id']
-    clients_by_email[counterpart_addr] = new_id
-    return new_id
+        VALUES %s
+        ON CONFLICT (partner_id, LOWER(email)) WHERE auto_created
+        DO UPDATE SET auto_created = TRUE
+        RETURNING id, LOWER(email) AS email, (xmax = 0) AS created
+    """, rows, template="(%s, %s, %s, %s, %s, TRUE)", page_size=len(rows), fetch=True)
+    for lead in leads:
+        clients_by_email[lead['email']] = lead['id']
+    return sum(1 for lead in leads if lead['created'])
 
 
 def sync_email(conn, body):
     """Синхронизирует входящую почту по всем настроенным IMAP-ящикам: скачивает новые письма,
     привязывает к клиенту по email, создаёт нового лида если отправитель неизвестен.
+    Ящики синхронизируются параллельно (до SYNC_WORKERS одновременно), чтобы TLS-рукопожатие,
+    логин и загрузка по разным ящикам не складывались в таймауте функции.
     От дублирования при параллельных запусках (фоновый таймер + ручная кнопка) защищает
     ON CONFLICT DO NOTHING при вставке и дедупликация запроса на фронтенде."""
     partner_id = body.get('partner_id')
@@ -726,30 +1438,31 @@ def sync_email(conn, body):
     own_addresses = {b['address'].lower() for b in boxes}
 
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("""
-            SELECT email_message_id FROM bridge_messages
-            WHERE channel = 'email' AND email_message_id IS NOT NULL AND is_duplicate = FALSE
-        """)
-        known_ids = {r['email_message_id'] for r in cur.fetchall()}
-
         cur.execute("SELECT id, email FROM crm_clients WHERE partner_id = %s AND email IS NOT NULL AND email != ''", (partner_id,))
         clients_by_email = {r['email'].lower(): r['id'] for r in cur.fetchall() if r['email']}
 
         default_stage_key = _get_default_stage_key(cur, partner_id)
+        # правила автосортировки читаются один раз на синхронизацию, а не запросом на каждое письмо
+        folder_rules = _load_folder_rules(cur, partner_id)
 
     total_imported = 0
     total_created = 0
     errors = []
 
-    for box in boxes:
-        try:
-            imported, created = _sync_mailbox(conn, partner_id, box['address'], box['password'], known_ids, clients_by_email, own_addresses, default_stage_key)
-            total_imported += imported
-            total_created += created
-        except Exception as exc:
-            errors.append(f"{box['address']}: {exc}")
+    with ThreadPoolExecutor(max_workers=min(SYNC_WORKERS, len(boxes))) as pool:
+        futures = [
+            (box, pool.submit(_sync_mailbox_isolated, partner_id, box, clients_by_email, own_addresses, default_stage_key, folder_rules))
+            for box in boxes
+        ]
+        for box, future in futures:
+            try:
+                imported, created = future.result()
+                total_imported += imported
+                total_created += created
+            except Exception as exc:
+                errors.append(f"{box['address']}: {exc}")
 
-    linked = _backfill_unlinked_emails(conn, partner_id)
+    linked = _backfill_unlinked_emails(conn, partner_id, incremental=True)
 
     result = {'success': True, 'imported': total_imported, 'linked': linked, 'created_leads': total_created}
     if errors:
@@ -757,99 +1470,295 @@ def sync_email(conn, body):
     return ok_response(result)
 
 
-def _sync_mailbox(conn, partner_id, address, password, known_ids, clients_by_email, own_addresses, default_stage_key):
-    """Синхронизирует последние 30 писем одного почтового ящика"""
-    imported = 0
-    created_leads = 0
+def _sync_mailbox_isolated(partner_id, box, clients_by_email, own_addresses, default_stage_key, folder_rules):
+    """Синхронизирует один ящик в отдельном потоке. У каждого потока своё подключение к БД
+    (одно psycopg2-подключение — одна транзакция, делить его между потоками нельзя) и своя
+    копия справочника клиентов по email."""
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        return _sync_mailbox(conn, partner_id, box['address'], box['password'], dict(clients_by_email), own_addresses, default_stage_key, folder_rules)
+    finally:
+        conn.close()
 
-    imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=15)
+
+def _imap_uidvalidity(imap):
+    """UIDVALIDITY выбранной папки (из ответа на SELECT); None, если сервер его не прислал"""
+    _, data = imap.response('UIDVALIDITY')
+    if not data or not data[0]:
+        return None
     try:
-        imap.login(address, password)
-        imap.select('INBOX')
-        status, data = imap.search(None, 'ALL')
-        if status != 'OK':
-            raise RuntimeError('Не удалось получить список писем')
+        return int(data[0])
+    except (ValueError, TypeError):
+        return None
 
-        ids = data[0].split()
-        recent_ids = ids[-30:]  # последние 30 писем за проход, чтобы уложиться в таймаут функции
-        if not recent_ids:
-            return 0, 0
 
-        id_set = b','.join(recent_ids)
-        status, msg_data = imap.fetch(id_set, '(RFC822)')
-        if status != 'OK' or not msg_data:
-            raise RuntimeError('Не удалось получить письма')
+def _get_sync_state(cur, mailbox, folder):
+    """Сохранённое состояние синхронизации ящика: {'uidvalidity', 'last_uid'} или None"""
+    cur.execute("""
+        SELECT uidvalidity, last_uid FROM bridge_mailbox_sync_state
+        WHERE mailbox = %s AND folder = %s
+    """, (mailbox, folder))
+    return cur.fetchone()
 
-        raw_messages = [part[1] for part in msg_data if isinstance(part, tuple)]
 
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            for raw in raw_messages:
-                msg = email_lib.message_from_bytes(raw)
-
-                from_name, from_addr = parseaddr(msg.get('From', ''))
-                from_name = _decode_mime_words(from_name) or from_addr
-                from_addr = (from_addr or '').lower()
-                subject = _decode_mime_words(msg.get('Subject', ''))
-                body_text = _get_email_body(msg)[:20000]
-                to_addr = parseaddr(msg.get('To', ''))[1]
-
-                message_id = (msg.get('Message-ID') or '').strip()
-                if not message_id:
-                    # письмо без Message-ID (частые автоматические рассылки) — строим устойчивый
-                    # отпечаток, иначе оно будет заново засчитано как новое на каждой проверке почты
-                    message_id = _synthetic_message_id(from_addr, subject, msg.get('Date', ''), body_text)
-                if message_id in known_ids:
-                    continue
+def _save_sync_state(cur, mailbox, folder, uidvalidity, last_uid):
+    """Сдвигает водяной знак синхронизации. Параллельный запуск не может откатить его назад:
+    при той же UIDVALIDITY сохраняется больший из UID."""
+    cur.execute("""
+        INSERT INTO bridge_mailbox_sync_state (mailbox, folder, uidvalidity, last_uid, updated_at)
+        VALUES (%s, %s, %s, %s, NOW())
+        ON CONFLICT (mailbox, folder) DO UPDATE SET
+            last_uid = CASE
+                WHEN bridge_mailbox_sync_state.uidvalidity = EXCLUDED.uidvalidity
+                THEN GREATEST(bridge_mailbox_sync_state.last_uid, EXCLUDED.last_uid)
+                ELSE EXCLUDED.last_uid
+            END,
+            uidvalidity = EXCLUDED.uidvalidity,
+            updated_at = NOW()
+    """, (mailbox, folder, uidvalidity, last_uid))
+
+
+def _uid_search(imap, criteria):
+    """UID SEARCH -> отсортированный список целых UID"""
+    status, data = imap.uid('SEARCH', None, criteria)
+    if status != 'OK':
+        raise RuntimeError('Не удалось получить список писем')
+    return sorted(int(u) for u in (data[0] or b'').split())
+
+
+def _new_uids(imap, state, uidvalidity):
+    """UID писем, которых ещё не было при прошлой синхронизации.
+    Первый запуск (или смена UIDVALIDITY, после которой старые UID теряют смысл) — берём
+    последние SYNC_BATCH_SIZE писем, как раньше, а всё более старое догружается через import_range."""
+    if state and uidvalidity is not None and state['uidvalidity'] == uidvalidity:
+        last_uid = state['last_uid']
+        # 'n:*' всегда возвращает хотя бы последнее письмо, даже если его UID меньше n
+        return [u for u in _uid_search(imap, f'UID {last_uid + 1}:*') if u > last_uid]
+    return _uid_search(imap, 'ALL')[-SYNC_BATCH_SIZE:]
+
+
+def _iter_fetch_parts(msg_data, by_uid):
+    """Разбирает ответ FETCH на тройки (id, meta, literal). id — UID для UID FETCH или порядковый
+    номер письма. UID и RFC822.SIZE сервер может прислать и после литерала, поэтому к meta
+    добавляется хвост ответа."""
+    for i, part in enumerate(msg_data):
+        if not isinstance(part, tuple):
+            continue
+        tail = msg_data[i + 1] if i + 1 < len(msg_data) and isinstance(msg_data[i + 1], bytes) else b''
+        meta = part[0] + b' ' + tail
+        m = re.search(rb'UID (\d+)', meta) if by_uid else re.match(rb'\s*(\d+)', meta)
+        if m:
+            yield int(m.group(1)), meta, part[1]
+
+
+def _compact_id_set(ids):
+    """[1, 2, 3, 7, 9, 10] -> '1:3,7,9:10': длинные списки UID уходят на сервер диапазонами"""
+    ranges = []
+    for i in sorted(ids):
+        if ranges and i == ranges[-1][1] + 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+
+def _imap_fetch(imap, ids, query, by_uid):
+    id_set = _compact_id_set(ids)
+    if by_uid:
+        return imap.uid('FETCH', id_set, query)
+    return imap.fetch(id_set, query)
+
+
+def _fetch_headers(imap, ids, by_uid=True):
+    """Первая фаза загрузки: только Message-ID/From/Date/Subject и размер письма, без тела
+    и вложений. Возвращает {id: {'size', 'message_id'}}; письма, удалённые с сервера между
+    поиском и загрузкой, в ответ не попадают."""
+    if not ids:
+        return {}
+    status, data = _imap_fetch(imap, ids, f'(RFC822.SIZE {HEADER_FIELDS})', by_uid)
+    if status != 'OK':
+        raise RuntimeError('Не удалось получить заголовки писем')
+    summaries = {}
+    for key, meta, literal in _iter_fetch_parts(data or [], by_uid):
+        size = re.search(rb'RFC822\.SIZE (\d+)', meta)
+        headers = email_lib.message_from_bytes(literal or b'')
+        summaries[key] = {
+            'size': int(size.group(1)) if size else 0,
+            'message_id': (headers.get('Message-ID') or '').strip(),
+        }
+    return summaries
+
+
+def _iter_messages(imap, ids, summaries, by_uid=True, peek=False):
+    """Вторая фаза: разобранные письма только для отобранных id, по одному, в порядке ids.
+    Мелкие письма скачиваются пачками до FETCH_CHUNK_BYTES одной командой, крупные — по одному
+    частями (_fetch_message), так что в памяти одновременно лежит не больше одного крупного
+    письма, сколько бы ни было в пачке. peek=True не помечает письма прочитанными."""
+    section = 'BODY.PEEK[]' if peek else 'BODY[]'
+    batch, batch_bytes = [], 0
+    for i in ids + [None]:
+        size = summaries[i]['size'] if i is not None else 0
+        if batch and (i is None or size > FETCH_CHUNK_BYTES or batch_bytes + size > FETCH_CHUNK_BYTES):
+            status, data = _imap_fetch(imap, batch, f'({section})', by_uid)
+            if status != 'OK':
+                raise RuntimeError('Не удалось получить письма')
+            raw_by_id = {key: literal for key, _, literal in _iter_fetch_parts(data or [], by_uid)}
+            del data
+            for key in batch:
+                raw = raw_by_id.pop(key, None)
+                if raw is not None:
+                    yield key, email_lib.message_from_bytes(raw)
+            batch, batch_bytes = [], 0
+        if i is None:
+            break
+        if size > FETCH_CHUNK_BYTES:
+            msg = _fetch_message(imap, i, by_uid, section)
+            if msg is not None:
+                yield i, msg
+        else:
+            batch.append(i)
+            batch_bytes += size
+
+
+def _fetch_message(imap, msg_id, by_uid, section):
+    """Скачивает крупное письмо частями по FETCH_CHUNK_BYTES (BODY[]<offset.length>) и сразу
+    скармливает их BytesFeedParser, чтобы ответы IMAP не копились списком кусков. Дерево письма
+    парсер всё равно держит целиком (с закодированными вложениями) — память растёт с размером
+    одного письма.
+    Возвращает None, если письмо успели удалить с сервера."""
+    parser = BytesFeedParser()
+    offset = 0
+    while True:
+        status, data = _imap_fetch(imap, [msg_id], f'({section}<{offset}.{FETCH_CHUNK_BYTES}>)', by_uid)
+        if status != 'OK':
+            raise RuntimeError('Не удалось получить письмо')
+        chunk = next((literal for _, _, literal in _iter_fetch_parts(data or [], by_uid)), None)
+        del data
+        if not chunk:
+            if offset == 0:
+                return None
+            break
+        parser.feed(chunk)
+        offset += len(chunk)
+        if len(chunk) < FETCH_CHUNK_BYTES:
+            break
+    return parser.close()
+
+
+def _parse_message(msg):
+    """Сводит разобранное письмо к полям, которые сохраняются в переписку, а вложения
+    сбрасывает во временные файлы. После этого дерево письма можно отпустить: пока пачка
+    пишется в базу, в памяти держатся только заголовки и тексты писем."""
+    from_name, from_addr = parseaddr(msg.get('From', ''))
+    return {
+        'from_name': _decode_mime_words(from_name) or from_addr,
+        'from_addr': (from_addr or '').lower(),
+        'to_addr': parseaddr(msg.get('To', ''))[1],
+        'to_all': _decode_mime_words(msg.get('To', '')),
+        'cc': _decode_mime_words(msg.get('Cc', '')),
+        'subject': _decode_mime_words(msg.get('Subject', '')),
+        'date': msg.get('Date', ''),
+        'message_id': (msg.get('Message-ID') or '').strip(),
+        'in_reply_to': (msg.get('In-Reply-To') or '').strip() or None,
+        'references': (msg.get('References') or '').strip() or None,
+        'body_text': _get_email_body(msg)[:20000],
+        'attachments': _spool_attachments(msg),
+    }
 
-                in_reply_to = (msg.get('In-Reply-To') or '').strip() or None
-                references = (msg.get('References') or '').strip() or None
-                cc_raw = _decode_mime_words(msg.get('Cc', ''))
-                cc_list = _split_addresses(cc_raw)
-                to_all = _split_addresses(_decode_mime_words(msg.get('To', '')))
 
-                client_id = _find_client_or_create(cur, partner_id, clients_by_email, from_addr, from_name, own_addresses, default_stage_key)
-                if client_id and from_addr not in clients_by_email:
-                    created_leads += 1
+def _download_messages(imap, ids, summaries, by_uid=True, peek=False):
+    """Скачивает и разбирает отобранные письма: [запись _parse_message, ...] в порядке ids"""
+    records = []
+    try:
+        for _, msg in _iter_messages(imap, ids, summaries, by_uid, peek):
+            records.append(_parse_message(msg))
+    except Exception:
+        for record in records:
+            _close_attachments(record['attachments'])
+        raise
+    return records
+
+
+def _known_message_ids(cur, message_ids):
+    """Какие из переданных Message-ID уже сохранены. Проверяются только письма текущей пачки
+    (= ANY по уникальному индексу email_message_id), поэтому стоимость проверки не растёт
+    вместе с объёмом накопленной переписки."""
+    message_ids = [m for m in message_ids if m]
+    if not message_ids:
+        return set()
+    cur.execute("""
+        SELECT email_message_id FROM bridge_messages
+        WHERE channel = 'email' AND is_duplicate = FALSE AND email_message_id = ANY(%s)
+    """, (message_ids,))
+    return {r['email_message_id'] for r in cur.fetchall()}
+
+
+def _needs_download(summary, known_ids):
+    """Письмо с уже сохранённым Message-ID отбрасывается по заголовкам. Письмо без Message-ID
+    приходится скачать: его синтетический идентификатор строится по тексту."""
+    return not summary['message_id'] or summary['message_id'] not in known_ids
+
+
+def _plan_body_fetch(uids, summaries, known_ids, byte_budget):
+    """По заголовкам решает, какие письма скачивать целиком за этот проход.
+    Возвращает (uid для загрузки, максимальный UID, который можно считать обработанным).
+    Бюджет по байтам не даёт одному проходу утонуть в письмах с крупными вложениями:
+    всё, что не влезло, заберёт следующий проход (хотя бы одно письмо скачивается всегда)."""
+    to_fetch = []
+    total = 0
+    covered = None
+    for uid in uids:
+        summary = summaries.get(uid)
+        if summary and _needs_download(summary, known_ids):
+            if to_fetch and total + summary['size'] > byte_budget:
+                break
+            to_fetch.append(uid)
+            total += summary['size']
+        covered = uid
+    return to_fetch, covered
+
+
+def _sync_mailbox(conn, partner_id, address, password, clients_by_email, own_addresses, default_stage_key, folder_rules):
+    """Инкрементально синхронизирует один почтовый ящик: скачивает только письма с UID больше
+    сохранённого водяного знака. За проход обрабатывается не больше SYNC_BATCH_SIZE самых старых
+    новых писем (чтобы уложиться в таймаут функции) — остальные заберёт следующий проход,
+    а не пропустит, как при выборке 'последних 30'. Загрузка двухфазная: сначала заголовки,
+    затем тела только тех писем, которых ещё нет в базе."""
+    imported = 0
+    created_leads = 0
+    pending_attachments = []
 
-                folder_id = _folder_for_address(cur, partner_id, from_addr)
+    imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=15)
+    try:
+        imap.login(address, password)
+        imap.select('INBOX')
+        uidvalidity = _imap_uidvalidity(imap)
 
-                cur.execute("""
-                    INSERT INTO bridge_messages (
-                        partner_id, client_id, channel, direction, sender_name,
-                        subject, body, email_message_id, email_from, email_to, mailbox,
-                        email_in_reply_to, email_references, email_cc, email_to_all, folder_id
-                    ) VALUES (%s, %s, 'email', 'in', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (email_message_id) WHERE channel = 'email' AND email_message_id IS NOT NULL AND is_duplicate = FALSE
-                    DO NOTHING
-                    RETURNING id
-                """, (
-                    partner_id, client_id, from_name or from_addr,
-                    subject, body_text, message_id, from_addr, to_addr, address,
-                    in_reply_to, references,
-                    ', '.join(cc_list) if cc_list else None,
-                    ', '.join(to_all) if to_all else None,
-                    folder_id,
-                ))
-                inserted_row = cur.fetchone()
-                if not inserted_row:
-                    # письмо уже было сохранено параллельным процессом — пропускаем
-                    known_ids.add(message_id)
-                    continue
-                msg_id = inserted_row['id']
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            state = _get_sync_state(cur, address, 'INBOX')
 
-                for filename, mime, raw_bytes in _extract_email_attachments(msg):
-                    _save_attachment(cur, msg_id, filename, mime, raw_bytes)
+        uids = _new_uids(imap, state, uidvalidity)[:SYNC_BATCH_SIZE]
+        if not uids:
+            return 0, 0
 
-                if client_id:
-                    cur.execute("""
-                        UPDATE crm_clients
-                        SET last_message_at = NOW(), unread_messages_count = unread_messages_count + 1
-                        WHERE id = %s
-                    """, (client_id,))
+        # сначала только заголовки: уже сохранённые письма отсеиваются без скачивания вложений
+        summaries = _fetch_headers(imap, uids)
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            known_ids = _known_message_ids(cur, [s['message_id'] for s in summaries.values()])
+        fetch_uids, covered_uid = _plan_body_fetch(uids, summaries, known_ids, SYNC_FETCH_BYTES)
+        # письма скачиваются и разбираются по одному, вложения уходят во временные файлы
+        records = _download_messages(imap, fetch_uids, summaries)
 
-                known_ids.add(message_id)
-                imported += 1
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            imported, created_leads = _store_parsed_messages(
+                cur, partner_id, address, 'in', records, known_ids,
+                clients_by_email, own_addresses, default_stage_key, folder_rules, pending_attachments,
+            )
 
+            # водяной знак сдвигается в той же транзакции, что и вставка писем: если вставка
+            # упала, следующий проход заново заберёт эти же UID
+            if uidvalidity is not None and covered_uid is not None:
+                _save_sync_state(cur, address, 'INBOX', uidvalidity, covered_uid)
             conn.commit()
     finally:
         try:
@@ -858,48 +1767,79 @@ def _sync_mailbox(conn, partner_id, address, password, known_ids, clients_by_ema
             pass
         imap.logout()
 
+    _flush_attachments(conn, pending_attachments)
     return imported, created_leads
 
 
-def _backfill_unlinked_emails(conn, partner_id):
+def _backfill_unlinked_emails(conn, partner_id, incremental=False):
     """Привязывает ранее сохранённые письма без client_id к клиентам, если с тех пор
-    в CRM появился клиент с совпадающим email (письмо могло прийти раньше, чем завели карточку)."""
+    в CRM появился клиент с совпадающим email (письмо могло прийти раньше, чем завели карточку).
+    Одним UPDATE ... FROM по lower(email) и одним сгруппированным пересчётом непрочитанных.
+
+    incremental=True — только пары, где письмо (updated_at) или email клиента (email_updated_at)
+    изменены после начала прошлого прохода с запасом BACKFILL_OVERLAP_SECONDS: новые письма,
+    новые клиенты и исправленные адреса. Запас подбирает строки транзакций, которые начались
+    до прошлого прохода, а закоммитились после него; обе ветки идут по индексам, а не по
+    всем непривязанным письмам. Состояние — в bridge_backfill_state."""
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT id, email FROM crm_clients WHERE partner_id = %s AND email IS NOT NULL AND email != ''", (partner_id,))
-        clients_by_email = {r['email'].lower(): r['id'] for r in cur.fetchall() if r['email']}
-        if not clients_by_email:
-            return 0
-
         cur.execute("""
-            SELECT id, email_from FROM bridge_messages
-            WHERE partner_id = %s AND channel = 'email' AND client_id IS NULL AND email_from IS NOT NULL
+            SELECT LOCALTIMESTAMP AS now,
+                   (SELECT last_run_at FROM bridge_backfill_state WHERE partner_id = %s) AS last_run_at
         """, (partner_id,))
-        unlinked = cur.fetchall()
-
-        linked_count = 0
-        touched_clients = set()
-        for row in unlinked:
-            client_id = clients_by_email.get((row['email_from'] or '').lower())
-            if not client_id:
-                continue
-            cur.execute("UPDATE bridge_messages SET client_id = %s WHERE id = %s", (client_id, row['id']))
-            touched_clients.add(client_id)
-            linked_count += 1
+        marks = cur.fetchone()
+        since = None
+        if incremental and marks['last_run_at'] is not None:
+            from datetime import timedelta
+            since = marks['last_run_at'] - timedelta(seconds=BACKFILL_OVERLAP_SECONDS)
 
-        for client_id in touched_clients:
+        cur.execute("""
+            UPDATE bridge_messages m SET client_id = c.id
+            FROM (
+                SELECT DISTINCT ON (LOWER(email)) id, LOWER(email) AS email
+                FROM crm_clients
+                WHERE partner_id = %(partner_id)s AND email IS NOT NULL AND email != ''
+                ORDER BY LOWER(email), id DESC
+            ) c
+            WHERE m.partner_id = %(partner_id)s AND m.channel = 'email' AND m.client_id IS NULL
+              AND m.email_from IS NOT NULL AND LOWER(m.email_from) = c.email
+              AND (%(since)s::timestamp IS NULL OR m.id IN (
+                  SELECT id FROM bridge_messages
+                  WHERE partner_id = %(partner_id)s AND channel = 'email' AND client_id IS NULL
+                    AND updated_at >= %(since)s
+                  UNION
+                  SELECT mm.id FROM crm_clients cc
+                  JOIN bridge_messages mm
+                      ON mm.partner_id = %(partner_id)s AND mm.channel = 'email' AND mm.client_id IS NULL
+                     AND LOWER(mm.email_from) = LOWER(cc.email)
+                  WHERE cc.partner_id = %(partner_id)s AND cc.email_updated_at >= %(since)s
+              ))
+            RETURNING m.client_id
+        """, {'partner_id': partner_id, 'since': since})
+        linked = [r['client_id'] for r in cur.fetchall()]
+
+        if linked:
             cur.execute("""
-                UPDATE crm_clients SET
+                UPDATE crm_clients c SET
                     last_message_at = NOW(),
-                    unread_messages_count = (
-                        SELECT COUNT(*) FROM bridge_messages
-                        WHERE client_id = %s AND direction = 'in' AND is_read = FALSE
-                    )
-                WHERE id = %s
-            """, (client_id, client_id))
+                    unread_messages_count = u.unread
+                FROM (
+                    SELECT t.client_id, COUNT(m.id) AS unread
+                    FROM unnest(%s::int[]) AS t(client_id)
+                    LEFT JOIN bridge_messages m
+                        ON m.client_id = t.client_id AND m.direction = 'in' AND m.is_read = FALSE
+                    GROUP BY t.client_id
+                ) u
+                WHERE c.id = u.client_id
+            """, (list(set(linked)),))
 
+        cur.execute("""
+            INSERT INTO bridge_backfill_state (partner_id, last_run_at, updated_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (partner_id) DO UPDATE SET last_run_at = EXCLUDED.last_run_at, updated_at = NOW()
+        """, (partner_id, marks['now']))
         conn.commit()
 
-    return linked_count
+    return len(linked)
 
 
 def _split_addresses(value):
@@ -947,8 +1887,7 @@ def send_email(conn, body):
         return error_response('Не настроен ни один почтовый ящик', 500)
 
     box = next((b for b in boxes if b['address'] == mailbox_address), None) or boxes[0]
-    address, password = box['address'], box['password']
-    own_addresses = {b['address'].lower() for b in boxes}
+    address = box['address']
 
     in_reply_to = None
     references = None
@@ -1013,46 +1952,179 @@ def send_email(conn, body):
 
         conn.commit()
 
-    # ---- сборка письма
-    depo_attachments = []
+    attachments, error = _resolve_outgoing_attachments(conn, attachments_in, depo_files)
+    if error:
+        return error_response(error, 400)
+
+    # письмо сохраняется в переписку и ставится в очередь одной транзакцией, затем сразу
+    # отправляется из этой же очереди; при временной ошибке SMTP оно остаётся в bridge_outbox
+    # на повтор (drain_outbox), а ответ несёт delivery_status первой попытки
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        message = _enqueue_email(
+            cur, partner_id, client_id, subject, text, address, to_list, cc_list,
+            in_reply_to, references, signature_html, attachments, _load_folder_rules(cur, partner_id),
+        )
+        conn.commit()
+    _drain_outbox(conn, OUTBOX_DRAIN_SECONDS, partner_id, [message['id']])
+    message.update(_delivery_statuses(conn, [message['id']])[message['id']])
+
+    return ok_response({'success': True, 'message': message, 'client_id': client_id})
+
+
+def send_bulk_email(conn, body):
+    """Рассылка одного письма нескольким клиентам CRM: каждому ставится в очередь отдельное
+    письмо (получатели не видят друг друга) со ссылками на одни и те же вложения, и эти же
+    письма сразу отправляются в этом запросе подряд через одну SMTP-сессию ящика (не дольше
+    OUTBOX_DRAIN_SECONDS). Что не успело уйти или упало на временной ошибке, остаётся в очереди
+    на повтор drain_outbox. Клиенты без email возвращаются в failed."""
+    partner_id = body.get('partner_id')
+    subject = (body.get('subject') or '').strip()
+    text = (body.get('body') or '').strip()
+    mailbox_address = (body.get('mailbox') or '').strip()
+    signature_id = body.get('signature_id')
+    client_ids = []
+    for raw_id in body.get('client_ids') or []:
+        cid = _parse_int(raw_id)
+        if cid and cid not in client_ids:
+            client_ids.append(cid)
+
+    if not partner_id or not text or not client_ids:
+        return error_response('partner_id, body and client_ids are required', 400)
+    if len(client_ids) > BULK_SEND_LIMIT:
+        return error_response(f'Не больше {BULK_SEND_LIMIT} получателей за один запрос', 400)
+
+    boxes = _get_mailboxes()
+    if not boxes:
+        return error_response('Не настроен ни один почтовый ящик', 500)
+    box = next((b for b in boxes if b['address'] == mailbox_address), None) or boxes[0]
+    address = box['address']
+
+    attachments, error = _resolve_outgoing_attachments(conn, body.get('attachments') or [], body.get('depo_files') or [])
+    if error:
+        return error_response(error, 400)
+
+    message_ids = []
+    failed = []
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT id, email FROM crm_clients WHERE partner_id = %s AND id = ANY(%s)", (partner_id, client_ids))
+        emails = {r['id']: (_split_addresses(r['email']) or [None])[0] for r in cur.fetchall()}
+        signature_html = ''
+        if signature_id:
+            cur.execute("SELECT html FROM bridge_signatures WHERE id = %s AND partner_id = %s", (signature_id, partner_id))
+            sig = cur.fetchone()
+            if sig:
+                signature_html = sig['html'] or ''
+        folder_rules = _load_folder_rules(cur, partner_id)
+
+        for client_id in client_ids:
+            email = emails.get(client_id)
+            if not email:
+                failed.append({'client_id': client_id, 'error': 'У клиента не указан email'})
+                continue
+            message = _enqueue_email(
+                cur, partner_id, client_id, subject, text, address, [email], [],
+                None, None, signature_html, attachments, folder_rules,
+            )
+            message_ids.append(message['id'])
+        conn.commit()
+
+    sent, undelivered, retried = _drain_outbox(conn, OUTBOX_DRAIN_SECONDS, partner_id, message_ids) if message_ids else (0, 0, 0)
+    return ok_response({
+        'success': True, 'queued': len(message_ids), 'message_ids': message_ids, 'failed': failed,
+        'sent': sent, 'undelivered': undelivered, 'pending': len(message_ids) - sent - undelivered,
+    })
+
+
+def _fetch_urls(urls):
+    """Скачивает файлы по ссылкам параллельно (до ATTACHMENT_DOWNLOAD_WORKERS одновременно):
+    {url: bytes}. Ссылки, которые не удалось скачать, в ответ не попадают."""
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+    downloaded = {}
+    with ThreadPoolExecutor(max_workers=min(ATTACHMENT_DOWNLOAD_WORKERS, len(urls))) as pool:
+        futures = {pool.submit(_fetch_url_bytes, url): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                downloaded[futures[future]] = future.result()
+            except Exception:
+                continue
+    return downloaded
+
+
+def _resolve_outgoing_attachments(conn, attachments_in, depo_files):
+    """Вложения исходящего письма в виде ссылок на хранилище: ([(name, mime, url, size), ...], None)
+    или ([], текст ошибки). Файлы из депозитария и загруженные заранее через upload_attachment
+    уже лежат в хранилище — к письму привязывается их ссылка, повторно ничего не загружается
+    (размер берётся из storage_blobs, если файл туда записан). В хранилище кладутся только
+    вложения старого формата — base64 в теле запроса."""
+    resolved = []
     for f in depo_files:
-        url = f.get('url')
-        if not url:
+        if f.get('url'):
+            resolved.append((f.get('name') or 'file', f.get('mime') or 'application/octet-stream', f['url'], None))
+
+    for att in attachments_in:
+        name = att.get('name') or 'file'
+        mime = att.get('mime') or 'application/octet-stream'
+        if att.get('url'):
+            resolved.append((name, mime, att['url'], None))
             continue
+        # Фолбэк на старый формат: файл целиком в base64 внутри тела запроса
+        data_url = att.get('data') or ''
+        raw_b64 = data_url.split(',', 1)[1] if ',' in data_url else data_url
         try:
-            raw = _fetch_url_bytes(url)
+            raw = base64.b64decode(raw_b64)
         except Exception:
             continue
         if len(raw) > MAX_ATTACH_SIZE:
-            continue
-        depo_attachments.append((f.get('name') or 'file', f.get('mime') or 'application/octet-stream', raw))
+            return [], f'Файл "{name}" превышает 25 МБ'
+        resolved.append((name, mime, _store_blob(conn, raw, name, mime, 'bridge'), len(raw)))
+
+    unknown = [url for _, _, url, size in resolved if size is None]
+    if unknown:
+        with conn.cursor() as cur:
+            cur.execute("SELECT url, size_bytes FROM storage_blobs WHERE url = ANY(%s)", (unknown,))
+            sizes = dict(cur.fetchall())
+        resolved = [(name, mime, url, size if size is not None else sizes.get(url)) for name, mime, url, size in resolved]
+    return resolved, None
+
+
+def _enqueue_email(cur, partner_id, client_id, subject, text, address, to_list, cc_list, in_reply_to, references, signature_html, attachments, folder_rules):
+    """Сохраняет исходящее письмо в переписку со статусом queued, привязывает вложения
+    по ссылкам и ставит письмо в bridge_outbox (без commit). Message-ID назначается сразу —
+    по нему ответ клиента попадёт в цепочку, даже если письмо ещё в очереди."""
+    message = _save_outgoing_message(
+        cur, partner_id, client_id, subject, text, address, to_list, cc_list,
+        make_msgid(domain=address.split('@')[-1]), in_reply_to, references,
+        _match_folder(folder_rules, to_list[0]),
+    )
+    message['attachments'] = []
+    for name, mime, url, size in attachments:
+        cur.execute("""
+            INSERT INTO bridge_attachments (message_id, file_name, mime, size_bytes, url)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING *
+        """, (message['id'], name, mime, size, url))
+        message['attachments'].append(cur.fetchone())
+    cur.execute("""
+        INSERT INTO bridge_outbox (message_id, partner_id, mailbox, signature_html)
+        VALUES (%s, %s, %s, %s)
+    """, (message['id'], partner_id, address, signature_html or None))
+    return message
 
-    decoded_attachments = []
-    for att in attachments_in:
-        name = att.get('name') or 'file'
-        mime = att.get('mime') or 'application/octet-stream'
-        url = att.get('url')
-        if url:
-            # Вложение уже загружено в хранилище отдельным запросом (upload_attachment) —
-            # так письмо с несколькими файлами не упирается в лимит размера тела запроса
-            try:
-                raw = _fetch_url_bytes(url)
-            except Exception:
-                continue
-        else:
-            # Фолбэк на старый формат: файл целиком в base64 внутри тела запроса
-            data_url = att.get('data') or ''
-            raw_b64 = data_url.split(',', 1)[1] if ',' in data_url else data_url
-            try:
-                raw = base64.b64decode(raw_b64)
-            except Exception:
-                continue
-        if len(raw) > MAX_ATTACH_SIZE:
-            return error_response(f'Файл "{name}" превышает 25 МБ', 400)
-        decoded_attachments.append((name, mime, raw))
 
-    all_attachments = decoded_attachments + depo_attachments
+def _attachment_parts(attachments):
+    """MIME-части вложений из [(name, mime, raw), ...]"""
+    parts = []
+    for name, mime, raw in attachments:
+        part = MIMEApplication(raw, Name=name)
+        part['Content-Disposition'] = f'attachment; filename="{name}"'
+        parts.append(part)
+    return parts
+
 
+def _build_email(address, subject, text, signature_html, to_list, cc_list, in_reply_to, references, attachment_parts, message_id):
+    """Собирает письмо (текст + HTML с подписью + вложения) с заранее назначенным Message-ID"""
     body_html = html_lib.escape(text).replace('\n', '<br>')
     if signature_html:
         body_html = f"{body_html}<br><br>{signature_html}"
@@ -1068,8 +2140,7 @@ def send_email(conn, body):
     alt.attach(MIMEText(html_doc, 'html', 'utf-8'))
     msg.attach(alt)
 
-    new_message_id = make_msgid(domain=address.split('@')[-1])
-    msg['Message-ID'] = new_message_id
+    msg['Message-ID'] = message_id
     msg['Date'] = formatdate(localtime=True)
     msg['Subject'] = subject or '(без темы)'
     msg['From'] = address
@@ -1083,48 +2154,225 @@ def send_email(conn, body):
     msg['MIME-Version'] = '1.0'
     msg['X-Mailer'] = 'sppi.ooo Bridge'
 
-    for name, mime, raw in all_attachments:
-        part = MIMEApplication(raw, Name=name)
-        part['Content-Disposition'] = f'attachment; filename="{name}"'
+    for part in attachment_parts:
         msg.attach(part)
+    return msg
+
+
+def _save_outgoing_message(cur, partner_id, client_id, subject, text, address, to_list, cc_list, message_id, in_reply_to, references, folder_id):
+    """Сохраняет исходящее письмо в переписку (без commit) и возвращает строку bridge_messages"""
+    cur.execute("""
+        INSERT INTO bridge_messages (
+            partner_id, client_id, channel, direction, sender_name,
+            subject, body, email_from, email_to, mailbox,
+            email_message_id, email_in_reply_to, email_references,
+            email_cc, email_to_all, folder_id, is_read, notified, delivery_status
+        ) VALUES (%s, %s, 'email', 'out', 'Менеджер', %s, %s, %s, %s, %s,
+                  %s, %s, %s, %s, %s, %s, TRUE, TRUE, 'queued')
+        RETURNING *
+    """, (
+        partner_id, client_id, subject, text, address, to_list[0], address,
+        message_id, in_reply_to, references,
+        ', '.join(cc_list) if cc_list else None,
+        ', '.join(to_list), folder_id,
+    ))
+    message = cur.fetchone()
+
+    if client_id:
+        cur.execute("UPDATE crm_clients SET last_message_at = NOW() WHERE id = %s", (client_id,))
+    return message
+
+
+# ------------------------------------------------------------------ outbox --
+
+def drain_outbox(conn, body):
+    """Отправляет письма из очереди bridge_outbox, пока они есть и не вышло OUTBOX_DRAIN_SECONDS.
+    Первую попытку доставки делает сам send_email, здесь подбираются отложенные повторы —
+    фронтенд вызывает drain_outbox фоновым таймером CRM. С partner_id разбирается только
+    очередь партнёра, без него — общая. Параллельные вызовы не мешают друг другу: письмо забирается арендой
+    (locked_until) с SKIP LOCKED."""
+    sent, failed, retried = _drain_outbox(conn, OUTBOX_DRAIN_SECONDS, _parse_int(body.get('partner_id')))
+    return ok_response({'success': True, 'sent': sent, 'failed': failed, 'retried': retried})
+
+
+def _drain_outbox(conn, seconds, partner_id=None, message_ids=None):
+    """Разбирает очередь исходящих по одному письму (только партнёра partner_id и только письма
+    message_ids, если они заданы).
+    Письмо, зависшее в sending дольше аренды (функция упала посреди отправки), забирается
+    повторно — доставка «хотя бы один раз».
+    Возвращает (отправлено, окончательно не доставлено, отложено на повтор)."""
+    deadline = time.monotonic() + seconds
+    boxes = {b['address']: b['password'] for b in _get_mailboxes()}
+    sent = failed = retried = 0
+    while time.monotonic() < deadline:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                UPDATE bridge_outbox SET
+                    status = 'sending', attempts = attempts + 1,
+                    locked_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+                WHERE id = (
+                    SELECT id FROM bridge_outbox
+                    WHERE ((status = 'pending' AND next_attempt_at <= NOW())
+                           OR (status = 'sending' AND locked_until < NOW()))
+                      AND (%s::int IS NULL OR partner_id = %s)
+                      AND (%s::int[] IS NULL OR message_id = ANY(%s))
+                    ORDER BY next_attempt_at, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+            """, (OUTBOX_DRAIN_SECONDS * 3, partner_id, partner_id, message_ids, message_ids))
+            item = cur.fetchone()
+            conn.commit()
+        if not item:
+            break
+
+        try:
+            _deliver_outbox_item(conn, item, boxes)
+        except Exception as exc:
+            transient = _smtp_transient(exc) and item['attempts'] < OUTBOX_MAX_ATTEMPTS
+            delay = _outbox_retry_delay(item['attempts'])
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE bridge_outbox SET
+                        status = %s, last_error = %s, locked_until = NULL,
+                        next_attempt_at = NOW() + make_interval(secs => %s), updated_at = NOW()
+                    WHERE id = %s
+                """, ('pending' if transient else 'failed', str(exc)[:1000], delay, item['id']))
+                if not transient:
+                    cur.execute("""
+                        UPDATE bridge_messages SET delivery_status = 'failed', delivery_error = %s WHERE id = %s
+                    """, (str(exc)[:1000], item['message_id']))
+                conn.commit()
+            if transient:
+                retried += 1
+            else:
+                failed += 1
+            continue
 
-    recipients = to_list + cc_list
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE bridge_outbox SET status = 'sent', sent_at = NOW(), locked_until = NULL, last_error = NULL, updated_at = NOW()
+                WHERE id = %s
+            """, (item['id'],))
+            cur.execute("UPDATE bridge_messages SET delivery_status = 'sent', delivery_error = NULL WHERE id = %s", (item['message_id'],))
+            conn.commit()
+        sent += 1
+    return sent, failed, retried
+
+
+def _delivery_statuses(conn, message_ids):
+    """{id письма: {'delivery_status', 'delivery_error'}} после попытки отправки"""
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT id, delivery_status, delivery_error FROM bridge_messages WHERE id = ANY(%s)", (message_ids,))
+        statuses = {r.pop('id'): r for r in cur.fetchall()}
+        conn.commit()
+    return statuses
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context) as server:
-        server.login(address, password)
-        server.sendmail(address, recipients, msg.as_string())
 
+def _deliver_outbox_item(conn, item, boxes):
+    """Собирает письмо из сохранённой строки bridge_messages и её вложений и отправляет по SMTP"""
+    password = boxes.get(item['mailbox'])
+    if password is None:
+        raise RuntimeError(f"Почтовый ящик {item['mailbox']} больше не настроен")
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        folder_id = _folder_for_address(cur, partner_id, to_list[0])
         cur.execute("""
-            INSERT INTO bridge_messages (
-                partner_id, client_id, channel, direction, sender_name,
-                subject, body, email_from, email_to, mailbox,
-                email_message_id, email_in_reply_to, email_references,
-                email_cc, email_to_all, folder_id, is_read, notified
-            ) VALUES (%s, %s, 'email', 'out', 'Менеджер', %s, %s, %s, %s, %s,
-                      %s, %s, %s, %s, %s, %s, TRUE, TRUE)
-            RETURNING *
-        """, (
-            partner_id, client_id, subject, text, address, to_list[0], address,
-            new_message_id, in_reply_to, references,
-            ', '.join(cc_list) if cc_list else None,
-            ', '.join(to_list), folder_id,
-        ))
+            SELECT subject, body, email_to_all, email_cc, email_message_id, email_in_reply_to, email_references
+            FROM bridge_messages WHERE id = %s
+        """, (item['message_id'],))
         message = cur.fetchone()
+        cur.execute("SELECT file_name, mime, url FROM bridge_attachments WHERE message_id = %s ORDER BY id", (item['message_id'],))
+        attachment_rows = cur.fetchall()
+        conn.commit()
+    if not message:
+        raise RuntimeError('Письмо удалено из переписки')
+
+    downloaded = _fetch_urls([a['url'] for a in attachment_rows])
+    missing = [a['file_name'] for a in attachment_rows if a['url'] not in downloaded]
+    if missing:
+        raise ConnectionError(f"Не удалось скачать вложения: {', '.join(missing)}")
+
+    to_list = _split_addresses(message['email_to_all'])
+    cc_list = _split_addresses(message['email_cc'])
+    msg = _build_email(
+        item['mailbox'], message['subject'], message['body'] or '', item['signature_html'],
+        to_list, cc_list, message['email_in_reply_to'], message['email_references'],
+        _attachment_parts([(a['file_name'], a['mime'], downloaded[a['url']]) for a in attachment_rows]),
+        message['email_message_id'],
+    )
+    _smtp_send(item['mailbox'], password, to_list + cc_list, msg.as_string())
+
+
+def _outbox_retry_delay(attempts):
+    """Пауза перед повтором после attempts неудачных попыток: OUTBOX_RETRY_SECONDS, дальше вдвое больше, не больше часа"""
+    return min(OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1), 3600)
+
+
+def _smtp_transient(exc):
+    """Временная ли ошибка доставки: коды 4xx, обрыв соединения, таймаут, недоступное хранилище.
+    Постоянные (5xx — неверный адрес, отказ в авторизации) повторять бесполезно."""
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPException):
+        return False
+    return isinstance(exc, OSError)
+
+
+_smtp_sessions = {}  # адрес ящика -> {'server', 'password', 'used_at', 'lock'}
+_smtp_sessions_lock = threading.Lock()
+
+
+def _smtp_send(address, password, recipients, message):
+    """Отправляет письмо через SMTP-сессию ящика, которая живёт между вызовами в прогретом
+    контейнере: TLS-рукопожатие и логин делаются один раз, а не на каждое письмо. Сессия,
+    простоявшая дольше SMTP_IDLE_SECONDS, проверяется NOOP и при обрыве открывается заново.
+    После ошибки отправки сессия закрывается (следующее письмо откроет новую), а исключение
+    уходит вызывающему: повторять ли письмо, решает очередь (_drain_outbox)."""
+    with _smtp_sessions_lock:
+        session = _smtp_sessions.setdefault(address, {'server': None, 'password': None, 'used_at': 0.0, 'lock': threading.Lock()})
+    with session['lock']:
+        server = session['server']
+        if server is not None and (session['password'] != password or not _smtp_alive(server, session['used_at'])):
+            _smtp_close(server)
+            server = session['server'] = None
+        if server is None:
+            server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ssl.create_default_context(), timeout=30)
+            try:
+                server.login(address, password)
+            except Exception:
+                _smtp_close(server)
+                raise
+            session['server'], session['password'] = server, password
+        try:
+            server.sendmail(address, recipients, message)
+        except Exception:
+            _smtp_close(server)
+            session['server'] = None
+            raise
+        session['used_at'] = time.monotonic()
 
-        for name, mime, raw in all_attachments:
-            _save_attachment(cur, message['id'], name, mime, raw)
 
-        if client_id:
-            cur.execute("UPDATE crm_clients SET last_message_at = NOW() WHERE id = %s", (client_id,))
-        conn.commit()
+def _smtp_alive(server, used_at):
+    if time.monotonic() - used_at < SMTP_IDLE_SECONDS:
+        return True
+    try:
+        return server.noop()[0] == 250
+    except Exception:
+        return False
 
-        cur.execute("SELECT * FROM bridge_attachments WHERE message_id = %s", (message['id'],))
-        message['attachments'] = cur.fetchall()
 
-    return ok_response({'success': True, 'message': message, 'client_id': client_id})
+def _smtp_close(server):
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
 
 
 # ------------------------------------------------------------- import_range --
@@ -1160,38 +2408,65 @@ def _find_folder(imap, keywords):
     return None
 
 
+IMPORT_JOB_COLUMNS = """
+    id, partner_id, mailbox, folder, real_folder, date_from, date_to,
+    cursor_pos, total, imported, status, error, error_kind, attempts, created_at, updated_at
+"""
+
+
+class ImportJobFailed(RuntimeError):
+    """Задание импорта продолжать бессмысленно (ящик убран из настроек, папку пересоздали)"""
+
+
 def import_range(conn, body):
     """Служебный метод: загружает исторические письма (входящие или отправленные) за указанный
-    период из конкретного почтового ящика — постранично (offset/limit), чтобы не упереться
-    в таймаут функции. Вызывается несколько раз подряд, пока has_more == True."""
+    период из конкретного почтового ящика. Первый вызов заводит задание импорта со списком UID
+    писем за период, каждый следующий (с job_id или с теми же mailbox/folder/датами) продолжает
+    с сохранённого курсора крупными пачками UID, пока не уложится в IMPORT_STEP_SECONDS.
+    Вызывается повторно, пока has_more == True. Прежние клиенты, листавшие импорт через
+    offset/next_offset, продолжают работать: offset в запросе не нужен (позицию хранит задание),
+    а в ответе, как и раньше, есть offset и next_offset — позиция до и после шага.
+    Задание, остановленное после IMPORT_MAX_ATTEMPTS временных сбоев подряд, повторный вызов
+    продолжает с того же места."""
     partner_id = body.get('partner_id')
+    job_id = body.get('job_id')
+
+    if job_id:
+        if not partner_id:
+            return error_response('partner_id is required', 400)
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT * FROM bridge_import_jobs WHERE id = %s AND partner_id = %s", (job_id, partner_id))
+            job = cur.fetchone()
+        if not job:
+            return error_response('Задание импорта не найдено', 404)
+        return _continue_import_job(conn, _reopen_import_job(conn, job))
+
     mailbox_address = (body.get('mailbox') or '').strip()
     date_from = body.get('date_from')  # 'YYYY-MM-DD'
     date_to = body.get('date_to')      # 'YYYY-MM-DD' включительно
     folder = body.get('folder', 'INBOX')  # 'INBOX' | 'SENT' (логическое имя, реальное определяется автоматически)
-    offset = int(body.get('offset', 0))
-    limit = min(int(body.get('limit', 10)), 20)
 
     if not partner_id or not mailbox_address or not date_from or not date_to:
         return error_response('partner_id, mailbox, date_from, date_to are required', 400)
     if folder not in ('INBOX', 'SENT'):
         return error_response("folder must be 'INBOX' or 'SENT'", 400)
 
-    boxes = _get_mailboxes()
-    box = next((b for b in boxes if b['address'] == mailbox_address), None)
+    box = next((b for b in _get_mailboxes() if b['address'] == mailbox_address), None)
     if not box:
         return error_response('Указанный почтовый ящик не настроен', 400)
-    own_addresses = {b['address'].lower() for b in boxes}
 
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        # повторный запуск того же импорта продолжает незавершённое задание, а не начинает заново
         cur.execute("""
-            SELECT email_message_id FROM bridge_messages
-            WHERE channel = 'email' AND email_message_id IS NOT NULL AND is_duplicate = FALSE
-        """)
-        known_ids = {r['email_message_id'] for r in cur.fetchall()}
-        cur.execute("SELECT id, email FROM crm_clients WHERE partner_id = %s AND email IS NOT NULL AND email != ''", (partner_id,))
-        clients_by_email = {r['email'].lower(): r['id'] for r in cur.fetchall() if r['email']}
-        default_stage_key = _get_default_stage_key(cur, partner_id)
+            SELECT * FROM bridge_import_jobs
+            WHERE partner_id = %s AND mailbox = %s AND folder = %s
+              AND date_from = %s AND date_to = %s
+              AND (status = 'running' OR (status = 'error' AND error_kind = 'transient'))
+            ORDER BY id DESC LIMIT 1
+        """, (partner_id, mailbox_address, folder, date_from, date_to))
+        job = cur.fetchone()
+    if job:
+        return _continue_import_job(conn, _reopen_import_job(conn, job))
 
     imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=20)
     try:
@@ -1201,114 +2476,290 @@ def import_range(conn, body):
         status, _ = imap.select(f'"{real_folder}"', readonly=True)
         if status != 'OK':
             return error_response(f'Папка "{real_folder}" недоступна', 502)
+        uidvalidity = _imap_uidvalidity(imap)
 
         since = _imap_date(date_from)
         before = _imap_date_plus_one(date_to)
-        status, data = imap.search(None, f'(SINCE "{since}" BEFORE "{before}")')
-        if status != 'OK':
+        try:
+            uids = _uid_search(imap, f'(SINCE "{since}" BEFORE "{before}")')
+        except RuntimeError:
             return error_response('Ошибка поиска писем', 502)
-
-        ids = data[0].split()
-        total = len(ids)
-        page_ids = ids[offset:offset + limit]
-
-        imported = 0
-        if page_ids:
-            id_set = b','.join(page_ids)
-            status, msg_data = imap.fetch(id_set, '(RFC822)')
-            if status == 'OK' and msg_data:
-                raw_messages = [part[1] for part in msg_data if isinstance(part, tuple)]
-                direction = 'in' if folder == 'INBOX' else 'out'
-
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    for raw in raw_messages:
-                        msg = email_lib.message_from_bytes(raw)
-
-                        subject = _decode_mime_words(msg.get('Subject', ''))
-                        body_text = _get_email_body(msg)[:20000]
-
-                        message_id = (msg.get('Message-ID') or '').strip()
-                        if not message_id:
-                            fp_addr = parseaddr(msg.get('From' if direction == 'in' else 'To', ''))[1].lower()
-                            message_id = _synthetic_message_id(fp_addr, subject, msg.get('Date', ''), body_text)
-                        if message_id in known_ids:
-                            continue
-
-                        if direction == 'in':
-                            from_name, from_addr = parseaddr(msg.get('From', ''))
-                            from_name = _decode_mime_words(from_name) or from_addr
-                            from_addr = (from_addr or '').lower()
-                            to_addr = parseaddr(msg.get('To', ''))[1]
-                            counterpart_addr, counterpart_name = from_addr, from_name
-                            sender_name = from_name or from_addr
-                        else:
-                            _, to_addr_raw = parseaddr(msg.get('To', ''))
-                            to_addr = (to_addr_raw or '').lower()
-                            from_addr = mailbox_address
-                            counterpart_addr, counterpart_name = to_addr, None
-                            sender_name = 'Менеджер'
-
-                        client_id = _find_client_or_create(cur, partner_id, clients_by_email, counterpart_addr, counterpart_name, own_addresses, default_stage_key)
-
-                        cur.execute("""
-                            INSERT INTO bridge_messages (
-                                partner_id, client_id, channel, direction, sender_name,
-                                subject, body, email_message_id, email_from, email_to, mailbox
-                            ) VALUES (%s, %s, 'email', %s, %s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT (email_message_id) WHERE channel = 'email' AND email_message_id IS NOT NULL AND is_duplicate = FALSE
-                            DO NOTHING
-                            RETURNING id
-                        """, (
-                            partner_id, client_id, direction, sender_name,
-                            subject, body_text, message_id, from_addr, to_addr, mailbox_address,
-                        ))
-                        inserted_row = cur.fetchone()
-                        if not inserted_row:
-                            known_ids.add(message_id)
-                            continue
-                        msg_id = inserted_row['id']
-
-                        for filename, mime, raw_bytes in _extract_email_attachments(msg):
-                            _save_attachment(cur, msg_id, filename, mime, raw_bytes)
-
-                        if client_id and direction == 'in':
-                            cur.execute("""
-                                UPDATE crm_clients
-                                SET last_message_at = NOW(), unread_messages_count = unread_messages_count + 1
-                                WHERE id = %s
-                            """, (client_id,))
-                        elif client_id:
-                            cur.execute("UPDATE crm_clients SET last_message_at = NOW() WHERE id = %s", (client_id,))
-
-                        if message_id:
-                            known_ids.add(message_id)
-                        imported += 1
-
-                    conn.commit()
     finally:
         try:
             imap.logout()
         except Exception:
             pass
 
-    next_offset = offset + limit
-    has_more = next_offset < total
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""
+            INSERT INTO bridge_import_jobs (
+                partner_id, mailbox, folder, real_folder, date_from, date_to, uidvalidity, uids, total
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING *
+        """, (partner_id, mailbox_address, folder, real_folder, date_from, date_to, uidvalidity, uids, len(uids)))
+        job = cur.fetchone()
+        conn.commit()
+
+    return _continue_import_job(conn, job)
 
+
+def get_import_job(conn, params):
+    """Прогресс задания импорта исторической почты"""
+    partner_id = _parse_int(params.get('partner_id'))
+    job_id = _parse_int(params.get('job_id'))
+    if partner_id is None or job_id is None:
+        return error_response('Missing partner_id or job_id', 400)
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"SELECT {IMPORT_JOB_COLUMNS} FROM bridge_import_jobs WHERE id = %s AND partner_id = %s", (job_id, partner_id))
+        job = cur.fetchone()
+    if not job:
+        return error_response('Задание импорта не найдено', 404)
+    return ok_response({'job': job})
+
+
+def _reopen_import_job(conn, job):
+    """Задание, остановленное временными сбоями, снова переводится в running со сброшенным счётчиком"""
+    if job['status'] != 'error' or job['error_kind'] != 'transient':
+        return job
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""
+            UPDATE bridge_import_jobs SET status = 'running', attempts = 0, locked_until = NULL, updated_at = NOW()
+            WHERE id = %s AND status = 'error' AND error_kind = 'transient'
+            RETURNING *
+        """, (job['id'],))
+        reopened = cur.fetchone()
+        conn.commit()
+    return reopened or job
+
+
+def _continue_import_job(conn, job):
+    """Выполняет очередной шаг задания импорта и возвращает его прогресс"""
+    imported = 0
+    stepped = False
+    offset = job['cursor_pos']
+    if job['status'] == 'running':
+        # захватываем задание: параллельный вызов с тем же job_id не будет качать те же письма
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                UPDATE bridge_import_jobs
+                SET locked_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+                WHERE id = %s AND status = 'running' AND (locked_until IS NULL OR locked_until < NOW())
+                RETURNING *
+            """, (IMPORT_STEP_SECONDS * 2, job['id']))
+            locked = cur.fetchone()
+            conn.commit()
+        if locked:
+            job = locked
+            stepped = True
+            try:
+                imported = _run_import_job(conn, job)
+            except Exception as exc:
+                # обрыв IMAP, таймаут, сбой БД — задание остаётся running и повторяется следующим
+                # вызовом после паузы; сломанным оно считается только после IMPORT_MAX_ATTEMPTS
+                # сбоев подряд (счётчик сбрасывает каждая сохранённая пачка) или ImportJobFailed
+                conn.rollback()
+                fatal = isinstance(exc, ImportJobFailed)
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE bridge_import_jobs SET
+                            attempts = attempts + 1, error = %s, error_kind = %s,
+                            status = CASE WHEN %s OR attempts + 1 >= %s THEN 'error' ELSE status END,
+                            locked_until = NOW() + make_interval(secs => %s * (attempts + 1)), updated_at = NOW()
+                        WHERE id = %s
+                    """, (str(exc), 'fatal' if fatal else 'transient', fatal, IMPORT_MAX_ATTEMPTS, IMPORT_RETRY_SECONDS, job['id']))
+                    conn.commit()
+            else:
+                with conn.cursor() as cur:
+                    cur.execute("UPDATE bridge_import_jobs SET locked_until = NULL WHERE id = %s", (job['id'],))
+                    conn.commit()
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"SELECT {IMPORT_JOB_COLUMNS} FROM bridge_import_jobs WHERE id = %s", (job['id'],))
+        job = cur.fetchone()
+
+    has_more = job['status'] == 'running'
     result = {
-        'success': True,
-        'folder': folder,
+        'success': job['status'] != 'error',
+        'job_id': job['id'],
+        'job': job,
+        'folder': job['folder'],
         'imported': imported,
-        'total': total,
+        'total': job['total'],
         'offset': offset,
-        'next_offset': next_offset,
+        'next_offset': job['cursor_pos'],
         'has_more': has_more,
     }
-    if not has_more:
-        result['linked'] = _backfill_unlinked_emails(conn, partner_id)
-
+    if job['status'] == 'error':
+        result['error'] = job['error']
+    elif job['status'] == 'running' and job['error']:
+        result['retry_error'] = job['error']
+    if stepped and job['status'] == 'done':
+        result['linked'] = _backfill_unlinked_emails(conn, job['partner_id'])
     return ok_response(result)
 
 
+def _run_import_job(conn, job):
+    """Импортирует письма задания с курсора пачками по IMPORT_CHUNK_SIZE UID (заголовки одной
+    командой UID FETCH по диапазонам, тела — только новых писем), сохраняя курсор после каждой
+    пачки. Останавливается, когда список закончился или вышло время шага."""
+    deadline = time.monotonic() + IMPORT_STEP_SECONDS
+    boxes = _get_mailboxes()
+    box = next((b for b in boxes if b['address'] == job['mailbox']), None)
+    if not box:
+        raise ImportJobFailed('Почтовый ящик задания больше не настроен')
+    own_addresses = {b['address'].lower() for b in boxes}
+    direction = 'in' if job['folder'] == 'INBOX' else 'out'
+    partner_id = job['partner_id']
+    uids = list(job['uids'] or [])
+    cursor_pos = job['cursor_pos']
+    if cursor_pos >= len(uids):
+        with conn.cursor() as cur:
+            cur.execute("UPDATE bridge_import_jobs SET status = 'done', updated_at = NOW() WHERE id = %s", (job['id'],))
+            conn.commit()
+        return 0
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT id, email FROM crm_clients WHERE partner_id = %s AND email IS NOT NULL AND email != ''", (partner_id,))
+        clients_by_email = {r['email'].lower(): r['id'] for r in cur.fetchall() if r['email']}
+        default_stage_key = _get_default_stage_key(cur, partner_id)
+        folder_rules = _load_folder_rules(cur, partner_id)
+
+    imported = 0
+    imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=20)
+    try:
+        imap.login(box['address'], box['password'])
+        status, _ = imap.select(f'"{job["real_folder"]}"', readonly=True)
+        if status != 'OK':
+            raise RuntimeError(f'Папка "{job["real_folder"]}" недоступна')
+        if job['uidvalidity'] is not None and _imap_uidvalidity(imap) != job['uidvalidity']:
+            raise ImportJobFailed('Папка на сервере была пересоздана (сменился UIDVALIDITY), запустите импорт заново')
+
+        while cursor_pos < len(uids) and time.monotonic() < deadline:
+            chunk = uids[cursor_pos:cursor_pos + IMPORT_CHUNK_SIZE]
+            summaries = _fetch_headers(imap, chunk)
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                known_ids = _known_message_ids(cur, [s['message_id'] for s in summaries.values()])
+            fetch_uids, covered_uid = _plan_body_fetch(chunk, summaries, known_ids, IMPORT_FETCH_BYTES)
+            records = _download_messages(imap, fetch_uids, summaries, peek=True)
+
+            pending_attachments = []
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                chunk_imported, _ = _store_parsed_messages(
+                    cur, partner_id, job['mailbox'], direction, records,
+                    known_ids, clients_by_email, own_addresses, default_stage_key, folder_rules, pending_attachments,
+                )
+                imported += chunk_imported
+                cursor_pos += chunk.index(covered_uid) + 1
+                done = cursor_pos >= len(uids)
+                cur.execute("""
+                    UPDATE bridge_import_jobs SET
+                        cursor_pos = %s, imported = imported + %s, status = %s, attempts = 0, error = NULL, error_kind = NULL,
+                        locked_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+                    WHERE id = %s
+                """, (cursor_pos, chunk_imported, 'done' if done else 'running', IMPORT_STEP_SECONDS * 2, job['id']))
+                conn.commit()
+            _flush_attachments(conn, pending_attachments)
+    finally:
+        try:
+            imap.logout()
+        except Exception:
+            pass
+
+    return imported
+
+
+def _store_parsed_messages(cur, partner_id, mailbox_address, direction, records, known_ids, clients_by_email, own_addresses, default_stage_key, folder_rules, pending_attachments):
+    """Сохраняет пачку разобранных писем (см. _parse_message) — входящих из синхронизации
+    и импорта или отправленных из импорта — без commit: уже известные письма отсеиваются,
+    лиды для неизвестных отправителей создаются одним запросом (_create_leads), письма
+    вставляются одним INSERT, счётчики клиентов обновляются одним UPDATE. Письма раскладываются
+    по папкам по правилам автосортировки, вложения откладываются в pending_attachments.
+    Возвращает (добавлено писем, создано лидов)."""
+    # письма без Message-ID (частые автоматические рассылки) получают устойчивый отпечаток,
+    # иначе они заново засчитывались бы как новые на каждой проверке почты
+    synthetic = []
+    for record in records:
+        if not record['message_id']:
+            fp_addr = record['from_addr'] if direction == 'in' else record['to_addr'].lower()
+            record['message_id'] = _synthetic_message_id(fp_addr, record['subject'], record['date'], record['body_text'])
+            synthetic.append(record['message_id'])
+    if synthetic:
+        known_ids |= _known_message_ids(cur, synthetic)
+
+    fresh = []
+    senders = {}
+    for record in records:
+        if record['message_id'] in known_ids:
+            _close_attachments(record['attachments'])
+            continue
+        known_ids.add(record['message_id'])
+        if direction == 'in':
+            counterpart_addr, counterpart_name = record['from_addr'], record['from_name']
+        else:
+            counterpart_addr, counterpart_name = record['to_addr'].lower(), None
+        record['counterpart'] = counterpart_addr
+        if counterpart_addr and counterpart_addr not in clients_by_email and counterpart_addr not in own_addresses:
+            senders.setdefault(counterpart_addr, counterpart_name)
+        fresh.append(record)
+    if not fresh:
+        return 0, 0
+
+    created_leads = _create_leads(cur, partner_id, senders, clients_by_email, default_stage_key)
+
+    rows = []
+    for record in fresh:
+        record['client_id'] = clients_by_email.get(record['counterpart']) if record['counterpart'] else None
+        if direction == 'in':
+            sender_name = record['from_name'] or record['from_addr']
+            from_addr, to_addr = record['from_addr'], record['to_addr']
+        else:
+            sender_name = 'Менеджер'
+            from_addr, to_addr = mailbox_address, record['to_addr'].lower()
+        cc_list = _split_addresses(record['cc'])
+        to_all = _split_addresses(record['to_all'])
+        rows.append((
+            partner_id, record['client_id'], direction, sender_name,
+            record['subject'], record['body_text'], record['message_id'], from_addr, to_addr, mailbox_address,
+            record['in_reply_to'], record['references'],
+            ', '.join(cc_list) if cc_list else None,
+            ', '.join(to_all) if to_all else None,
+            _match_folder(folder_rules, record['counterpart']),
+        ))
+    inserted = execute_values(cur, """
+        INSERT INTO bridge_messages (
+            partner_id, client_id, channel, direction, sender_name,
+            subject, body, email_message_id, email_from, email_to, mailbox,
+            email_in_reply_to, email_references, email_cc, email_to_all, folder_id
+        ) VALUES %s
+        ON CONFLICT (email_message_id) WHERE channel = 'email' AND email_message_id IS NOT NULL AND is_duplicate = FALSE
+        DO NOTHING
+        RETURNING id, email_message_id
+    """, rows, template="(%s, %s, 'email', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", page_size=len(rows), fetch=True)
+    saved = {r['email_message_id']: r['id'] for r in inserted}
+
+    unread = {}
+    for record in fresh:
+        msg_id = saved.get(record['message_id'])
+        if not msg_id:
+            # письмо уже сохранено параллельным процессом — пропускаем
+            _close_attachments(record['attachments'])
+            continue
+        for filename, mime, spool, size, digest in record['attachments']:
+            _queue_attachment(pending_attachments, msg_id, filename, mime, spool, size, digest)
+        if record['client_id']:
+            unread[record['client_id']] = unread.get(record['client_id'], 0) + (1 if direction == 'in' else 0)
+
+    if unread:
+        execute_values(cur, """
+            UPDATE crm_clients c SET
+                last_message_at = NOW(),
+                unread_messages_count = c.unread_messages_count + v.unread
+            FROM (VALUES %s) AS v(id, unread)
+            WHERE c.id = v.id
+        """, sorted(unread.items()))
+    return len(saved), created_leads
+
+
 # ---------------------------------------------------------------- telegram --
 
 def send_telegram_raw(bot_token, chat_id, text):
@@ -1355,46 +2806,114 @@ def send_telegram(conn, body):
     return ok_response({'success': True, 'message': message})
 
 
-def handle_telegram_webhook(conn, update):
-    """Принимает апдейт от Telegram-бота: сохраняет входящее сообщение и привязывает к клиенту
-    по chat_id или username (клиент должен быть предварительно создан в CRM с указанным telegram_username)."""
-    message = update.get('message') or update.get('edited_message')
-    if not message:
-        return ok_response({'ok': True})
+def handle_telegram_webhook(conn, body):
+    """Принимает апдейты от Telegram-бота: сохраняет входящие сообщения и привязывает к клиенту
+    по chat_id или username (клиент должен быть предварительно создан в CRM с указанным telegram_username).
+    Кроме одиночного апдейта webhook принимает пачку в формате ответа getUpdates
+    ({"ok": true, "result": [...]}) или просто список апдейтов — так накопившуюся очередь можно
+    залить одним запросом: клиенты находятся через кэш (_resolve_telegram_chats), сообщения
+    вставляются одним INSERT, счётчики непрочитанных обновляются одним UPDATE."""
+    if isinstance(body, list):
+        updates = body
+    elif isinstance(body.get('result'), list):
+        updates = body['result']
+    else:
+        updates = [body]
 
-    chat = message.get('chat', {})
-    chat_id = str(chat.get('id', ''))
-    username = chat.get('username', '')
-    text = message.get('text', '')
-    sender_name = message.get('from', {}).get('first_name', 'Клиент')
+    incoming = []
+    for update in updates:
+        message = update.get('message') or update.get('edited_message')
+        if not message:
+            continue
+        chat = message.get('chat', {})
+        incoming.append({
+            'chat_id': str(chat.get('id', '')),
+            'username': chat.get('username', ''),
+            'text': message.get('text', ''),
+            'sender_name': message.get('from', {}).get('first_name', 'Клиент'),
+        })
+    if not incoming:
+        return ok_response({'ok': True})
 
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT id, partner_id FROM crm_clients WHERE telegram_chat_id = %s", (chat_id,))
-        client = cur.fetchone()
+        links = _resolve_telegram_chats(cur, {(m['chat_id'], m['username']) for m in incoming})
+
+        rows = []
+        unread = {}
+        for m in incoming:
+            client_id, partner_id = links.get((m['chat_id'], m['username'])) or (None, None)
+            m['client_id'] = client_id
+            rows.append((partner_id, client_id, m['sender_name'], m['text'], m['chat_id'], m['username']))
+            if client_id:
+                unread[client_id] = unread.get(client_id, 0) + 1
+
+        execute_values(cur, """
+            INSERT INTO bridge_messages (partner_id, client_id, channel, direction, sender_name, body, telegram_chat_id, telegram_username)
+            VALUES %s
+        """, rows, template="(%s, %s, 'telegram', 'in', %s, %s, %s, %s)")
 
-        if not client and username:
-            cur.execute("SELECT id, partner_id FROM crm_clients WHERE telegram_username = %s", (username,))
-            client = cur.fetchone()
-            if client:
-                cur.execute("UPDATE crm_clients SET telegram_chat_id = %s WHERE id = %s", (chat_id, client['id']))
+        if unread:
+            execute_values(cur, """
+                UPDATE crm_clients c SET last_message_at = NOW(), unread_messages_count = c.unread_messages_count + v.n
+                FROM (VALUES %s) AS v(id, n)
+                WHERE c.id = v.id
+            """, sorted(unread.items()))
 
-        client_id = client['id'] if client else None
-        partner_id = client['partner_id'] if client else None
+        conn.commit()
 
-        cur.execute("""
-            INSERT INTO bridge_messages (partner_id, client_id, channel, direction, sender_name, body, telegram_chat_id, telegram_username)
-            VALUES (%s, %s, 'telegram', 'in', %s, %s, %s, %s)
-        """, (partner_id, client_id, sender_name, text, chat_id, username))
+    if len(updates) == 1:
+        return ok_response({'ok': True, 'client_id': incoming[0]['client_id']})
+    return ok_response({'ok': True, 'saved': len(rows)})
 
-        if client_id:
-            cur.execute("""
-                UPDATE crm_clients SET last_message_at = NOW(), unread_messages_count = unread_messages_count + 1
-                WHERE id = %s
-            """, (client_id,))
 
-        conn.commit()
+_telegram_chats = {'version': None, 'links': {}}  # (chat_id, username) -> (client_id, partner_id) | None
 
-    return ok_response({'ok': True, 'client_id': client_id})
+
+def _resolve_telegram_chats(cur, chats):
+    """Клиенты CRM для Telegram-чатов: {(chat_id, username): (client_id, partner_id) или None}.
+    Ответ кэшируется в памяти контейнера, в том числе «чат ни к кому не привязан». Кэш живёт,
+    пока не изменилась версия привязок (telegram_link_versions, её увеличивает триггер на любое
+    изменение telegram_chat_id / telegram_username), так что прогретый контейнер тратит на пачку
+    апдейтов один запрос версии. Промахи ищутся одним запросом сразу по chat_id и username;
+    чату, найденному по username, как и раньше, прописывается telegram_chat_id."""
+    cur.execute("SELECT version FROM telegram_link_versions WHERE scope = 'crm_clients'")
+    row = cur.fetchone()
+    version = row['version'] if row else None
+    if version is None or version != _telegram_chats['version']:
+        _telegram_chats['version'] = version
+        _telegram_chats['links'] = {}
+    cache = _telegram_chats['links']
+
+    missing = [key for key in chats if key not in cache]
+    if missing:
+        cur.execute("""
+            SELECT id, partner_id, telegram_chat_id, telegram_username FROM crm_clients
+            WHERE telegram_chat_id = ANY(%s) OR telegram_username = ANY(%s)
+            ORDER BY id
+        """, (list({chat_id for chat_id, _ in missing}), list({username for _, username in missing if username})))
+        by_chat, by_username = {}, {}
+        for r in cur.fetchall():
+            if r['telegram_chat_id']:
+                by_chat.setdefault(r['telegram_chat_id'], r)
+            if r['telegram_username']:
+                by_username.setdefault(r['telegram_username'], r)
+
+        relink = {}
+        for chat_id, username in missing:
+            client = by_chat.get(chat_id)
+            if not client and username:
+                client = by_username.get(username)
+                if client:
+                    relink[client['id']] = chat_id
+            cache[(chat_id, username)] = (client['id'], client['partner_id']) if client else None
+        if relink:
+            execute_values(cur, """
+                UPDATE crm_clients c SET telegram_chat_id = v.chat_id
+                FROM (VALUES %s) AS v(id, chat_id)
+                WHERE c.id = v.id
+            """, sorted(relink.items()))
+
+    return {key: cache[key] for key in chats}
 
 
 def register_telegram_webhook(body):
@@ -1409,7 +2928,9 @@ def register_telegram_webhook(body):
 
     webhook_url = f"{target_url}?mode=telegram_webhook"
     api_url = f"https://api.telegram.org/bot{bot_token}/setWebhook"
-    data = urllib.parse.urlencode({'url': webhook_url}).encode('utf-8')
+    # max_connections ограничивает, сколько запросов Telegram шлёт параллельно, когда
+    # доставляет накопившуюся очередь апдейтов, — иначе каждый открывает своё подключение к БД
+    data = urllib.parse.urlencode({'url': webhook_url, 'max_connections': TELEGRAM_WEBHOOK_MAX_CONNECTIONS}).encode('utf-8')
     req = urllib.request.Request(api_url, data=data, method='POST')
     with urllib.request.urlopen(req, timeout=15) as resp:
         result = json.loads(resp.read().decode('utf-8'))
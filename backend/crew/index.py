@@ -4,7 +4,6 @@ import os
 import hashlib
 import secrets
 import base64
-import uuid
 from datetime import datetime, timedelta
 
 import psycopg2
@@ -446,7 +445,23 @@ def do_upload_avatar(conn, me, body):
     if len(raw) > 6 * 1024 * 1024:
         return err('Файл слишком большой (макс 6 МБ)', 400)
 
-    key = f"crew/avatars/{uuid.uuid4().hex}.{ext}"
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        url = store_avatar(cur, raw, ext, content_type)
+        cur.execute("UPDATE crew_members SET avatar_url = %s WHERE id = %s RETURNING *", (url, target_id))
+        member = cur.fetchone()
+        conn.commit()
+    return ok({'member': member_public(member), 'url': url})
+
+
+def store_avatar(cur, raw, ext, content_type):
+    """Кладёт фото в S3 под ключом crew/avatars/sha256.расширение; та же фотография
+    повторно не загружается."""
+    digest = hashlib.sha256(raw).hexdigest()
+    key = f"crew/avatars/{digest}.{ext}"
+    cur.execute("SELECT url FROM storage_blobs WHERE s3_key = %s", (key,))
+    blob = cur.fetchone()
+    if blob:
+        return blob['url']
     s3 = boto3.client(
         's3',
         endpoint_url='https://bucket.poehali.dev',
@@ -455,12 +470,12 @@ def do_upload_avatar(conn, me, body):
     )
     s3.put_object(Bucket='files', Key=key, Body=raw, ContentType=content_type)
     url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
-
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("UPDATE crew_members SET avatar_url = %s WHERE id = %s RETURNING *", (url, target_id))
-        member = cur.fetchone()
-        conn.commit()
-    return ok({'member': member_public(member), 'url': url})
+    cur.execute("""
+        INSERT INTO storage_blobs (sha256, s3_key, url, size_bytes, mime)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (s3_key) DO NOTHING
+    """, (digest, key, url, len(raw), content_type))
+    return url
 
 
 def do_logout(conn, token):
@@ -5,7 +5,6 @@ import hashlib
 import string
 import random
 import base64
-import uuid
 from datetime import datetime
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -1274,6 +1273,32 @@ def delete_document(conn, partner_id, document_id):
 MAX_DOC_SIZE = 30 * 1024 * 1024
 
 
+def _store_blob(cur, raw, name, mime, prefix):
+    """Загружает файл в S3 под ключом prefix/sha256.расширение; уже загруженный объект
+    (тот же договор в другой сделке) повторно не загружается."""
+    digest = hashlib.sha256(raw).hexdigest()
+    ext = name.rsplit('.', 1)[-1].lower()[:8] if '.' in name else ''
+    key = f"{prefix}/{digest}{('.' + ext) if ext else ''}"
+    cur.execute("SELECT url FROM storage_blobs WHERE s3_key = %s", (key,))
+    row = cur.fetchone()
+    if row:
+        return row['url']
+    s3 = boto3.client(
+        's3',
+        endpoint_url='https://bucket.poehali.dev',
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+    )
+    s3.put_object(Bucket='files', Key=key, Body=raw, ContentType=mime)
+    url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
+    cur.execute("""
+        INSERT INTO storage_blobs (sha256, s3_key, url, size_bytes, mime)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (s3_key) DO NOTHING
+    """, (digest, key, url, len(raw), mime))
+    return url
+
+
 def upload_document(conn, partner_id, body):
     """Загружает файл (base64) в S3, создаёт запись в депозитарии (папка сделки создаётся
     автоматически по юр.названию клиента в 'Галактический реестр') и прикрепляет к сделке."""
@@ -1297,16 +1322,7 @@ def upload_document(conn, partner_id, body):
         if folder_id is None:
             return error_response('Client not found', 404)
 
-        ext = name.rsplit('.', 1)[-1].lower()[:8] if '.' in name else ''
-        key = f"depository/{uuid.uuid4().hex}{('.' + ext) if ext else ''}"
-        s3 = boto3.client(
-            's3',
-            endpoint_url='https://bucket.poehali.dev',
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
-        )
-        s3.put_object(Bucket='files', Key=key, Body=raw, ContentType=mime)
-        url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
+        url = _store_blob(cur, raw, name, mime, prefix='depository')
 
         cur.execute("""
             INSERT INTO depo_files (folder_id, name, url, mime, size_bytes, is_public)
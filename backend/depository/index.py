@@ -2,7 +2,7 @@
 import json
 import os
 import base64
-import uuid
+import hashlib
 import re
 
 import psycopg2
@@ -53,6 +53,28 @@ def cdn_url(key):
     return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
 
 
+def store_blob(conn, raw, name, mime, prefix='depository'):
+    """Загружает файл в S3 под ключом prefix/sha256.расширение и возвращает ссылку;
+    повторная загрузка того же файла отдаёт уже записанный объект."""
+    digest = hashlib.sha256(raw).hexdigest()
+    ext = name.rsplit('.', 1)[-1].lower()[:8] if '.' in name else ''
+    key = f"{prefix}/{digest}{('.' + ext) if ext else ''}"
+    with conn.cursor() as cur:
+        cur.execute("SELECT url FROM storage_blobs WHERE s3_key = %s", (key,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        s3_client().put_object(Bucket='files', Key=key, Body=raw, ContentType=mime)
+        url = cdn_url(key)
+        cur.execute("""
+            INSERT INTO storage_blobs (sha256, s3_key, url, size_bytes, mime)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (s3_key) DO NOTHING
+        """, (digest, key, url, len(raw), mime))
+        conn.commit()
+    return url
+
+
 def log_activity(cur, file_id, member_id, action, details=None):
     cur.execute(
         "INSERT INTO depo_activity (file_id, member_id, action, details) VALUES (%s, %s, %s, %s)",
@@ -221,9 +243,7 @@ def upload_file(conn, me, body):
     ext = ''
     if '.' in name:
         ext = name.rsplit('.', 1)[-1].lower()[:8]
-    key = f"depository/{uuid.uuid4().hex}{('.' + ext) if ext else ''}"
-    s3_client().put_object(Bucket='files', Key=key, Body=raw, ContentType=mime)
-    url = cdn_url(key)
+    url = store_blob(conn, raw, name, mime)
 
     # извлечение текста для поиска (только текстовые форматы)
     text_content = ''
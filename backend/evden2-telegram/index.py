@@ -4,7 +4,10 @@ import os
 import urllib.request
 import urllib.parse
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+
+
+WEBHOOK_MAX_CONNECTIONS = 5  # одновременных запросов webhook от Telegram при разборе очереди апдейтов
 
 
 def handler(event, context):
@@ -45,41 +48,104 @@ def handler(event, context):
         conn.close()
 
 
-def handle_telegram_webhook(conn, update):
-    """Принимает апдейт от Telegram, сохраняет сообщение и привязывает к сделке по chat_id или username"""
-    message = update.get('message') or update.get('edited_message')
-    if not message:
+def handle_telegram_webhook(conn, body):
+    """Принимает апдейты от Telegram, сохраняет сообщения и привязывает к сделке по chat_id или username.
+    Кроме одиночного апдейта принимает пачку в формате ответа getUpdates ({"ok": true, "result": [...]})
+    или список апдейтов: сделки находятся через кэш (resolve_deals), сообщения вставляются одним INSERT."""
+    if isinstance(body, list):
+        updates, batch = body, True
+    elif isinstance(body.get('result'), list):
+        updates, batch = body['result'], True
+    else:
+        updates, batch = [body], False
+
+    incoming = []
+    for update in updates:
+        message = update.get('message') or update.get('edited_message')
+        if not message:
+            continue
+        chat = message.get('chat', {})
+        incoming.append({
+            'chat_id': str(chat.get('id', '')),
+            'username': chat.get('username', ''),
+            'text': message.get('text', ''),
+            'sender_name': message.get('from', {}).get('first_name', 'Клиент'),
+        })
+    if not incoming:
+        if batch:
+            return ok_response({'ok': True, 'saved': 0, 'skipped': len(updates)})
         return ok_response({'ok': True})
 
-    chat = message.get('chat', {})
-    chat_id = str(chat.get('id', ''))
-    username = chat.get('username', '')
-    text = message.get('text', '')
-    sender_name = message.get('from', {}).get('first_name', 'Клиент')
-
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT id FROM evden_deals WHERE telegram_chat_id = %s", (chat_id,))
-        deal = cur.fetchone()
+        deals = resolve_deals(cur, {(m['chat_id'], m['username']) for m in incoming})
+        for m in incoming:
+            m['deal_id'] = deals.get((m['chat_id'], m['username']))
+        saved = execute_values(cur, """
+            INSERT INTO evden_messages (deal_id, channel, direction, sender_name, telegram_chat_id, text)
+            VALUES %s
+            RETURNING id
+        """, [(m['deal_id'], m['sender_name'], m['chat_id'], m['text']) for m in incoming],
+            template="(%s, 'telegram', 'in', %s, %s, %s)", fetch=True)
+        conn.commit()
 
-        if not deal and username:
-            cur.execute("SELECT id FROM evden_deals WHERE telegram_username = %s", (username,))
-            deal = cur.fetchone()
-            if deal:
-                cur.execute("UPDATE evden_deals SET telegram_chat_id = %s WHERE id = %s", (chat_id, deal['id']))
+    for m in incoming:
+        if not m['deal_id']:
+            notify_unassigned(m['chat_id'], m['username'], m['text'])
 
-        deal_id = deal['id'] if deal else None
+    if not batch:
+        return ok_response({'ok': True, 'deal_id': incoming[0]['deal_id']})
+    # saved — строки, которые реально вставлены; skipped — апдейты без сообщения (вступления в чат и т.п.)
+    return ok_response({'ok': True, 'saved': len(saved), 'skipped': len(updates) - len(incoming)})
 
-        cur.execute("""
-            INSERT INTO evden_messages (deal_id, channel, direction, sender_name, telegram_chat_id, text)
-            VALUES (%s, 'telegram', 'in', %s, %s, %s)
-            RETURNING *
-        """, (deal_id, sender_name, chat_id, text))
-        conn.commit()
 
-    if not deal_id:
-        notify_unassigned(chat_id, username, text)
+_chat_deals = {'version': None, 'links': {}}  # (chat_id, username) -> deal_id или None
 
-    return ok_response({'ok': True, 'deal_id': deal_id})
+
+def resolve_deals(cur, chats):
+    """Сделки для Telegram-чатов: {(chat_id, username): deal_id или None}. Ответ (в том числе
+    «чат не привязан») кэшируется в памяти контейнера, пока не изменилась версия привязок
+    (telegram_link_versions, scope 'evden_deals': её увеличивает триггер на любое изменение
+    telegram_chat_id / telegram_username сделки), так что привязка или отвязка чата в карточке
+    сделки видна со следующей пачки апдейтов. Промахи ищутся одним запросом по chat_id и username."""
+    cur.execute("SELECT version FROM telegram_link_versions WHERE scope = 'evden_deals'")
+    row = cur.fetchone()
+    version = row['version'] if row else None
+    if version is None or version != _chat_deals['version']:
+        _chat_deals['version'] = version
+        _chat_deals['links'] = {}
+    cache = _chat_deals['links']
+
+    missing = [key for key in chats if key not in cache]
+    if missing:
+        cur.execute("""
+            SELECT id, telegram_chat_id, telegram_username FROM evden_deals
+            WHERE telegram_chat_id = ANY(%s) OR telegram_username = ANY(%s)
+            ORDER BY id
+        """, (list({chat_id for chat_id, _ in missing}), list({username for _, username in missing if username})))
+        by_chat, by_username = {}, {}
+        for r in cur.fetchall():
+            if r['telegram_chat_id']:
+                by_chat.setdefault(r['telegram_chat_id'], r['id'])
+            if r['telegram_username']:
+                by_username.setdefault(r['telegram_username'], r['id'])
+
+        relink = {}
+        for chat_id, username in missing:
+            deal_id = by_chat.get(chat_id)
+            if not deal_id and username:
+                deal_id = by_username.get(username)
+                if deal_id:
+                    relink[deal_id] = chat_id
+            cache[(chat_id, username)] = deal_id
+        if relink:
+            # триггер увеличит версию, и следующая пачка перечитает привязки заново
+            execute_values(cur, """
+                UPDATE evden_deals d SET telegram_chat_id = v.chat_id
+                FROM (VALUES %s) AS v(id, chat_id)
+                WHERE d.id = v.id
+            """, sorted(relink.items()))
+
+    return {key: cache[key] for key in chats}
 
 
 def notify_unassigned(chat_id, username, text):
@@ -106,7 +172,8 @@ def register_webhook(body):
 
     webhook_url = f"{target_url}?mode=webhook"
     api_url = f"https://api.telegram.org/bot{bot_token}/setWebhook"
-    data = urllib.parse.urlencode({'url': webhook_url}).encode('utf-8')
+    # max_connections ограничивает параллельные запросы Telegram при доставке накопившихся апдейтов
+    data = urllib.parse.urlencode({'url': webhook_url, 'max_connections': WEBHOOK_MAX_CONNECTIONS}).encode('utf-8')
     req = urllib.request.Request(api_url, data=data, method='POST')
     with urllib.request.urlopen(req, timeout=15) as resp:
         result = json.loads(resp.read().decode('utf-8'))
@@ -2,102 +2,512 @@
 import json
 import os
 import base64
+import datetime
+import hashlib
 import io
+import multiprocessing
 import httpx
 import psycopg2
+import psycopg2.extras
 import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+PARSE_OCR_WORKERS = 6  # изображений, распознаваемых одновременно (каждое — HTTP-запросы к vision-моделям)
+# Процессов для разбора PDF/DOCX/XLSX; по умолчанию 0 — документы разбираются в потоках.
+# Включается переменной KP_PARSE_PROCESSES там, где у функции несколько ядер: каждый
+# spawn-процесс заново импортирует модуль с тяжёлыми зависимостями, и это окупается только
+# на больших документах при реально доступных ядрах.
+PARSE_PROCESS_WORKERS = min(int(os.environ.get('KP_PARSE_PROCESSES') or 0), os.cpu_count() or 1)
+MAX_CHARS_PER_FILE = 15000
+SECTION_FILES_CHARS = 3000  # generate_section отдаёт аналитику только начало материалов
+PDF_SPLIT_PAGES = 100  # страниц в одном диапазоне при разборе большого PDF несколькими процессами
+PDF_SPLIT_MIN_BYTES = 1024 * 1024  # PDF меньше этого не делим: подсчёт страниц дороже выигрыша
+EXCEL_SHEET_MAX_ROWS = 3000  # непустых строк одного листа Excel в тексте (прайсы и сметы бывают на 100k+ строк)
+EXCEL_SHEET_MAX_CHARS = 100000  # символов текста одного листа Excel
+# Версии экстракторов — часть ключа кэша kp_extracted_texts. Меняется вывод экстрактора —
+# увеличьте его версию, иначе повторные загрузки будут отдавать текст старой версии.
+EXTRACTOR_VERSIONS = {'pdf': 1, 'docx': 1, 'excel': 3, 'text': 1, 'ocr': 1}
 
 
 def get_db():
     return psycopg2.connect(os.environ['DATABASE_URL'])
 
 
-def extract_text_from_pdf(data: bytes) -> str:
+def iter_pdf_pages(reader, first: int = 0, last: int = None):
+    """Текст страниц PDF с first по last (не включая) по одной: страница разбирается,
+    только когда до неё дошли"""
+    for i in range(first, len(reader.pages) if last is None else last):
+        yield reader.pages[i].extract_text()
+
+
+def extract_text_from_pdf(data: bytes, max_chars: int = None) -> tuple:
+    """Текст PDF и число страниц: (text, page_count). Страницы читаются по очереди и чтение
+    останавливается, как только набрано max_chars символов, — остальные страницы не разбираются."""
     try:
         import pypdf
         reader = pypdf.PdfReader(io.BytesIO(data))
         texts = []
-        for page in reader.pages:
-            t = page.extract_text()
+        size = -1
+        for t in iter_pdf_pages(reader):
             if t:
                 texts.append(t)
-        return '\n'.join(texts)
+                size += len(t) + 1
+                if max_chars is not None and size >= max_chars:
+                    break
+        return '\n'.join(texts), len(reader.pages)
+    except Exception as e:
+        return f'[Ошибка чтения PDF: {e}]', None
+
+
+def extract_pdf_pages(data: bytes, first: int, last: int) -> str:
+    """Текст диапазона страниц PDF — часть разбора большого PDF несколькими процессами"""
+    try:
+        import pypdf
+        reader = pypdf.PdfReader(io.BytesIO(data))
+        return '\n'.join(t for t in iter_pdf_pages(reader, first, last) if t)
     except Exception as e:
         return f'[Ошибка чтения PDF: {e}]'
 
 
+def pdf_page_ranges(data: bytes) -> tuple:
+    """(page_count, [(first, last), ...]) для PDF, который стоит разобрать по диапазонам
+    страниц в нескольких процессах, иначе None"""
+    if len(data) < PDF_SPLIT_MIN_BYTES:
+        return None
+    try:
+        import pypdf
+        page_count = len(pypdf.PdfReader(io.BytesIO(data)).pages)
+    except Exception:
+        return None
+    if page_count <= PDF_SPLIT_PAGES:
+        return None
+    return page_count, [(first, min(first + PDF_SPLIT_PAGES, page_count)) for first in range(0, page_count, PDF_SPLIT_PAGES)]
+
+
 def extract_text_from_docx(data: bytes) -> str:
+    """Текст DOCX в порядке документа: абзацы (заголовки — с '## ') и таблицы.
+    Один проход по телу документа: обёртка абзаца или таблицы строится прямо из элемента,
+    без поиска его в doc.paragraphs / doc.tables (это было O(n²) на больших ТЗ).
+    Имена стилей кэшируются по style_id, текст ячеек — по элементу <w:tc>."""
     try:
         import docx
+        from docx.table import Table
+        from docx.text.paragraph import Paragraph
         doc = docx.Document(io.BytesIO(data))
+        body = doc.element.body
         parts = []
+        style_names = {}
 
-        def get_cell_text(cell):
-            return ' '.join(p.text.strip() for p in cell.paragraphs if p.text.strip())
+        cell_texts = {}
 
-        for block in doc.element.body:
+        def get_cell_text(cell):
+            # объединённые ячейки повторяются в row.cells — текст каждой <w:tc> считаем один раз
+            tc = cell._tc
+            if tc not in cell_texts:
+                texts = (p.text.strip() for p in cell.paragraphs)
+                cell_texts[tc] = ' '.join(t for t in texts if t)
+            return cell_texts[tc]
+
+        for block in body:
             tag = block.tag.split('}')[-1] if '}' in block.tag else block.tag
             if tag == 'p':
-                para = None
-                for p in doc.paragraphs:
-                    if p._element is block:
-                        para = p
-                        break
-                if para and para.text.strip():
-                    style = para.style.name if para.style else ''
+                para = Paragraph(block, doc._body)
+                text = para.text.strip()
+                if text:
+                    style_id = block.style
+                    if style_id not in style_names:
+                        style_names[style_id] = para.style.name if para.style else ''
+                    style = style_names[style_id]
                     if 'Heading' in style or 'heading' in style:
-                        parts.append(f'\n## {para.text.strip()}')
+                        parts.append(f'\n## {text}')
                     else:
-                        parts.append(para.text.strip())
+                        parts.append(text)
             elif tag == 'tbl':
-                for tbl in doc.tables:
-                    if tbl._element is block:
-                        rows = tbl.rows
-                        if not rows:
-                            continue
-                        header_cells = [get_cell_text(c) for c in rows[0].cells]
-                        has_header = any(header_cells)
+                rows = Table(block, doc._body).rows
+                cell_texts.clear()
+                if not rows:
+                    continue
+                header_cells = [get_cell_text(c) for c in rows[0].cells]
+                has_header = any(header_cells)
+                if has_header:
+                    parts.append('\nТАБЛИЦА:')
+                    parts.append(' | '.join(header_cells))
+                    parts.append('-' * 40)
+                for row in (rows[1:] if has_header else rows):
+                    row_texts = [get_cell_text(c) for c in row.cells]
+                    non_empty = [t for t in row_texts if t]
+                    if non_empty:
                         if has_header:
-                            parts.append('\nТАБЛИЦА:')
-                            parts.append(' | '.join(header_cells))
-                            parts.append('-' * 40)
-                        for row in (rows[1:] if has_header else rows):
-                            row_texts = [get_cell_text(c) for c in row.cells]
-                            non_empty = [t for t in row_texts if t]
-                            if non_empty:
-                                if has_header:
-                                    pairs = []
-                                    for h, v in zip(header_cells, row_texts):
-                                        if v:
-                                            pairs.append(f'{h}: {v}' if h else v)
-                                    parts.append(', '.join(pairs))
-                                else:
-                                    parts.append(' | '.join(non_empty))
-                        break
+                            pairs = []
+                            for h, v in zip(header_cells, row_texts):
+                                if v:
+                                    pairs.append(f'{h}: {v}' if h else v)
+                            parts.append(', '.join(pairs))
+                        else:
+                            parts.append(' | '.join(non_empty))
 
         return '\n'.join(parts)
     except Exception as e:
         return f'[Ошибка чтения DOCX: {e}]'
 
 
-def extract_text_from_excel(data: bytes) -> str:
+def format_excel_cell(value) -> str:
+    """Значение ячейки Excel для текста: целые без '.0', дробные без хвоста двоичной погрешности,
+    даты — ДД.ММ.ГГГГ (со временем, если оно есть), переносы строк внутри ячейки — пробелом"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'да' if value else 'нет'
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return f'{value:.15g}'
+    if isinstance(value, datetime.datetime):
+        if value.time() == datetime.time(0):
+            return value.strftime('%d.%m.%Y')
+        return value.strftime('%d.%m.%Y %H:%M' if not value.second else '%d.%m.%Y %H:%M:%S')
+    if isinstance(value, datetime.date):
+        return value.strftime('%d.%m.%Y')
+    if isinstance(value, datetime.time):
+        return value.strftime('%H:%M' if not value.second else '%H:%M:%S')
+    if isinstance(value, str):
+        return ' '.join(value.split())
+    return str(value)
+
+
+def iter_excel_rows(ws):
+    """Непустые строки листа — списки отформатированных ячеек. Хвостовые пустые колонки
+    (в прайсах часто «раздутый» диапазон до XFD) отбрасываются до форматирования."""
+    for row in ws.iter_rows(values_only=True):
+        last = len(row) - 1
+        while last >= 0 and (row[last] is None or (isinstance(row[last], str) and not row[last].strip())):
+            last -= 1
+        if last >= 0:
+            yield [format_excel_cell(v) for v in row[:last + 1]]
+
+
+def iter_excel_lines(wb, max_chars: int = None):
+    """Строки текста книги по листам. Лист обрезается после EXCEL_SHEET_MAX_ROWS строк или
+    EXCEL_SHEET_MAX_CHARS символов (с пометкой), вся книга — после max_chars символов.
+    Генератор: остановка чтения останавливает и разбор XML листа."""
+    total = 0
+    for sheet_name in wb.sheetnames:
+        header = f'\n[Лист: {sheet_name}]'
+        total += len(header) + 1
+        yield header
+        rows = chars = 0
+        for cells in iter_excel_rows(wb[sheet_name]):
+            if rows >= EXCEL_SHEET_MAX_ROWS:
+                yield f'[… лист обрезан: показаны первые {rows} строк, лимит {EXCEL_SHEET_MAX_ROWS} строк на лист]'
+                break
+            if chars >= EXCEL_SHEET_MAX_CHARS:
+                yield f'[… лист обрезан: показаны первые {rows} строк, лимит {EXCEL_SHEET_MAX_CHARS} символов на лист]'
+                break
+            # пустые ячейки по краям строки не дают висящих разделителей, как и раньше
+            line = ' | '.join(cells).strip(' |')
+            rows += 1
+            chars += len(line) + 1
+            yield line
+            if max_chars is not None and total + chars >= max_chars:
+                return
+        total += chars
+
+
+def extract_text_from_excel(data: bytes, max_chars: int = None) -> str:
+    """Текст книги Excel (только чтение, потоково, память не растёт с числом строк)"""
     try:
         import openpyxl
         wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
-        parts = []
-        for sheet_name in wb.sheetnames:
-            ws = wb[sheet_name]
-            parts.append(f'\n[Лист: {sheet_name}]')
-            for row in ws.iter_rows(values_only=True):
-                cells = [str(c) if c is not None else '' for c in row]
-                non_empty = [c for c in cells if c.strip()]
-                if non_empty:
-                    parts.append(' | '.join(cells).strip(' |'))
-        return '\n'.join(parts)
+        try:
+            return '\n'.join(iter_excel_lines(wb, max_chars))
+        finally:
+            wb.close()
     except Exception as e:
         return f'[Ошибка чтения Excel: {e}]'
 
 
+OCR_PROMPT = (
+    'Это изображение технического документа, скан, фото или скриншот. '
+    'Выполни:\n'
+    '1. Извлеки ВЕСЬ текст дословно (OCR)\n'
+    '2. Опиши таблицы, схемы, чертежи\n'
+    '3. Укажи все числа, размеры, характеристики\n'
+    '4. Печати, подписи, реквизиты — тоже укажи\n'
+    'Отвечай на русском языке.'
+)
+# Пробуем модели по очереди — первая доступная выигрывает
+OCR_MODELS = [
+    'google/gemini-2.0-flash-001',
+    'google/gemini-flash-1.5-8b',
+    'openai/gpt-4o-mini',
+]
+
+
+def ocr_image(data_b64: str, mime: str, api_key: str) -> tuple:
+    """Распознаёт текст с изображения через vision-модели (с fallback).
+    Возвращает (text, model); model — None, если ни одна модель не ответила."""
+    content = [
+        {'type': 'text', 'text': OCR_PROMPT},
+        {'type': 'image_url', 'image_url': {'url': f'data:{mime};base64,{data_b64}'}}
+    ]
+    last_err = ''
+    for model in OCR_MODELS:
+        try:
+            with httpx.Client(timeout=15) as vc:
+                vr = vc.post(
+                    'https://openrouter.ai/api/v1/chat/completions',
+                    headers={'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'},
+                    json={'model': model, 'messages': [{'role': 'user', 'content': content}], 'max_tokens': 2000}
+                )
+            if vr.status_code == 200:
+                return vr.json()['choices'][0]['message']['content'], model
+            last_err = f'{model}: HTTP {vr.status_code} — {vr.text[:150]}'
+        except Exception as e:
+            last_err = f'{model}: {e}'
+    return f'[OCR не удался. Последняя ошибка: {last_err}]', None
+
+
+def file_kind(name: str, ftype: str) -> str:
+    """Экстрактор для файла: 'ocr', 'pdf', 'docx', 'excel' или 'text'"""
+    lname = name.lower()
+    if ftype.startswith('image/') or lname.endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tiff')):
+        return 'ocr'
+    if 'pdf' in ftype or lname.endswith('.pdf'):
+        return 'pdf'
+    if 'word' in ftype or 'document' in ftype or lname.endswith(('.docx', '.doc')):
+        return 'docx'
+    if 'sheet' in ftype or 'excel' in ftype or lname.endswith(('.xlsx', '.xls')):
+        return 'excel'
+    return 'text'
+
+
+def extract_document_text(raw: bytes, kind: str, max_chars: int = None) -> tuple:
+    """Текст документа экстрактором kind (кроме OCR): (text, page_count). max_chars — сколько
+    символов нужно вызывающему: экстрактор вправе остановиться, набрав их.
+    Функция верхнего уровня — её можно отдать в пул процессов."""
+    if kind == 'pdf':
+        return extract_text_from_pdf(raw, max_chars)
+    if kind == 'docx':
+        return extract_text_from_docx(raw), None
+    if kind == 'excel':
+        return extract_text_from_excel(raw, max_chars), None
+    return raw.decode('utf-8', errors='replace'), None
+
+
+def _extraction_failed(text: str) -> bool:
+    """Ошибки разбора и неудачный OCR в кэш не попадают — следующая загрузка попробует снова"""
+    return text.startswith(('[Ошибка чтения', '[OCR не удался'))
+
+
+def _load_extracted_texts(conn, digests: list, max_chars: int = None) -> dict:
+    """Кэшированные тексты текущих версий экстракторов: {(sha256, kind): (text, page_count, ocr_model)}.
+    Запись, извлечённая с меньшим бюджетом символов, чем нужен сейчас, не подходит."""
+    if conn is None or not digests:
+        return {}
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT sha256, extractor, extractor_version, text, page_count, ocr_model, char_budget
+               FROM kp_extracted_texts WHERE sha256 = ANY(%s)""",
+            (list(digests),)
+        )
+        rows = cur.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        return {}
+    return {
+        (digest, kind): (text, page_count, ocr_model)
+        for digest, kind, version, text, page_count, ocr_model, char_budget in rows
+        if EXTRACTOR_VERSIONS.get(kind) == version
+        and (char_budget is None or (max_chars is not None and char_budget >= max_chars))
+    }
+
+
+def _save_extracted_texts(conn, rows: list):
+    """Сохраняет свежие результаты разбора; rows — (sha256, kind, text, page_count, ocr_model, size_bytes, char_budget).
+    char_budget — бюджет, на котором разбор мог остановиться (None — текст полный); более полный
+    текст заменяет сохранённый."""
+    if conn is None or not rows:
+        return
+    try:
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(
+            cur,
+            """INSERT INTO kp_extracted_texts (sha256, extractor, extractor_version, text, page_count, ocr_model, size_bytes, char_budget)
+               VALUES %s
+               ON CONFLICT (sha256, extractor, extractor_version) DO UPDATE
+               SET text = EXCLUDED.text, page_count = EXCLUDED.page_count, char_budget = EXCLUDED.char_budget
+               WHERE kp_extracted_texts.char_budget IS NOT NULL
+                 AND (EXCLUDED.char_budget IS NULL OR EXCLUDED.char_budget > kp_extracted_texts.char_budget)""",
+            [(digest, kind, EXTRACTOR_VERSIONS[kind], text, page_count, ocr_model, size, char_budget)
+             for digest, kind, text, page_count, ocr_model, size, char_budget in rows]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+
+
+def _document_pool(count: int):
+    """Пул процессов для CPU-тяжёлого разбора документов, если он включён (KP_PARSE_PROCESSES).
+    Для одной задачи пул не нужен (запуск процесса дороже выигрыша). Пул живёт один вызов
+    parse_files и закрывается в нём же. Если среда не даёт создавать процессы (нет /dev/shm
+    для семафоров) — None с записью в лог, документы разбираются в потоках.
+    spawn, а не fork: в контейнере уже могут работать фоновые потоки задач КП."""
+    if count < 2 or PARSE_PROCESS_WORKERS < 2:
+        return None
+    try:
+        return ProcessPoolExecutor(max_workers=min(PARSE_PROCESS_WORKERS, count), mp_context=multiprocessing.get_context('spawn'))
+    except (OSError, NotImplementedError, ValueError) as e:
+        print(f'[generate-kp] пул процессов недоступен, разбор в потоках: {e}', flush=True)
+        return None
+
+
+def job_file_kind(name: str, ftype: str) -> str:
+    """Экстрактор для файла задачи КП/ДК/раздела: только по расширению — PDF, DOCX или текст
+    (без OCR и Excel, фронтенд присылает сюда только .pdf/.docx/.doc)"""
+    lname = name.lower()
+    if lname.endswith('.pdf'):
+        return 'pdf'
+    if lname.endswith('.docx'):
+        return 'docx'
+    return 'text'
+
+
+def parse_files(files_b64: list, api_key: str, max_chars: int = MAX_CHARS_PER_FILE, kind_of=file_kind) -> tuple:
+    """Извлекает текст из загруженных файлов одновременно: изображения распознаются в пуле
+    потоков (ожидание HTTP), PDF/DOCX/XLSX — там же или, если включён KP_PARSE_PROCESSES,
+    в пуле процессов. Время ответа —
+    примерно время самого долгого файла, а не сумма. Порядок результатов совпадает с порядком
+    файлов, ошибка одного файла попадает в его результат и не мешает остальным.
+
+    Результаты кэшируются в kp_extracted_texts по sha256 содержимого и версии экстрактора:
+    повторно загруженный файл не разбирается и не отправляется на OCR. Одинаковые файлы
+    внутри одного запроса тоже разбираются один раз. Кэш — best effort: без БД файлы
+    просто разбираются заново.
+
+    max_chars — сколько символов файла нужно вызывающему: текст обрезается до него, а PDF
+    перестаёт читаться, набрав его. max_chars=None — текст целиком; тогда большой PDF
+    (pdf_page_ranges) при включённом пуле процессов разбирается диапазонами страниц параллельно.
+    kind_of(name, type) выбирает экстрактор (file_kind; job_file_kind — для задач).
+    Возвращает (results, total_chars)."""
+    results = [None] * len(files_b64)
+    pending = {}  # (sha256, kind) -> {'raw', 'data_b64', 'mime', 'files': [(i, name)]}
+    for i, f in enumerate(files_b64):
+        name = f.get('name', 'файл')
+        ftype = f.get('type', '')
+        data_b64 = f.get('data', '')
+        if not data_b64:
+            results[i] = {'name': name, 'text': '[Пустой файл]', 'error': True}
+            continue
+        try:
+            raw = base64.b64decode(data_b64)
+        except Exception as e:
+            results[i] = {'name': name, 'text': f'[Ошибка: {e}]', 'error': True}
+            continue
+        kind = kind_of(name, ftype)
+        entry = pending.setdefault((hashlib.sha256(raw).hexdigest(), kind), {
+            'raw': raw,
+            'data_b64': data_b64,
+            'mime': ftype if ftype.startswith('image/') else 'image/png',
+            'files': [],
+        })
+        entry['files'].append((i, name))
+
+    try:
+        conn = get_db() if pending else None
+    except Exception:
+        conn = None
+    try:
+        done = _load_extracted_texts(conn, {digest for digest, _ in pending}, max_chars)
+        cached = set(done)
+        errors = {}
+        misses = [key for key in pending if key not in cached]
+        split = {}  # (sha256, 'pdf') -> (page_count, [(first, last), ...])
+        if max_chars is None:
+            for key in misses:
+                if key[1] == 'pdf':
+                    ranges = pdf_page_ranges(pending[key]['raw'])
+                    if ranges:
+                        split[key] = ranges
+        document_tasks = sum(len(split[key][1]) if key in split else 1 for key in misses if key[1] != 'ocr')
+        processes = _document_pool(document_tasks)
+        if processes is None:
+            # без пула процессов диапазоны в потоках упрутся в GIL — PDF разбирается целиком
+            split = {}
+
+        tasks = []  # (key, func, args)
+        for key in misses:
+            entry = pending[key]
+            if key[1] == 'ocr':
+                tasks.append((key, ocr_image, (entry['data_b64'], entry['mime'], api_key)))
+            elif key in split:
+                tasks.extend((key, extract_pdf_pages, (entry['raw'], first, last)) for first, last in split[key][1])
+            else:
+                tasks.append((key, extract_document_text, (entry['raw'], key[1], max_chars)))
+        outputs = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(PARSE_OCR_WORKERS, len(tasks)))) as threads:
+                futures = [
+                    (key, func, args, (threads if func is ocr_image else processes or threads).submit(func, *args))
+                    for key, func, args in tasks
+                ]
+                for key, func, args, future in futures:
+                    try:
+                        try:
+                            out = future.result()
+                        except BrokenProcessPool as e:
+                            # процесс-воркер упал (например, не хватило памяти) — разбираем файл здесь
+                            print(f'[generate-kp] пул процессов сломан, {func.__name__} в потоке: {e}', flush=True)
+                            out = func(*args)
+                        outputs.setdefault(key, []).append(out)
+                    except Exception as e:
+                        errors[key] = e
+        finally:
+            if processes:
+                processes.shutdown()
+
+        for key, outs in outputs.items():
+            if key in errors:
+                continue
+            if key[1] == 'ocr':
+                text, ocr_model = outs[0]
+                done[key] = (text, None, ocr_model)
+            elif key in split:
+                failed = next((t for t in outs if _extraction_failed(t)), None)
+                done[key] = (failed or '\n'.join(t for t in outs if t), None if failed else split[key][0], None)
+            else:
+                text, page_count = outs[0]
+                done[key] = (text, page_count, None)
+
+        _save_extracted_texts(conn, [
+            (digest, kind, text, page_count, ocr_model, len(pending[(digest, kind)]['raw']),
+             max_chars if max_chars is not None and len(text) >= max_chars else None)
+            for (digest, kind), (text, page_count, ocr_model) in done.items()
+            if (digest, kind) not in cached and not _extraction_failed(text)
+        ])
+    finally:
+        if conn is not None:
+            conn.close()
+
+    for key, entry in pending.items():
+        for i, name in entry['files']:
+            if key in errors:
+                results[i] = {'name': name, 'text': f'[Ошибка: {errors[key]}]', 'error': True}
+                continue
+            text = done[key][0]
+            is_image = key[1] == 'ocr'
+            is_error = is_image and text.startswith('[OCR')
+            if max_chars is not None:
+                text = text[:max_chars]
+            results[i] = {'name': name, 'text': text, 'chars': len(text), 'error': is_error, 'ocr': is_image, 'cached': key in cached}
+
+    total_chars = sum(r.get('chars', 0) for r in results)
+    return results, total_chars
+
+
 PRICE_LIST = [
     {"code": "ОП-ОКС.БЗУ", "name": "Благоустройство земельного участка (БЗУ под ключ)", "unit": "га", "price_per_unit": 500000, "min_order_sum": 500000, "special_rules": "Округление площади: 1.1–1.4 как 1 га; 1.5–1.9 как 2 га"},
     {"code": "ОП-ППТ понижающие условия", "name": "ППТ, гос, понижающие условия", "unit": "га", "price_per_unit": 215000, "special_rules": "Коэффициент 0.15 для понижающих условий"},
@@ -668,10 +1078,17 @@ AGENT_COORDINATOR_PROMPT = """Ты — Технический координат
 ТОЛЬКО JSON."""
 
 
-def process_job_async(job_id: str, action: str, combined_text: str, extra_prompt: str, kp_data: dict, section_context: str = ''):
-    """Фоновый поток: агентный RAG-подход (4 этапа) → сохраняет результат в БД"""
+def process_job_async(job_id: str, action: str, files_b64: list, files_text: str, extra_prompt: str, kp_data: dict, section_context: str = ''):
+    """Фоновый поток: разбор файлов, агентный RAG-подход (4 этапа) → сохраняет результат в БД"""
     conn = None
     try:
+        # Парсинг файлов — здесь, а не в запросе запуска (через тот же кэш, что и parse_files).
+        # generate_section берёт только начало материалов — ровно столько и извлекаем.
+        files_chars = SECTION_FILES_CHARS if action == 'generate_section' else None
+        parsed, _ = parse_files(files_b64, '', max_chars=files_chars, kind_of=job_file_kind)
+        parsed_texts = [f"=== ФАЙЛ: {p['name']} ===\n{p['text']}" for p in parsed]
+        combined_text = '\n\n'.join(parsed_texts) if parsed_texts else files_text
+
         if action == 'generate_kp':
             update_job_stage(job_id, 'Анализирую ТЗ и исходные данные...', 1, 2)
             user_message = f"""СОДЕРЖИМОЕ ЗАГРУЖЕННЫХ ДОКУМЕНТОВ:
@@ -688,7 +1105,7 @@ def process_job_async(job_id: str, action: str, combined_text: str, extra_prompt
             update_job_stage(job_id, 'Агент-аналитик разбирает техническое задание...', 1, 4)
             tz_analysis_raw = call_ai(
                 AGENT_ANALYST_PROMPT,
-                f"ТЕХНИЧЕСКОЕ ЗАДАНИЕ И КОНТЕКСТ:\n{section_context}\n\nДОПОЛНИТЕЛЬНЫЕ МАТЕРИАЛЫ:\n{combined_text[:3000] if combined_text else '—'}",
+                f"ТЕХНИЧЕСКОЕ ЗАДАНИЕ И КОНТЕКСТ:\n{section_context}\n\nДОПОЛНИТЕЛЬНЫЕ МАТЕРИАЛЫ:\n{combined_text[:SECTION_FILES_CHARS] if combined_text else '—'}",
                 max_tokens=2000
             )
             try:
@@ -1530,86 +1947,13 @@ def handler(event: dict, context) -> dict:
 
     # Парсинг файлов — извлечение текста + OCR изображений через Gemini Vision
     if action == 'parse_files':
-        import httpx as _httpx
         api_key = os.environ.get('OPENROUTER_API_KEY', '')
         if not api_key:
             return {'statusCode': 500, 'headers': CORS, 'body': json.dumps({'error': 'OPENROUTER_API_KEY не настроен'})}
         files_b64 = body.get('files_b64', [])
         if not files_b64:
             return {'statusCode': 400, 'headers': CORS, 'body': json.dumps({'error': 'files_b64 пустой'})}
-        results = []
-        total_chars = 0
-        MAX_CHARS_PER_FILE = 15000
-
-        OCR_PROMPT = (
-            'Это изображение технического документа, скан, фото или скриншот. '
-            'Выполни:\n'
-            '1. Извлеки ВЕСЬ текст дословно (OCR)\n'
-            '2. Опиши таблицы, схемы, чертежи\n'
-            '3. Укажи все числа, размеры, характеристики\n'
-            '4. Печати, подписи, реквизиты — тоже укажи\n'
-            'Отвечай на русском языке.'
-        )
-        # Пробуем модели по очереди — первая доступная выигрывает
-        OCR_MODELS = [
-            'google/gemini-2.0-flash-001',
-            'google/gemini-flash-1.5-8b',
-            'openai/gpt-4o-mini',
-        ]
-
-        def ocr_image(data_b64: str, mime: str, fname: str) -> str:
-            """Распознаёт текст с изображения через vision-модели (с fallback)."""
-            content = [
-                {'type': 'text', 'text': OCR_PROMPT},
-                {'type': 'image_url', 'image_url': {'url': f'data:{mime};base64,{data_b64}'}}
-            ]
-            last_err = ''
-            for model in OCR_MODELS:
-                try:
-                    with _httpx.Client(timeout=15) as vc:
-                        vr = vc.post(
-                            'https://openrouter.ai/api/v1/chat/completions',
-                            headers={'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'},
-                            json={'model': model, 'messages': [{'role': 'user', 'content': content}], 'max_tokens': 2000}
-                        )
-                    if vr.status_code == 200:
-                        return vr.json()['choices'][0]['message']['content']
-                    last_err = f'{model}: HTTP {vr.status_code} — {vr.text[:150]}'
-                except Exception as e:
-                    last_err = f'{model}: {e}'
-            return f'[OCR не удался. Последняя ошибка: {last_err}]'
-
-        for f in files_b64:
-            name = f.get('name', 'файл')
-            ftype = f.get('type', '')
-            data_b64 = f.get('data', '')
-            if not data_b64:
-                results.append({'name': name, 'text': '[Пустой файл]', 'error': True})
-                continue
-            try:
-                is_image = ftype.startswith('image/') or name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tiff'))
-                if is_image:
-                    mime = ftype if ftype.startswith('image/') else 'image/png'
-                    text = ocr_image(data_b64, mime, name)
-                    is_error = text.startswith('[OCR')
-                else:
-                    raw = base64.b64decode(data_b64)
-                    if 'pdf' in ftype or name.lower().endswith('.pdf'):
-                        text = extract_text_from_pdf(raw)
-                    elif 'word' in ftype or 'document' in ftype or name.lower().endswith(('.docx', '.doc')):
-                        text = extract_text_from_docx(raw)
-                    elif 'sheet' in ftype or 'excel' in ftype or name.lower().endswith(('.xlsx', '.xls')):
-                        text = extract_text_from_excel(raw)
-                    elif 'csv' in ftype or name.lower().endswith('.csv'):
-                        text = raw.decode('utf-8', errors='replace')
-                    else:
-                        text = raw.decode('utf-8', errors='replace')
-                    is_error = False
-                text = text[:MAX_CHARS_PER_FILE]
-                total_chars += len(text)
-                results.append({'name': name, 'text': text, 'chars': len(text), 'error': is_error, 'ocr': is_image})
-            except Exception as e:
-                results.append({'name': name, 'text': f'[Ошибка: {e}]', 'error': True})
+        results, total_chars = parse_files(files_b64, api_key)
         return {'statusCode': 200, 'headers': CORS, 'body': json.dumps({'files': results, 'total_chars': total_chars}, ensure_ascii=False)}
 
     # DeepSeek чат — синхронный, без очереди
@@ -1649,22 +1993,6 @@ def handler(event: dict, context) -> dict:
     files_b64 = body.get('files_b64', [])
     section_context = body.get('context', '')
 
-    # Парсинг файлов
-    parsed_texts = []
-    for f in files_b64:
-        name = f.get('name', '')
-        b64 = f.get('data', '')
-        raw = base64.b64decode(b64)
-        if name.lower().endswith('.pdf'):
-            text = extract_text_from_pdf(raw)
-        elif name.lower().endswith('.docx'):
-            text = extract_text_from_docx(raw)
-        else:
-            text = raw.decode('utf-8', errors='replace')
-        parsed_texts.append(f'=== ФАЙЛ: {name} ===\n{text}')
-
-    combined_text = '\n\n'.join(parsed_texts) if parsed_texts else files_text
-
     # Сохранить задачу в БД
     input_data = json.dumps({'action': action, 'extra_prompt': extra_prompt}, ensure_ascii=False)
     conn = get_db()
@@ -1680,7 +2008,7 @@ def handler(event: dict, context) -> dict:
     # Запустить фоновый поток
     t = threading.Thread(
         target=process_job_async,
-        args=(job_id, action, combined_text, extra_prompt, kp_data, section_context),
+        args=(job_id, action, files_b64, files_text, extra_prompt, kp_data, section_context),
         daemon=True
     )
     t.start()
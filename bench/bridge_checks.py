@@ -0,0 +1,330 @@
+"""Проверки результатов 'Радужного моста' (backend/bridge/index.py), а не только HTTP-статусов.
+
+Смоук-тесты backend/bridge/tests.json проверяют коды ответов и форму JSON; здесь сверяются данные:
+    правила папок — приоритет _compile_folder_rules / _match_folder (точный адрес > домен >
+        шаблон, длинный шаблон > короткий, раннее правило > позднее) и то, что set-based
+        _apply_folder_rules (DISTINCT ON ... ORDER BY priority) раскладывает письма так же;
+    курсоры — разбор и сборка курсоров, и что листание get_messages (before и updated_since)
+        по сообщениям с одинаковыми created_at / updated_at отдаёт каждое ровно один раз;
+    очередь отправки — какие ошибки SMTP повторяются и расписание повторов;
+    хранилище — ключ объекта по содержимому и префиксу: один файл под одним префиксом
+        загружается один раз, под другим префиксом получает свой объект;
+    импорт — задание, упавшее на временных сбоях, продолжается, на постоянной ошибке — нет;
+    привязка писем — инкрементальный проход подбирает письмо, клиент для которого появился
+        после прошлого прохода.
+
+Без DATABASE_URL выполняются только проверки, не требующие базы. С DATABASE_URL (локальная
+Postgres со схемой проекта, как у bench/bridge_ingest.py) — и проверки на базе: данные пишутся
+под отдельным partner_id и удаляются до и после прогона.
+
+Запуск из корня репозитория (нужны зависимости backend/bridge/requirements.txt):
+    [DATABASE_URL=postgresql://localhost/bridge_bench] python bench/bridge_checks.py
+"""
+import argparse
+import json
+import os
+import re
+import smtplib
+import sys
+from datetime import datetime
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'backend', 'bridge'))
+
+import index as bridge  # noqa: E402
+
+# правила в порядке создания (id) и ожидаемая папка для адресов
+FOLDER_RULES = [
+    (1, 10, '*@firm.example'),
+    (2, 20, '@firm.example'),
+    (3, 30, 'boss@firm.example'),
+    (4, 40, ' BOSS@Firm.example'),   # тот же адрес позже — проигрывает правилу 3
+    (5, 50, '*@*.example'),
+    (6, 60, 'sales*@*.example'),      # длиннее правила 5 — важнее его
+    (7, 70, 'other.example'),         # домен без '@'
+    (8, 80, '@Other.example'),        # тот же домен позже
+    (9, 90, 'a_b%@*.test'),           # '_' и '%' — буквальные символы, не маски LIKE
+]
+FOLDER_CASES = {
+    'boss@firm.example': 30,
+    'Anna@Firm.example': 20,
+    'sales1@x.example': 60,
+    'anna@x.example': 50,
+    'bob@other.example': 70,
+    'a_b%@q.test': 90,
+    'axbz@q.test': None,
+    'nobody@nowhere.org': None,
+    '': None,
+}
+
+
+class Checks:
+    def __init__(self):
+        self.failed = 0
+        self.passed = 0
+
+    def expect(self, name, actual, expected):
+        if actual == expected:
+            self.passed += 1
+        else:
+            self.failed += 1
+            print(f"FAIL {name}: получено {actual!r}, ожидалось {expected!r}")
+
+
+def sql_order_match(rules, address):
+    """Папка так, как её выбирает _apply_folder_rules: первое по порядку rules['rows'] подходящее правило"""
+    address = (address or '').strip().lower()
+    for r in rules['rows']:
+        pattern = r['pattern']
+        kind = bridge._folder_rule_kind(pattern)
+        if kind == 0:
+            hit = address == pattern
+        elif kind == 1:
+            hit = address.split('@', 1)[-1] == pattern.lstrip('@') if '@' in address else False
+        else:
+            hit = re.fullmatch('.*'.join(re.escape(p) for p in pattern.split('*')), address, re.DOTALL) is not None
+        if hit:
+            return r['folder_id']
+    return None
+
+
+# ------------------------------------------------------------ без базы --
+
+def check_folder_rules(checks):
+    rules = bridge._compile_folder_rules([{'id': i, 'folder_id': f, 'email_address': p} for i, f, p in FOLDER_RULES])
+    for address, expected in FOLDER_CASES.items():
+        checks.expect(f"_match_folder({address!r})", bridge._match_folder(rules, address), expected)
+        if address:
+            checks.expect(f"порядок rows для {address!r}", sql_order_match(rules, address), expected)
+    # порядок правил не зависит от порядка строк в выборке
+    shuffled = bridge._compile_folder_rules([{'id': i, 'folder_id': f, 'email_address': p} for i, f, p in reversed(FOLDER_RULES)])
+    checks.expect('rows не зависят от порядка выборки', [r['id'] for r in shuffled['rows']], [r['id'] for r in rules['rows']])
+
+
+def check_cursors(checks):
+    ts = datetime(2026, 5, 1, 10, 0, 0, 123456)
+    checks.expect('курсор туда-обратно', bridge._parse_cursor(bridge._make_cursor(ts, 42)), (ts, 42))
+    checks.expect('курсор без микросекунд', bridge._parse_cursor(bridge._make_cursor(ts.replace(microsecond=0), 7)),
+                  (ts.replace(microsecond=0), 7))
+    checks.expect('голая метка в updated_since', bridge._parse_updated_since(ts.isoformat()), (ts, 0))
+    for raw in ('', 'abc', '2026-05-01|x', '|5', 'x|5'):
+        checks.expect(f"неверный курсор {raw!r}", bridge._parse_cursor(raw), None)
+    # при равном времени порядок задаёт id, как в сравнении строк (updated_at, id) > (...)
+    page = sorted([(ts, 5), (ts, 3), (ts, 9)])
+    checks.expect('порядок при равном времени', [row_id for _, row_id in page], [3, 5, 9])
+
+
+def check_outbox_retry(checks):
+    transient = {
+        '451 временно': smtplib.SMTPResponseException(451, b'try later'),
+        'обрыв соединения': smtplib.SMTPServerDisconnected('gone'),
+        'таймаут': TimeoutError(),
+        'отказ 4xx по всем получателям': smtplib.SMTPRecipientsRefused({'a@x': (450, b'busy'), 'b@x': (421, b'later')}),
+    }
+    permanent = {
+        '550 нет адреса': smtplib.SMTPResponseException(550, b'no such user'),
+        'отказ в авторизации': smtplib.SMTPAuthenticationError(535, b'bad password'),
+        'один получатель 5xx': smtplib.SMTPRecipientsRefused({'a@x': (450, b'busy'), 'b@x': (550, b'no')}),
+        'ошибка в коде': ValueError('bug'),
+    }
+    for name, exc in transient.items():
+        checks.expect(f"временная: {name}", bridge._smtp_transient(exc), True)
+    for name, exc in permanent.items():
+        checks.expect(f"постоянная: {name}", bridge._smtp_transient(exc), False)
+    delays = [bridge._outbox_retry_delay(n) for n in range(1, bridge.OUTBOX_MAX_ATTEMPTS + 4)]
+    checks.expect('первый повтор', delays[0], bridge.OUTBOX_RETRY_SECONDS)
+    checks.expect('паузы не убывают', delays, sorted(delays))
+    checks.expect('пауза не больше часа', max(delays), 3600)
+
+
+def check_blob_keys(checks):
+    digest = 'ab' * 32
+    key = bridge._blob_key('bridge/attachments', digest, 'Счёт.PDF')
+    checks.expect('ключ объекта', key, f'bridge/attachments/{digest}.pdf')
+    checks.expect('без расширения', bridge._blob_key('bridge/attachments', digest, 'README'), f'bridge/attachments/{digest}')
+    checks.expect('тот же файл с другим именем', bridge._blob_key('bridge/attachments', digest, 'copy.pdf'), key)
+    checks.expect('другой префикс — другой объект', bridge._blob_key('crm/documents', digest, 'Счёт.pdf') != key, True)
+
+
+# ------------------------------------------------------------ на базе --
+
+def call(func, conn, params):
+    response = func(conn, params)
+    data = json.loads(response['body'])
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"{func.__name__}: {response['statusCode']} {data.get('error')}")
+    return data
+
+
+def check_folder_rules_sql(checks, conn, partner_id):
+    with conn.cursor() as cur:
+        folders = {}
+        for _, folder, _ in FOLDER_RULES:
+            cur.execute("INSERT INTO bridge_folders (partner_id, name) VALUES (%s, %s) RETURNING id", (partner_id, f'check {folder}'))
+            folders[folder] = cur.fetchone()[0]
+        rows = [{'id': i, 'folder_id': folders[f], 'email_address': p} for i, f, p in FOLDER_RULES]
+        messages = {}
+        for address in FOLDER_CASES:
+            if not address:
+                continue
+            cur.execute("""
+                INSERT INTO bridge_messages (partner_id, channel, direction, sender_name, email_from, body)
+                VALUES (%s, 'email', 'in', 'check', %s, '') RETURNING id
+            """, (partner_id, address))
+            messages[cur.fetchone()[0]] = address
+        rules = bridge._compile_folder_rules(rows)
+        bridge._apply_folder_rules(cur, partner_id, rules)
+        cur.execute("SELECT id, folder_id FROM bridge_messages WHERE id = ANY(%s)", (list(messages),))
+        for message_id, folder_id in cur.fetchall():
+            address = messages[message_id]
+            checks.expect(f"_apply_folder_rules({address!r})", folder_id, bridge._match_folder(rules, address))
+        conn.commit()
+
+
+def check_message_paging(checks, conn, partner_id):
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO crm_clients (partner_id, company_name, contact_person, email)
+            VALUES (%s, 'check', '', 'paging@check.example') RETURNING id
+        """, (partner_id,))
+        client_id = cur.fetchone()[0]
+        # одна транзакция — у всех строк одинаковые created_at и updated_at (NOW())
+        cur.execute("""
+            INSERT INTO bridge_messages (partner_id, client_id, channel, direction, sender_name, body)
+            SELECT %s, %s, 'telegram', 'in', 'check', 'm' || n FROM generate_series(1, 23) n
+            RETURNING id
+        """, (partner_id, client_id))
+        ids = sorted(r[0] for r in cur.fetchall())
+        conn.commit()
+
+    seen, cursor = [], None
+    while True:
+        params = {'client_id': str(client_id), 'limit': '5'}
+        if cursor:
+            params['before'] = cursor
+        page = call(bridge.get_messages, conn, params)
+        seen.extend(m['id'] for m in page['messages'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    checks.expect('before: все сообщения по одному разу, от новых к старым', seen, ids[::-1])
+
+    seen, since = [], datetime(2000, 1, 1).isoformat()
+    while True:
+        page = call(bridge.get_messages, conn, {'client_id': str(client_id), 'limit': '5', 'updated_since': since})
+        seen.extend(m['id'] for m in page['messages'])
+        since = page['updated_until']
+        if not page['has_more']:
+            break
+    checks.expect('updated_since: все сообщения по одному разу', seen, ids)
+
+
+def check_blob_dedup(checks, conn):
+    uploads = []
+    upload_bytes = bridge._upload_bytes
+    bridge._upload_bytes = lambda raw, key, mime: uploads.append(key) or f'https://check.local/{key}'
+    try:
+        raw = os.urandom(64)
+        first = bridge._store_blob(conn, raw, 'a.bin', 'application/octet-stream', 'bridge/check')
+        second = bridge._store_blob(conn, raw, 'b.bin', 'application/octet-stream', 'bridge/check')
+        other = bridge._store_blob(conn, raw, 'a.bin', 'application/octet-stream', 'crm/check')
+    finally:
+        bridge._upload_bytes = upload_bytes
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM storage_blobs WHERE url LIKE %s", ('https://check.local/%',))
+            conn.commit()
+    checks.expect('повтор файла не загружается', (second, len(uploads)), (first, 2))
+    checks.expect('другой префикс — своя ссылка', other != first, True)
+
+
+def check_import_reopen(checks, conn, partner_id):
+    jobs = {}
+    with conn.cursor() as cur:
+        for kind in ('transient', 'fatal'):
+            cur.execute("""
+                INSERT INTO bridge_import_jobs (partner_id, mailbox, date_from, date_to, uids, cursor_pos, total,
+                                                status, error, error_kind, attempts)
+                VALUES (%s, 'check@check.example', '2025-01-01', '2025-12-31', '{1,2,3}', 2, 3, 'error', 'x', %s, 5)
+                RETURNING id
+            """, (partner_id, kind))
+            jobs[kind] = cur.fetchone()[0]
+        conn.commit()
+    with conn.cursor(cursor_factory=bridge.RealDictCursor) as cur:
+        cur.execute(f"SELECT {bridge.IMPORT_JOB_COLUMNS} FROM bridge_import_jobs WHERE id = ANY(%s)", (list(jobs.values()),))
+        by_id = {r['id']: r for r in cur.fetchall()}
+    reopened = bridge._reopen_import_job(conn, by_id[jobs['transient']])
+    checks.expect('временный сбой: продолжается с курсора',
+                  (reopened['status'], reopened['attempts'], reopened['cursor_pos']), ('running', 0, 2))
+    kept = bridge._reopen_import_job(conn, by_id[jobs['fatal']])
+    checks.expect('постоянная ошибка: не продолжается', kept['status'], 'error')
+
+
+def check_backfill(checks, conn, partner_id):
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO bridge_messages (partner_id, channel, direction, sender_name, email_from, body)
+            VALUES (%s, 'email', 'in', 'check', 'Late@Check.example', '') RETURNING id
+        """, (partner_id,))
+        message_id = cur.fetchone()[0]
+        conn.commit()
+    checks.expect('полный проход без клиента', bridge._backfill_unlinked_emails(conn, partner_id), 0)
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO crm_clients (partner_id, company_name, contact_person, email)
+            VALUES (%s, 'check', '', 'late@check.example') RETURNING id
+        """, (partner_id,))
+        client_id = cur.fetchone()[0]
+        conn.commit()
+    checks.expect('инкрементальный проход после появления клиента',
+                  bridge._backfill_unlinked_emails(conn, partner_id, incremental=True), 1)
+    with conn.cursor() as cur:
+        cur.execute("SELECT client_id FROM bridge_messages WHERE id = %s", (message_id,))
+        checks.expect('письмо привязано к клиенту', cur.fetchone()[0], client_id)
+
+
+def cleanup(conn, partner_id):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM bridge_messages WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_conversations WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_folders WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM crm_clients WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_import_jobs WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_backfill_state WHERE partner_id = %s", (partner_id,))
+        conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--partner-id', type=int, default=990002, help='partner_id для данных проверок')
+    args = parser.parse_args()
+
+    checks = Checks()
+    check_folder_rules(checks)
+    check_cursors(checks)
+    check_outbox_retry(checks)
+    check_blob_keys(checks)
+
+    dsn = os.environ.get('DATABASE_URL')
+    if dsn:
+        conn = psycopg2.connect(dsn)
+        try:
+            cleanup(conn, args.partner_id)
+            check_folder_rules_sql(checks, conn, args.partner_id)
+            check_message_paging(checks, conn, args.partner_id)
+            check_blob_dedup(checks, conn)
+            check_import_reopen(checks, conn, args.partner_id)
+            check_backfill(checks, conn, args.partner_id)
+        finally:
+            cleanup(conn, args.partner_id)
+            conn.close()
+    else:
+        print('DATABASE_URL не задан: проверки на базе пропущены')
+
+    print(f"проверок: {checks.passed + checks.failed}, не прошло: {checks.failed}")
+    return 1 if checks.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,358 @@
+"""Бенчмарк почтового конвейера 'Радужного моста' (backend/bridge/index.py) без живых серверов beget.com.
+
+Поднимает локальные IMAP/SMTP-заглушки (bench/mail_standin.py) с синтетическим ящиком
+(число писем, размер текста, доля писем с вложениями и крупных писем настраиваются),
+подменяет хранилище файлов локальным и прогоняет через настоящий код моста три фазы:
+    import — import_range по INBOX и Sent до завершения задания;
+    sync   — sync_email по новым письмам, пришедшим после импорта;
+    send   — send_email с вложениями (первая попытка доставки — в самом запросе) и повторы drain_outbox.
+Для каждой фазы печатает писем в секунду, байты, отданные IMAP и принятые SMTP, объём,
+записанный в хранилище, число обращений к БД (execute + commit) и пиковую память
+(пик аллокаций Python по tracemalloc и максимальный RSS процесса).
+
+Нужна локальная Postgres со схемой проекта (применённые db_migrations), адрес — в
+DATABASE_URL. Данные бенчмарка пишутся под отдельным partner_id и удаляются до и после
+прогона (--keep оставляет их для разбора). Очередь bridge_outbox разбирается только по
+partner_id бенчмарка, чужие неотправленные письма не трогаются.
+
+Запуск из корня репозитория (нужны зависимости backend/bridge/requirements.txt):
+    DATABASE_URL=postgresql://localhost/bridge_bench python bench/bridge_ingest.py [--messages N] ...
+"""
+import argparse
+import base64
+import imaplib
+import json
+import os
+import random
+import resource
+import smtplib
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from email import policy
+from email.message import EmailMessage
+from email.utils import format_datetime, formataddr
+
+import psycopg2
+import psycopg2.extensions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'backend', 'bridge'))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import index as bridge  # noqa: E402
+import mail_standin  # noqa: E402
+
+BOX_ADDRESS = 'bench@bench.local'
+HISTORY_FROM, HISTORY_TO = '2025-01-01', '2025-12-31'
+STORAGE_KEY_ID = 'bench'
+SUBJECTS = [
+    'Коммерческое предложение', 'Счёт на оплату', 'Re: Договор поставки', 'Invoice', 'Заявка на расчёт',
+    'Акт сверки', 'Fwd: Тендерная документация', 'Вопрос по проекту', 'Newsletter', 'Уточнение сроков',
+]
+WORDS = ('проект дорога мост смета поставка срок оплата договор расчёт объект '
+         'delivery invoice schedule survey report').split()
+
+
+# ----------------------------------------------------------------- счётчики --
+
+class DbCounter:
+    """Обращения к БД: каждый execute/executemany и каждый commit/rollback — один запрос к серверу"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.round_trips = 0
+
+    def add(self):
+        with self.lock:
+            self.round_trips += 1
+
+
+DB = DbCounter()
+_counting_cursors = {}
+
+
+def _counting_cursor(factory):
+    if factory not in _counting_cursors:
+        class CountingCursor(factory):
+            def execute(self, query, vars=None):
+                DB.add()
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                DB.add()
+                return super().executemany(query, vars_list)
+
+        _counting_cursors[factory] = CountingCursor
+    return _counting_cursors[factory]
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _counting_cursor(factory)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        DB.add()
+        return super().commit()
+
+    def rollback(self):
+        DB.add()
+        return super().rollback()
+
+
+class StorageStandIn:
+    """Хранилище файлов вместо S3: put_object из _upload_bytes и чтение по ссылке для отправки"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.bytes_written = 0
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        with self.lock:
+            self.objects[Key] = data
+            self.bytes_written += len(data)
+
+    def fetch(self, url):
+        return self.objects[url.split('/bucket/', 1)[1]]
+
+
+# ------------------------------------------------------------ подмена сети --
+
+class PlainIMAP(imaplib.IMAP4):
+    def __init__(self, host, port, ssl_context=None, timeout=None):
+        super().__init__(host, port, timeout=timeout)
+
+
+class PlainSMTP(smtplib.SMTP):
+    def __init__(self, host, port, context=None, timeout=30):
+        super().__init__(host, port, timeout=timeout)
+
+
+def install_stand_ins(imap_port, smtp_port, storage, dsn):
+    imaplib.IMAP4_SSL = PlainIMAP
+    smtplib.SMTP_SSL = PlainSMTP
+    bridge.IMAP_HOST, bridge.IMAP_PORT = '127.0.0.1', imap_port
+    bridge.SMTP_HOST, bridge.SMTP_PORT = '127.0.0.1', smtp_port
+    bridge._s3_client = storage
+    bridge._fetch_url_bytes = storage.fetch
+
+    os.environ.update({
+        'EMAIL_ADDRESS': BOX_ADDRESS, 'EMAIL_PASSWORD': 'bench',
+        'AWS_ACCESS_KEY_ID': STORAGE_KEY_ID, 'AWS_SECRET_ACCESS_KEY': 'bench',
+    })
+    os.environ.pop('INFO_EMAIL_PASSWORD', None)  # синхронизируется только ящик бенчмарка
+
+    connect = psycopg2.connect
+    psycopg2.connect = lambda *args, **kwargs: connect(dsn, connection_factory=CountingConnection)
+
+
+# ------------------------------------------------------------ синтетика --
+
+def make_message(rng, n, args, sender, recipient, when):
+    """Синтетическое письмо: текст или HTML-версия, иногда без Message-ID, вложения по заданной доле"""
+    msg = EmailMessage()
+    msg['From'] = formataddr((f'Отправитель {sender.split("@")[0]}', sender))
+    msg['To'] = recipient
+    msg['Subject'] = f'{rng.choice(SUBJECTS)} №{n}'
+    msg['Date'] = format_datetime(when)
+    if rng.random() > 0.05:
+        msg['Message-ID'] = f'<bench-{args.seed}-{n}@bench.local>'
+
+    words = max(1, int(args.body_kb * 1024 * rng.uniform(0.5, 1.5)) // 8)
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    msg.set_content(text)
+    if rng.random() < 0.5:
+        msg.add_alternative(f'<html><body><div><p>{text}</p></div><style>p{{margin:0}}</style></body></html>', subtype='html')
+
+    roll = rng.random()
+    size_kb = args.large_kb if roll < args.large_ratio else args.attach_kb * rng.uniform(0.5, 1.5) if roll < args.attach_ratio else 0
+    if size_kb:
+        msg.add_attachment(rng.randbytes(int(size_kb * 1024)), maintype='application', subtype='pdf', filename=f'документ-{n}.pdf')
+    return msg.as_bytes(policy=policy.SMTP)
+
+
+def fill_mailbox(mailbox, rng, args):
+    """История за HISTORY_FROM..HISTORY_TO во входящих и отправленных; возвращает последний UID входящих"""
+    start = datetime.fromisoformat(HISTORY_FROM).replace(tzinfo=timezone.utc)
+    span = (datetime.fromisoformat(HISTORY_TO) - datetime.fromisoformat(HISTORY_FROM)).days
+    last_uid = 0
+    for n in range(args.messages):
+        when = start + timedelta(days=rng.randrange(span), seconds=rng.randrange(86400))
+        last_uid = mailbox.deliver('INBOX', make_message(rng, n, args, sender_address(rng, args), BOX_ADDRESS, when))
+    for n in range(args.sent):
+        when = start + timedelta(days=rng.randrange(span), seconds=rng.randrange(86400))
+        mailbox.deliver('Sent', make_message(rng, args.messages + n, args, BOX_ADDRESS, sender_address(rng, args), when))
+    return last_uid
+
+
+def sender_address(rng, args):
+    k = rng.randrange(args.senders)
+    return f'client{k}@firm{k % 17}.example'
+
+
+# ----------------------------------------------------------------- фазы --
+
+def call(func, conn, body):
+    response = func(conn, body)
+    data = json.loads(response['body'])
+    if response['statusCode'] != 200 or data.get('error'):
+        raise RuntimeError(f"{func.__name__}: {response['statusCode']} {data.get('error')}")
+    return data
+
+
+def run_import(conn, args):
+    imported = 0
+    for folder in ('INBOX', 'SENT'):
+        data = call(bridge.import_range, conn, {
+            'partner_id': args.partner_id, 'mailbox': BOX_ADDRESS, 'folder': folder,
+            'date_from': HISTORY_FROM, 'date_to': HISTORY_TO,
+        })
+        imported += data['imported']
+        while data['has_more']:
+            data = call(bridge.import_range, conn, {'partner_id': args.partner_id, 'job_id': data['job_id']})
+            imported += data['imported']
+    return imported
+
+
+def run_sync(conn, args, mailbox, rng, last_uid):
+    # письма, пришедшие после импорта: водяной знак синхронизации стоит на последнем старом UID
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO bridge_mailbox_sync_state (mailbox, folder, uidvalidity, last_uid, updated_at)
+            VALUES (%s, 'INBOX', %s, %s, NOW())
+            ON CONFLICT (mailbox, folder) DO UPDATE SET uidvalidity = EXCLUDED.uidvalidity, last_uid = EXCLUDED.last_uid
+        """, (BOX_ADDRESS, mailbox.uidvalidity, last_uid))
+        conn.commit()
+    now = datetime.now(timezone.utc)
+    for n in range(args.new):
+        mailbox.deliver('INBOX', make_message(rng, args.messages + args.sent + n, args, sender_address(rng, args), BOX_ADDRESS, now))
+    return measure_phase('sync', lambda: sync_until_idle(conn, args))
+
+
+def sync_until_idle(conn, args):
+    imported = 0
+    while True:
+        data = call(bridge.sync_email, conn, {'partner_id': args.partner_id})
+        imported += data['imported']
+        if not data['imported']:
+            return imported
+
+
+def run_send(conn, args, rng):
+    attachment = 'data:application/pdf;base64,' + base64.b64encode(rng.randbytes(args.attach_kb * 1024)).decode()
+    sent = 0
+    for n in range(args.send):
+        data = call(bridge.send_email, conn, {
+            'partner_id': args.partner_id, 'to': sender_address(rng, args), 'subject': f'Бенчмарк №{n}',
+            'body': 'Добрый день! Направляем материалы по проекту.',
+            'attachments': [{'name': 'смета.pdf', 'mime': 'application/pdf', 'data': attachment}] if rng.random() < args.attach_ratio else [],
+        })
+        sent += data['message']['delivery_status'] == 'sent'
+    # письма, отложенные после временной ошибки, добирает очередь
+    while True:
+        data = call(bridge.drain_outbox, conn, {'partner_id': args.partner_id})
+        sent += data['sent']
+        if not (data['sent'] or data['retried']):
+            return sent
+
+
+def measure_phase(name, func):
+    COUNTERS.reset()
+    DB.round_trips = 0
+    storage_before = STORAGE.bytes_written
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    messages = func()
+    elapsed = time.perf_counter() - started
+    return {
+        'phase': name,
+        'messages': messages,
+        'seconds': elapsed,
+        'imap_mb': COUNTERS.imap_bytes / 2 ** 20,
+        'smtp_mb': COUNTERS.smtp_bytes / 2 ** 20,
+        'storage_mb': (STORAGE.bytes_written - storage_before) / 2 ** 20,
+        'round_trips': DB.round_trips,
+        'peak_mb': tracemalloc.get_traced_memory()[1] / 2 ** 20,
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def cleanup(conn, partner_id):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM bridge_outbox WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_attachments WHERE message_id IN (SELECT id FROM bridge_messages WHERE partner_id = %s)", (partner_id,))
+        cur.execute("DELETE FROM bridge_messages WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_conversations WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM crm_clients WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_import_jobs WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_backfill_state WHERE partner_id = %s", (partner_id,))
+        cur.execute("DELETE FROM bridge_mailbox_sync_state WHERE mailbox = %s", (BOX_ADDRESS,))
+        cur.execute("DELETE FROM storage_blobs WHERE url LIKE %s", (f'%/projects/{STORAGE_KEY_ID}/bucket/%',))
+        conn.commit()
+
+
+COUNTERS = mail_standin.Counters()
+STORAGE = StorageStandIn()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=300, help='исторических писем во входящих (фаза import)')
+    parser.add_argument('--sent', type=int, default=60, help='исторических писем в отправленных (фаза import)')
+    parser.add_argument('--new', type=int, default=120, help='новых писем для фазы sync')
+    parser.add_argument('--send', type=int, default=40, help='писем в фазе send')
+    parser.add_argument('--senders', type=int, default=80, help='разных отправителей (каждый новый — автолид)')
+    parser.add_argument('--body-kb', type=float, default=4, help='средний размер текста письма, КБ')
+    parser.add_argument('--attach-ratio', type=float, default=0.25, help='доля писем с вложением')
+    parser.add_argument('--attach-kb', type=int, default=120, help='средний размер вложения, КБ')
+    parser.add_argument('--large-ratio', type=float, default=0.03, help='доля крупных писем (качаются частями)')
+    parser.add_argument('--large-kb', type=int, default=2500, help='размер вложения крупного письма, КБ')
+    parser.add_argument('--partner-id', type=int, default=990001, help='partner_id для данных бенчмарка')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='не удалять данные бенчмарка после прогона')
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        parser.error('нужен DATABASE_URL локальной базы со схемой проекта')
+
+    rng = random.Random(args.seed)
+    mailbox = mail_standin.Mailbox()
+    last_uid = fill_mailbox(mailbox, rng, args)
+    imap_port, smtp_port, stop = mail_standin.start(mailbox, COUNTERS)
+    install_stand_ins(imap_port, smtp_port, STORAGE, dsn)
+    tracemalloc.start()
+
+    conn = psycopg2.connect(dsn)
+    try:
+        cleanup(conn, args.partner_id)
+
+        rows = [
+            measure_phase('import', lambda: run_import(conn, args)),
+            run_sync(conn, args, mailbox, rng, last_uid),
+            measure_phase('send', lambda: run_send(conn, args, rng)),
+        ]
+    finally:
+        if not args.keep:
+            cleanup(conn, args.partner_id)
+        conn.close()
+        stop()
+
+    print(f"{'фаза':<8} {'писем':>6} {'сек':>7} {'писем/с':>8} {'IMAP, МБ':>9} {'SMTP, МБ':>9} "
+          f"{'файлы, МБ':>10} {'запросов БД':>12} {'на письмо':>10} {'пик Python, МБ':>15} {'RSS, МБ':>8}")
+    for r in rows:
+        per_message = r['round_trips'] / r['messages'] if r['messages'] else 0
+        print(f"{r['phase']:<8} {r['messages']:>6} {r['seconds']:>7.2f} {r['messages'] / r['seconds']:>8.1f} "
+              f"{r['imap_mb']:>9.1f} {r['smtp_mb']:>9.1f} {r['storage_mb']:>10.1f} {r['round_trips']:>12} "
+              f"{per_message:>10.1f} {r['peak_mb']:>15.1f} {r['rss_mb']:>8.0f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Бенчмарк извлечения текста из DOCX (generate-kp extract_text_from_docx) на крупных ТЗ.
+
+Сравнивает текущую реализацию (один проход по телу документа) с прежней, которая для каждого
+абзаца и каждой таблицы заново строила doc.paragraphs / doc.tables и искала в них свой
+элемент: проверяет, что результат совпадает байт в байт, и печатает время разбора.
+Документы генерируются на лету python-docx: разделы с заголовками, абзацы текста, таблицы
+с шапкой и без, объединённые ячейки, пустые абзацы и абзацы собственного стиля —
+примерно по 10 абзацев и полтаблицы на страницу.
+
+Запуск из корня репозитория (нужны зависимости backend/generate-kp/requirements.txt):
+    python bench/docx_extract.py [--pages 20,100,300] [--repeat N]
+"""
+import argparse
+import io
+import random
+import sys
+import os
+import time
+
+import docx
+from docx.enum.style import WD_STYLE_TYPE
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'backend', 'generate-kp'))
+
+from index import extract_text_from_docx  # noqa: E402
+
+WORDS = ('обследование участок дорога покрытие мост водоотвод смета объём работ срок '
+         'требование заказчик подрядчик документация проект ГОСТ СП км пикет').split()
+
+
+def legacy_extract_text_from_docx(data):
+    """Прежняя реализация extract_text_from_docx — эталон для сравнения результата и скорости"""
+    try:
+        doc = docx.Document(io.BytesIO(data))
+        parts = []
+
+        def get_cell_text(cell):
+            return ' '.join(p.text.strip() for p in cell.paragraphs if p.text.strip())
+
+        for block in doc.element.body:
+            tag = block.tag.split('}')[-1] if '}' in block.tag else block.tag
+            if tag == 'p':
+                para = None
+                for p in doc.paragraphs:
+                    if p._element is block:
+                        para = p
+                        break
+                if para and para.text.strip():
+                    style = para.style.name if para.style else ''
+                    if 'Heading' in style or 'heading' in style:
+                        parts.append(f'\n## {para.text.strip()}')
+                    else:
+                        parts.append(para.text.strip())
+            elif tag == 'tbl':
+                for tbl in doc.tables:
+                    if tbl._element is block:
+                        rows = tbl.rows
+                        if not rows:
+                            continue
+                        header_cells = [get_cell_text(c) for c in rows[0].cells]
+                        has_header = any(header_cells)
+                        if has_header:
+                            parts.append('\nТАБЛИЦА:')
+                            parts.append(' | '.join(header_cells))
+                            parts.append('-' * 40)
+                        for row in (rows[1:] if has_header else rows):
+                            row_texts = [get_cell_text(c) for c in row.cells]
+                            non_empty = [t for t in row_texts if t]
+                            if non_empty:
+                                if has_header:
+                                    pairs = []
+                                    for h, v in zip(header_cells, row_texts):
+                                        if v:
+                                            pairs.append(f'{h}: {v}' if h else v)
+                                    parts.append(', '.join(pairs))
+                                else:
+                                    parts.append(' | '.join(non_empty))
+                        break
+
+        return '\n'.join(parts)
+    except Exception as e:
+        return f'[Ошибка чтения DOCX: {e}]'
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def make_docx(pages, seed=1):
+    """Синтетическое ТЗ примерно на pages страниц"""
+    rng = random.Random(seed)
+    doc = docx.Document()
+    doc.styles.add_style('Пункт ТЗ', WD_STYLE_TYPE.PARAGRAPH)
+    for section in range(1, pages + 1):
+        doc.add_heading(f'{section}. {sentence(rng, 4)}', level=1 if section % 5 == 1 else 2)
+        for _ in range(rng.randint(6, 10)):
+            style = 'Пункт ТЗ' if rng.random() < 0.2 else None
+            doc.add_paragraph(sentence(rng, rng.randint(8, 40)), style=style)
+            if rng.random() < 0.1:
+                doc.add_paragraph('')
+        if section % 2 == 0:
+            cols = rng.randint(3, 6)
+            table = doc.add_table(rows=rng.randint(4, 12), cols=cols)
+            with_header = rng.random() < 0.7
+            for r, row in enumerate(table.rows):
+                for c, cell in enumerate(row.cells):
+                    if r == 0 and with_header:
+                        cell.text = f'Графа {c + 1}'
+                    elif r == 0 or rng.random() < 0.9:
+                        cell.text = sentence(rng, rng.randint(1, 6))
+            if len(table.rows) > 3:
+                table.cell(2, 0).merge(table.cell(2, 1))
+                table.cell(3, cols - 1).merge(table.cell(len(table.rows) - 1, cols - 1))
+    out = io.BytesIO()
+    doc.save(out)
+    return out.getvalue()
+
+
+def seconds_per_call(func, data, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', default='20,100,300', help='размеры документов в страницах, через запятую')
+    parser.add_argument('--repeat', type=int, default=3, help='прогонов на документ (берётся лучший)')
+    args = parser.parse_args()
+
+    mismatches = 0
+    print(f"{'страниц':>8} {'КБ':>8} {'символов':>10} {'было, мс':>10} {'стало, мс':>10} {'ускорение':>10}")
+    for pages in (int(p) for p in args.pages.split(',')):
+        data = make_docx(pages)
+        text = extract_text_from_docx(data)
+        if legacy_extract_text_from_docx(data) != text:
+            mismatches += 1
+            print(f'РАСХОЖДЕНИЕ: {pages} страниц')
+        old = seconds_per_call(legacy_extract_text_from_docx, data, args.repeat)
+        new = seconds_per_call(extract_text_from_docx, data, args.repeat)
+        print(f'{pages:>8} {len(data) / 1024:>8.1f} {len(text):>10} {old * 1000:>10.1f} {new * 1000:>10.1f} {old / new:>9.1f}x')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""Бенчмарк перевода HTML-писем в текст (bridge._html_to_text) на корпусе bench/html_corpus.
+
+Сравнивает текущую реализацию с прежней (шесть regex-проходов, в том числе '.*?' с возвратами
+по всему документу): проверяет, что на каждом файле корпуса результат совпадает, и печатает
+время на мегабайт.
+Кроме писем корпуса гоняет «рассылку» размером около мегабайта и патологическую разметку
+(незакрытые <script> и комментарии, '<script' без '>'), на которой поиск уходил в квадратичный перебор.
+
+Запуск из корня репозитория (нужны зависимости backend/bridge/requirements.txt):
+    python bench/html_to_text.py [--repeat N]
+"""
+import argparse
+import html as html_lib
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIR = os.path.join(ROOT, 'bench', 'html_corpus')
+sys.path.insert(0, os.path.join(ROOT, 'backend', 'bridge'))
+
+from index import _html_to_text  # noqa: E402
+
+
+def legacy_html_to_text(html):
+    """Прежняя реализация _html_to_text — эталон для сравнения результата и скорости"""
+    text = re.sub(r'<(script|style)[^>]*>.*?</\1>', ' ', html, flags=re.IGNORECASE | re.DOTALL)
+    text = re.sub(r'<!--.*?-->', ' ', text, flags=re.DOTALL)
+    text = re.sub(r'<(br|/p|/div|/tr|/li|/h[1-6])\s*/?>', '\n', text, flags=re.IGNORECASE)
+    text = re.sub(r'<[^>]+>', ' ', text)
+    text = html_lib.unescape(text)
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r'\n\s*\n+', '\n\n', text)
+    return text.strip()
+
+
+def load_corpus():
+    docs = {}
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        if name.endswith('.html'):
+            with open(os.path.join(CORPUS_DIR, name), encoding='utf-8') as f:
+                docs[name] = f.read()
+    # крупная рассылка: письма корпуса подряд до ~1 МБ
+    joined = '\n'.join(docs.values())
+    docs['(рассылка ~1 МБ)'] = joined * max(1, (1024 * 1024) // len(joined.encode('utf-8')))
+    return docs
+
+
+def pathological():
+    return {
+        '(незакрытые <script>, 200 КБ)': '<script>x' * 22000,
+        '(незакрытые комментарии, 200 КБ)': '<!--a' * 40000,
+        '(<script без \'>\', 200 КБ)': '<script a' * 22000,
+    }
+
+
+def seconds_per_call(func, text, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='прогонов на документ (берётся лучший)')
+    args = parser.parse_args()
+
+    mismatches = 0
+    print(f"{'документ':<36} {'КБ':>8} {'было, мс/МБ':>14} {'стало, мс/МБ':>14} {'ускорение':>10}")
+    for docs, repeat in ((load_corpus(), args.repeat), (pathological(), 1)):
+        for name, text in docs.items():
+            if legacy_html_to_text(text) != _html_to_text(text):
+                mismatches += 1
+                print(f'РАСХОЖДЕНИЕ: {name}')
+            mb = len(text.encode('utf-8')) / (1024 * 1024)
+            old = seconds_per_call(legacy_html_to_text, text, repeat)
+            new = seconds_per_call(_html_to_text, text, repeat)
+            print(f'{name:<36} {mb * 1024:>8.1f} {old * 1000 / mb:>14.1f} {new * 1000 / mb:>14.1f} {old / new:>9.1f}x')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+"""Локальные IMAP- и SMTP-заглушки для бенчмарка моста (bench/bridge_ingest.py).
+
+Реализуют ровно то подмножество протоколов, которым пользуется backend/bridge/index.py:
+LOGIN, LIST, SELECT/EXAMINE (с UIDVALIDITY), UID SEARCH (ALL, UID n:*, SINCE/BEFORE),
+FETCH/UID FETCH (RFC822.SIZE, BODY.PEEK[HEADER.FIELDS (...)], BODY[] и частичный
+BODY[]<offset.length>), CLOSE, LOGOUT; SMTP — EHLO, AUTH PLAIN, MAIL/RCPT/DATA, NOOP, QUIT.
+Работают без TLS: бенчмарк подменяет IMAP4_SSL/SMTP_SSL на обычные соединения.
+Считают байты, отданные клиенту (IMAP) и принятые от него (SMTP)."""
+import base64
+import re
+import socketserver
+import threading
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+
+class Counters:
+    """Счётчики трафика заглушек; обнуляются перед каждой фазой бенчмарка"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.imap_bytes = 0
+            self.imap_commands = 0
+            self.smtp_messages = 0
+            self.smtp_bytes = 0
+
+    def add(self, **values):
+        with self.lock:
+            for name, value in values.items():
+                setattr(self, name, getattr(self, name) + value)
+
+
+class Mailbox:
+    """Папки одного ящика: {имя: [(uid, дата, сырое письмо), ...]}, UID растут с 1"""
+
+    def __init__(self, folders=('INBOX', 'Sent')):
+        self.lock = threading.Lock()
+        self.folders = {name: [] for name in folders}
+        self.uidvalidity = 1
+
+    def deliver(self, folder, raw):
+        """Кладёт письмо в папку, как почтовый сервер при доставке; возвращает его UID"""
+        try:
+            date = parsedate_to_datetime(re.search(rb'^Date: (.+?)\r?$', raw, re.M | re.I).group(1).decode())
+        except (AttributeError, TypeError, ValueError):
+            date = datetime.now()
+        with self.lock:
+            messages = self.folders[folder]
+            uid = messages[-1][0] + 1 if messages else 1
+            messages.append((uid, date.date(), raw))
+        return uid
+
+    def snapshot(self, folder):
+        with self.lock:
+            return list(self.folders.get(folder, []))
+
+
+# --------------------------------------------------------------------- IMAP --
+
+_ID_SET = re.compile(r'^[\d:*,]+$')
+_PARTIAL = re.compile(r'BODY(?:\.PEEK)?\[\]<(\d+)\.(\d+)>', re.I)
+_HEADER_FIELDS = re.compile(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]', re.I)
+
+
+def _parse_id_set(id_set, ids):
+    """'1:3,7,9:*' -> подмножество ids (отсортированные UID или номера). Как и настоящий сервер,
+    'n:*' при n больше последнего id возвращает последнее письмо."""
+    if not ids:
+        return []
+    last = ids[-1]
+    wanted = set()
+    for part in id_set.split(','):
+        if ':' in part:
+            a, b = part.split(':', 1)
+            a = last if a == '*' else int(a)
+            b = last if b == '*' else int(b)
+            lo, hi = min(a, b), max(a, b)
+            wanted.update(i for i in ids if lo <= i <= hi)
+        else:
+            wanted.add(last if part == '*' else int(part))
+    return [i for i in ids if i in wanted]
+
+
+def _header_fields(raw, names):
+    """Только перечисленные заголовки письма (со строками-продолжениями) и пустая строка"""
+    head = raw.split(b'\r\n\r\n', 1)[0]
+    wanted = {n.upper().encode() for n in names}
+    out, keep = [], False
+    for line in head.split(b'\r\n'):
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                out.append(line)
+            continue
+        keep = line.split(b':', 1)[0].strip().upper() in wanted
+        if keep:
+            out.append(line)
+    return b'\r\n'.join(out) + b'\r\n\r\n'
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data)
+        self.server.counters.add(imap_bytes=len(data))
+
+    def handle(self):
+        self.folder = None
+        self.send(b'* OK [CAPABILITY IMAP4rev1 AUTH=PLAIN] bench IMAP ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            self.server.counters.add(imap_commands=1)
+            parts = line.decode('utf-8', 'replace').rstrip('\r\n').split(' ', 2)
+            tag = parts[0]
+            command = parts[1].upper() if len(parts) > 1 else ''
+            args = parts[2] if len(parts) > 2 else ''
+            by_uid = command == 'UID'
+            if by_uid:
+                sub = args.split(' ', 1)
+                command, args = sub[0].upper(), (sub[1] if len(sub) > 1 else '')
+            try:
+                if not self.dispatch(tag, command, args, by_uid):
+                    return
+            except Exception as exc:
+                self.send(f'{tag} BAD {exc}\r\n'.encode())
+
+    def dispatch(self, tag, command, args, by_uid):
+        if command == 'CAPABILITY':
+            self.send(b'* CAPABILITY IMAP4rev1 AUTH=PLAIN\r\n')
+        elif command == 'LOGIN':
+            pass
+        elif command == 'LIST':
+            for name in self.server.mailbox.folders:
+                self.send(f'* LIST (\\HasNoChildren) "/" "{name}"\r\n'.encode())
+        elif command in ('SELECT', 'EXAMINE'):
+            name = args.strip().strip('"')
+            if name not in self.server.mailbox.folders:
+                self.send(f'{tag} NO no such folder\r\n'.encode())
+                return True
+            self.folder = name
+            messages = self.server.mailbox.snapshot(name)
+            uidnext = messages[-1][0] + 1 if messages else 1
+            self.send(
+                b'* FLAGS (\\Seen)\r\n'
+                + f'* {len(messages)} EXISTS\r\n* 0 RECENT\r\n'.encode()
+                + f'* OK [UIDVALIDITY {self.server.mailbox.uidvalidity}] UIDs valid\r\n'.encode()
+                + f'* OK [UIDNEXT {uidnext}] next UID\r\n'.encode()
+            )
+            mode = 'READ-ONLY' if command == 'EXAMINE' else 'READ-WRITE'
+            self.send(f'{tag} OK [{mode}] {command} completed\r\n'.encode())
+            return True
+        elif command == 'SEARCH':
+            self.search(args)
+        elif command == 'FETCH':
+            self.fetch(args, by_uid)
+        elif command in ('NOOP', 'CLOSE'):
+            pass
+        elif command == 'LOGOUT':
+            self.send(b'* BYE bench IMAP logging out\r\n')
+            self.send(f'{tag} OK LOGOUT completed\r\n'.encode())
+            return False
+        else:
+            self.send(f'{tag} BAD unsupported command {command}\r\n'.encode())
+            return True
+        self.send(f'{tag} OK {command} completed\r\n'.encode())
+        return True
+
+    def search(self, criteria):
+        messages = self.server.mailbox.snapshot(self.folder)
+        tokens = re.findall(r'"[^"]*"|[^\s()]+', criteria)
+        selected = messages
+        i = 0
+        while i < len(tokens):
+            token = tokens[i].upper()
+            if token == 'UID':
+                wanted = set(_parse_id_set(tokens[i + 1], [m[0] for m in messages]))
+                selected = [m for m in selected if m[0] in wanted]
+                i += 2
+            elif token in ('SINCE', 'BEFORE'):
+                day = datetime.strptime(tokens[i + 1].strip('"'), '%d-%b-%Y').date()
+                selected = [m for m in selected if (m[1] >= day if token == 'SINCE' else m[1] < day)]
+                i += 2
+            else:
+                i += 1
+        self.send(('* SEARCH ' + ' '.join(str(m[0]) for m in selected)).rstrip().encode() + b'\r\n')
+
+    def fetch(self, args, by_uid):
+        id_set, items = args.split(' ', 1)
+        if not _ID_SET.match(id_set):
+            raise ValueError('bad id set')
+        messages = self.server.mailbox.snapshot(self.folder)
+        keys = [m[0] for m in messages] if by_uid else list(range(1, len(messages) + 1))
+        by_key = dict(zip(keys, enumerate(messages, 1)))
+        partial = _PARTIAL.search(items)
+        fields = _HEADER_FIELDS.search(items)
+        whole = re.search(r'BODY(?:\.PEEK)?\[\]', items, re.I)
+        for key in _parse_id_set(id_set, keys):
+            seq, (uid, _, raw) = by_key[key]
+            meta = f'UID {uid}'
+            if 'RFC822.SIZE' in items.upper():
+                meta += f' RFC822.SIZE {len(raw)}'
+            if fields:
+                section, literal = f'BODY[HEADER.FIELDS ({fields.group(1)})]', _header_fields(raw, fields.group(1).split())
+            elif partial:
+                offset, length = int(partial.group(1)), int(partial.group(2))
+                section, literal = f'BODY[]<{offset}>', raw[offset:offset + length]
+            elif whole:
+                section, literal = 'BODY[]', raw
+            else:
+                self.send(f'* {seq} FETCH ({meta})\r\n'.encode())
+                continue
+            self.send(f'* {seq} FETCH ({meta} {section} {{{len(literal)}}}\r\n'.encode() + literal + b')\r\n')
+
+
+# --------------------------------------------------------------------- SMTP --
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, text):
+        self.wfile.write(text.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 bench SMTP ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250-bench\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME')
+            elif verb == 'AUTH':
+                parts = command.split()
+                if len(parts) < 3:
+                    self.reply('334 ')
+                    base64.b64decode(self.rfile.readline().strip() or b'')
+                self.reply('235 authenticated')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 end with <CRLF>.<CRLF>')
+                size = 0
+                while True:
+                    chunk = self.rfile.readline()
+                    if not chunk or chunk == b'.\r\n':
+                        break
+                    size += len(chunk)
+                self.server.counters.add(smtp_messages=1, smtp_bytes=size)
+                self.reply('250 queued')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 unsupported')
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start(mailbox, counters, host='127.0.0.1'):
+    """Запускает IMAP- и SMTP-заглушки в фоновых потоках на свободных портах.
+    Возвращает (imap_port, smtp_port, stop)."""
+    imap = _Server((host, 0), _ImapHandler)
+    imap.mailbox, imap.counters = mailbox, counters
+    smtp = _Server((host, 0), _SmtpHandler)
+    smtp.counters = counters
+    for server in (imap, smtp):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop():
+        for server in (imap, smtp):
+            server.shutdown()
+            server.server_close()
+
+    return imap.server_address[1], smtp.server_address[1], stop
@@ -0,0 +1,12 @@
+-- Состояние инкрементальной синхронизации IMAP по каждому ящику/папке:
+-- UIDVALIDITY папки и максимальный уже обработанный UID. При очередной проверке почты
+-- запрашиваются только письма с UID больше сохранённого (UID SEARCH UID n:*),
+-- а при смене UIDVALIDITY на сервере состояние сбрасывается.
+CREATE TABLE IF NOT EXISTS bridge_mailbox_sync_state (
+    mailbox VARCHAR(255) NOT NULL,
+    folder VARCHAR(255) NOT NULL DEFAULT 'INBOX',
+    uidvalidity BIGINT NOT NULL,
+    last_uid BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (mailbox, folder)
+);
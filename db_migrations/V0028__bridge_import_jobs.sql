@@ -0,0 +1,23 @@
+-- Фоновый импорт исторической почты: задание хранит список UID писем за период и курсор,
+-- до которого импорт уже дошёл. Каждый вызов продолжает с курсора, пока не обработает весь список.
+CREATE TABLE IF NOT EXISTS bridge_import_jobs (
+    id SERIAL PRIMARY KEY,
+    partner_id INTEGER NOT NULL,
+    mailbox VARCHAR(255) NOT NULL,
+    folder VARCHAR(20) NOT NULL DEFAULT 'INBOX',   -- логическое имя: 'INBOX' | 'SENT'
+    real_folder VARCHAR(255),                      -- имя папки на IMAP-сервере
+    date_from DATE NOT NULL,
+    date_to DATE NOT NULL,
+    uidvalidity BIGINT,
+    uids BIGINT[] NOT NULL DEFAULT '{}',
+    cursor_pos INTEGER NOT NULL DEFAULT 0,         -- сколько UID из списка уже обработано
+    total INTEGER NOT NULL DEFAULT 0,
+    imported INTEGER NOT NULL DEFAULT 0,
+    status VARCHAR(20) NOT NULL DEFAULT 'running', -- 'running' | 'done' | 'error'
+    error TEXT,
+    locked_until TIMESTAMP,                        -- защита от одновременной обработки одного задания
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_bridge_import_jobs_partner ON bridge_import_jobs(partner_id, created_at DESC);
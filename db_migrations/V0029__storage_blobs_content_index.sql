@@ -0,0 +1,11 @@
+-- Общий индекс загруженных файлов по содержимому: sha256 -> ключ в S3 и публичная ссылка.
+-- Все места загрузки (вложения моста, депозитарий, документы сделок, аватары экипажа) сначала
+-- ищут файл здесь — повторная загрузка того же файла стоит одного запроса, а не put_object.
+CREATE TABLE IF NOT EXISTS storage_blobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    s3_key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    size_bytes BIGINT NOT NULL,
+    mime VARCHAR(200),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
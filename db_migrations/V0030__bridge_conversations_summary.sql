@@ -0,0 +1,133 @@
+-- Сводка диалогов "Радужного моста": последнее сообщение по каждому клиенту, отдельно для
+-- всех каналов ('all'), каждого канала ('channel:<канал>') и каждого почтового ящика
+-- ('mailbox:<адрес>'). Список диалогов читается отсюда постранично по времени последней
+-- активности и не сканирует всю историю переписки партнёра.
+CREATE TABLE IF NOT EXISTS bridge_conversations (
+    client_id INTEGER NOT NULL,
+    scope VARCHAR(300) NOT NULL,
+    partner_id INTEGER NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    last_channel VARCHAR(20),
+    last_message TEXT,
+    last_direction VARCHAR(10),
+    last_mailbox VARCHAR(255),
+    last_message_created_at TIMESTAMP,
+    PRIMARY KEY (client_id, scope)
+);
+
+CREATE INDEX IF NOT EXISTS idx_bridge_conversations_feed
+    ON bridge_conversations(partner_id, scope, last_message_created_at DESC, client_id DESC);
+
+-- Учитывает одно сообщение в сводке (если оно новее уже сохранённого последнего)
+CREATE OR REPLACE FUNCTION bridge_conversations_touch(m bridge_messages) RETURNS void AS $$
+BEGIN
+    INSERT INTO bridge_conversations (
+        client_id, scope, partner_id, last_message_id, last_channel, last_message,
+        last_direction, last_mailbox, last_message_created_at
+    )
+    SELECT m.client_id, s.scope, m.partner_id, m.id, m.channel, LEFT(m.body, 1000),
+           m.direction, m.mailbox, m.created_at
+    FROM unnest(
+        ARRAY['all', 'channel:' || m.channel]
+        || CASE WHEN m.mailbox IS NOT NULL THEN ARRAY['mailbox:' || m.mailbox] ELSE ARRAY[]::TEXT[] END
+    ) AS s(scope)
+    ON CONFLICT (client_id, scope) DO UPDATE SET
+        partner_id = EXCLUDED.partner_id,
+        last_message_id = EXCLUDED.last_message_id,
+        last_channel = EXCLUDED.last_channel,
+        last_message = EXCLUDED.last_message,
+        last_direction = EXCLUDED.last_direction,
+        last_mailbox = EXCLUDED.last_mailbox,
+        last_message_created_at = EXCLUDED.last_message_created_at
+    WHERE (bridge_conversations.last_message_created_at, bridge_conversations.last_message_id)
+        <= (EXCLUDED.last_message_created_at, EXCLUDED.last_message_id);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пересобирает сводку клиента целиком (после удаления или перепривязки сообщений)
+CREATE OR REPLACE FUNCTION bridge_conversations_refresh(p_client_id INTEGER) RETURNS void AS $$
+BEGIN
+    DELETE FROM bridge_conversations WHERE client_id = p_client_id;
+    PERFORM bridge_conversations_touch(m)
+    FROM bridge_messages m
+    WHERE m.client_id = p_client_id AND m.is_duplicate = FALSE;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bridge_messages_conversations_row_trg() RETURNS trigger AS $$
+BEGIN
+    IF NEW.client_id IS NOT NULL AND NOT NEW.is_duplicate THEN
+        PERFORM bridge_conversations_touch(NEW);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Перепривязка и пометка дублей обновляют сразу много сообщений одного клиента: сводку
+-- прежнего клиента пересобираем один раз за запрос, новому клиенту учитываем только
+-- изменившиеся строки. Триггер уровня запроса с таблицами переходов срабатывает на любой
+-- UPDATE (с transition tables нельзя задать список колонок), но сам отбирает строки,
+-- у которых сменился client_id или is_duplicate, поэтому обычные обновления (is_read,
+-- folder_id) стоят одного соединения old_rows с new_rows.
+CREATE OR REPLACE FUNCTION bridge_messages_conversations_update_trg() RETURNS trigger AS $$
+BEGIN
+    PERFORM bridge_conversations_refresh(d.client_id)
+    FROM (
+        SELECT DISTINCT o.client_id
+        FROM old_rows o JOIN new_rows n ON n.id = o.id
+        WHERE o.client_id IS NOT NULL
+          AND (o.client_id IS DISTINCT FROM n.client_id OR (n.is_duplicate AND NOT o.is_duplicate))
+    ) d;
+    PERFORM bridge_conversations_touch(m)
+    FROM old_rows o
+    JOIN new_rows n ON n.id = o.id
+    JOIN bridge_messages m ON m.id = n.id
+    WHERE n.client_id IS NOT NULL AND NOT n.is_duplicate
+      AND (o.client_id IS DISTINCT FROM n.client_id OR o.is_duplicate);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Удаление переписки затрагивает много строк одного клиента: пересобираем сводку
+-- один раз на клиента за запрос, а не на каждую удалённую строку
+CREATE OR REPLACE FUNCTION bridge_messages_conversations_delete_trg() RETURNS trigger AS $$
+BEGIN
+    PERFORM bridge_conversations_refresh(d.client_id)
+    FROM (SELECT DISTINCT client_id FROM old_rows WHERE client_id IS NOT NULL) d;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_bridge_messages_conversations_row ON bridge_messages;
+CREATE TRIGGER trg_bridge_messages_conversations_row
+    AFTER INSERT ON bridge_messages
+    FOR EACH ROW EXECUTE PROCEDURE bridge_messages_conversations_row_trg();
+
+DROP TRIGGER IF EXISTS trg_bridge_messages_conversations_update ON bridge_messages;
+CREATE TRIGGER trg_bridge_messages_conversations_update
+    AFTER UPDATE ON bridge_messages
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE bridge_messages_conversations_update_trg();
+
+DROP TRIGGER IF EXISTS trg_bridge_messages_conversations_delete ON bridge_messages;
+CREATE TRIGGER trg_bridge_messages_conversations_delete
+    AFTER DELETE ON bridge_messages
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE bridge_messages_conversations_delete_trg();
+
+-- Начальное заполнение сводки по уже накопленной переписке
+INSERT INTO bridge_conversations (
+    client_id, scope, partner_id, last_message_id, last_channel, last_message,
+    last_direction, last_mailbox, last_message_created_at
+)
+SELECT DISTINCT ON (m.client_id, s.scope)
+    m.client_id, s.scope, m.partner_id, m.id, m.channel, LEFT(m.body, 1000),
+    m.direction, m.mailbox, m.created_at
+FROM bridge_messages m
+CROSS JOIN LATERAL unnest(
+    ARRAY['all', 'channel:' || m.channel]
+    || CASE WHEN m.mailbox IS NOT NULL THEN ARRAY['mailbox:' || m.mailbox] ELSE ARRAY[]::TEXT[] END
+) AS s(scope)
+WHERE m.client_id IS NOT NULL AND m.is_duplicate = FALSE
+ORDER BY m.client_id, s.scope, m.created_at DESC, m.id DESC
+ON CONFLICT (client_id, scope) DO NOTHING;
@@ -0,0 +1,21 @@
+-- Время последнего изменения сообщения (прочитано, перенесено в папку, перепривязано к клиенту):
+-- клиенты, которые опрашивают переписку, забирают только новые и изменённые строки (updated_since)
+ALTER TABLE bridge_messages ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+UPDATE bridge_messages SET updated_at = created_at WHERE updated_at IS DISTINCT FROM created_at;
+
+CREATE OR REPLACE FUNCTION bridge_messages_touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_bridge_messages_updated_at ON bridge_messages;
+CREATE TRIGGER trg_bridge_messages_updated_at
+    BEFORE UPDATE ON bridge_messages
+    FOR EACH ROW EXECUTE PROCEDURE bridge_messages_touch_updated_at();
+
+-- Постраничная лента сообщений клиента и выборка изменений с момента последнего опроса
+CREATE INDEX IF NOT EXISTS idx_bridge_messages_client_created ON bridge_messages(client_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_bridge_messages_client_updated ON bridge_messages(client_id, updated_at);
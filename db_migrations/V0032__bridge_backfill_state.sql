@@ -0,0 +1,38 @@
+-- Водяной знак привязки писем без клиента к карточкам CRM: запоминаем время начала прохода,
+-- следующий проход смотрит только на письма (bridge_messages.updated_at) и адреса клиентов
+-- (crm_clients.email_updated_at), изменённые после него с запасом на долгие транзакции.
+-- NULL — следующий проход полный.
+CREATE TABLE IF NOT EXISTS bridge_backfill_state (
+    partner_id INTEGER PRIMARY KEY,
+    last_run_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Когда у клиента появился или сменился email (updated_at карточки CRM ведёт не везде)
+ALTER TABLE crm_clients ADD COLUMN IF NOT EXISTS email_updated_at TIMESTAMP;
+
+CREATE OR REPLACE FUNCTION crm_clients_touch_email_updated_at() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' OR NEW.email IS DISTINCT FROM OLD.email THEN
+        NEW.email_updated_at := NOW();
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_crm_clients_email_updated_at ON crm_clients;
+CREATE TRIGGER trg_crm_clients_email_updated_at
+    BEFORE INSERT OR UPDATE OF email ON crm_clients
+    FOR EACH ROW EXECUTE PROCEDURE crm_clients_touch_email_updated_at();
+
+-- Сопоставление письма и клиента идёт по lower(email)
+CREATE INDEX IF NOT EXISTS idx_crm_clients_partner_email_lower ON crm_clients(partner_id, LOWER(email));
+CREATE INDEX IF NOT EXISTS idx_crm_clients_partner_email_updated
+    ON crm_clients(partner_id, email_updated_at)
+    WHERE email_updated_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_bridge_messages_unlinked_from
+    ON bridge_messages(partner_id, LOWER(email_from))
+    WHERE channel = 'email' AND client_id IS NULL;
+CREATE INDEX IF NOT EXISTS idx_bridge_messages_unlinked_updated
+    ON bridge_messages(partner_id, updated_at)
+    WHERE channel = 'email' AND client_id IS NULL;
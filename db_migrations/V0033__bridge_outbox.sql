@@ -0,0 +1,30 @@
+-- Очередь исходящих писем: send_email сохраняет письмо в переписку и ставит его в очередь,
+-- а доставкой по SMTP (с повторами при временных ошибках) занимается drain_outbox.
+-- Текст, получатели и вложения берутся из bridge_messages / bridge_attachments по message_id.
+CREATE TABLE IF NOT EXISTS bridge_outbox (
+    id SERIAL PRIMARY KEY,
+    message_id INTEGER NOT NULL REFERENCES bridge_messages(id),
+    partner_id INTEGER NOT NULL,
+    mailbox VARCHAR(255) NOT NULL,
+    signature_html TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',  -- pending | sending | sent | failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until TIMESTAMP,
+    last_error TEXT,
+    sent_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Выборка писем, которые пора отправить (в том числе зависших в sending после обрыва функции)
+CREATE INDEX IF NOT EXISTS idx_bridge_outbox_due ON bridge_outbox(next_attempt_at, id) WHERE status IN ('pending', 'sending');
+CREATE INDEX IF NOT EXISTS idx_bridge_outbox_message ON bridge_outbox(message_id);
+
+-- Статус доставки исходящего письма для интерфейса: queued | sent | failed
+-- (NULL у входящих и у писем, отправленных до появления очереди)
+ALTER TABLE bridge_messages ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20);
+ALTER TABLE bridge_messages ADD COLUMN IF NOT EXISTS delivery_error TEXT;
+
+-- Вложение, уже лежащее в хранилище, привязывается к письму по ссылке; размер берётся отсюда
+CREATE INDEX IF NOT EXISTS idx_storage_blobs_url ON storage_blobs(url);
@@ -0,0 +1,72 @@
+-- Версии привязок Telegram-чатов к клиентам CRM и к сделкам EVDEN 2.0. Мост и evden2-telegram
+-- кэшируют в памяти контейнера, какому клиенту / какой сделке принадлежит chat_id, и сверяют
+-- версию одним запросом на пачку апдейтов: любое изменение telegram_chat_id / telegram_username
+-- (в том числе из карточки клиента или сделки) увеличивает версию и сбрасывает кэш.
+CREATE TABLE IF NOT EXISTS telegram_link_versions (
+    scope VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO telegram_link_versions (scope, version) VALUES ('crm_clients', 0), ('evden_deals', 0)
+ON CONFLICT (scope) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION crm_clients_bump_telegram_links() RETURNS trigger AS $$
+BEGIN
+    UPDATE telegram_link_versions SET version = version + 1 WHERE scope = 'crm_clients';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_crm_clients_telegram_links_ins ON crm_clients;
+CREATE TRIGGER trg_crm_clients_telegram_links_ins
+    AFTER INSERT ON crm_clients
+    FOR EACH ROW
+    WHEN (NEW.telegram_chat_id IS NOT NULL OR NEW.telegram_username IS NOT NULL)
+    EXECUTE PROCEDURE crm_clients_bump_telegram_links();
+
+DROP TRIGGER IF EXISTS trg_crm_clients_telegram_links_upd ON crm_clients;
+CREATE TRIGGER trg_crm_clients_telegram_links_upd
+    AFTER UPDATE OF telegram_chat_id, telegram_username ON crm_clients
+    FOR EACH ROW
+    WHEN (OLD.telegram_chat_id IS DISTINCT FROM NEW.telegram_chat_id
+          OR OLD.telegram_username IS DISTINCT FROM NEW.telegram_username)
+    EXECUTE PROCEDURE crm_clients_bump_telegram_links();
+
+DROP TRIGGER IF EXISTS trg_crm_clients_telegram_links_del ON crm_clients;
+CREATE TRIGGER trg_crm_clients_telegram_links_del
+    AFTER DELETE ON crm_clients
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE crm_clients_bump_telegram_links();
+
+-- Поиск клиента по chat_id / username пачкой (= ANY) для апдейтов, которых нет в кэше
+CREATE INDEX IF NOT EXISTS idx_crm_clients_telegram_chat ON crm_clients(telegram_chat_id) WHERE telegram_chat_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_crm_clients_telegram_username ON crm_clients(telegram_username) WHERE telegram_username IS NOT NULL;
+
+-- То же для сделок EVDEN 2.0
+CREATE OR REPLACE FUNCTION evden_deals_bump_telegram_links() RETURNS trigger AS $$
+BEGIN
+    UPDATE telegram_link_versions SET version = version + 1 WHERE scope = 'evden_deals';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_evden_deals_telegram_links_ins ON evden_deals;
+CREATE TRIGGER trg_evden_deals_telegram_links_ins
+    AFTER INSERT ON evden_deals
+    FOR EACH ROW
+    WHEN (NEW.telegram_chat_id IS NOT NULL OR NEW.telegram_username IS NOT NULL)
+    EXECUTE PROCEDURE evden_deals_bump_telegram_links();
+
+DROP TRIGGER IF EXISTS trg_evden_deals_telegram_links_upd ON evden_deals;
+CREATE TRIGGER trg_evden_deals_telegram_links_upd
+    AFTER UPDATE OF telegram_chat_id, telegram_username ON evden_deals
+    FOR EACH ROW
+    WHEN (OLD.telegram_chat_id IS DISTINCT FROM NEW.telegram_chat_id
+          OR OLD.telegram_username IS DISTINCT FROM NEW.telegram_username)
+    EXECUTE PROCEDURE evden_deals_bump_telegram_links();
+
+DROP TRIGGER IF EXISTS trg_evden_deals_telegram_links_del ON evden_deals;
+CREATE TRIGGER trg_evden_deals_telegram_links_del
+    AFTER DELETE ON evden_deals
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE evden_deals_bump_telegram_links();
@@ -0,0 +1,103 @@
+-- Полнотекстовый поиск по переписке "Радужного моста" (resource=search): тема, отправитель,
+-- имена вложений и текст сообщения. Документ хранится отдельно от bridge_messages, чтобы
+-- не раздувать выборки m.* и не трогать updated_at при пересчёте. Русская и английская
+-- конфигурации объединяются: запрос ищется по обеим.
+CREATE TABLE IF NOT EXISTS bridge_message_search (
+    message_id INTEGER PRIMARY KEY REFERENCES bridge_messages(id) ON DELETE CASCADE,
+    document TSVECTOR NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_bridge_message_search_document ON bridge_message_search USING GIN (document);
+
+-- Текст одного поля с весом: A — тема, B — отправитель, C — вложения, D — текст
+CREATE OR REPLACE FUNCTION bridge_search_weighted(p_text TEXT, p_weight "char") RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('russian', COALESCE(p_text, '')) || to_tsvector('english', COALESCE(p_text, '')), p_weight);
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Пересчитывает документы поиска для набора сообщений
+CREATE OR REPLACE FUNCTION bridge_search_refresh(p_ids INTEGER[]) RETURNS void AS $$
+BEGIN
+    INSERT INTO bridge_message_search (message_id, document)
+    SELECT m.id,
+           bridge_search_weighted(m.subject, 'A')
+           || bridge_search_weighted(concat_ws(' ', m.sender_name, m.email_from), 'B')
+           || bridge_search_weighted(a.file_names, 'C')
+           || bridge_search_weighted(m.body, 'D')
+    FROM bridge_messages m
+    LEFT JOIN LATERAL (
+        SELECT string_agg(file_name, ' ') AS file_names FROM bridge_attachments WHERE message_id = m.id
+    ) a ON TRUE
+    WHERE m.id = ANY(p_ids)
+    ON CONFLICT (message_id) DO UPDATE SET document = EXCLUDED.document;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Новые сообщения сохраняются пачками (execute_values): один пересчёт на запрос
+CREATE OR REPLACE FUNCTION bridge_messages_search_insert_trg() RETURNS trigger AS $$
+BEGIN
+    PERFORM bridge_search_refresh(ARRAY(SELECT id FROM new_rows));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bridge_messages_search_update_trg() RETURNS trigger AS $$
+BEGIN
+    PERFORM bridge_search_refresh(ARRAY[NEW.id]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bridge_attachments_search_insert_trg() RETURNS trigger AS $$
+BEGIN
+    PERFORM bridge_search_refresh(ARRAY(SELECT DISTINCT message_id FROM new_rows));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bridge_attachments_search_delete_trg() RETURNS trigger AS $$
+BEGIN
+    PERFORM bridge_search_refresh(ARRAY(SELECT DISTINCT message_id FROM old_rows));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_bridge_messages_search_insert ON bridge_messages;
+CREATE TRIGGER trg_bridge_messages_search_insert
+    AFTER INSERT ON bridge_messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE bridge_messages_search_insert_trg();
+
+DROP TRIGGER IF EXISTS trg_bridge_messages_search_update ON bridge_messages;
+CREATE TRIGGER trg_bridge_messages_search_update
+    AFTER UPDATE OF subject, body, sender_name, email_from ON bridge_messages
+    FOR EACH ROW
+    WHEN (OLD.subject IS DISTINCT FROM NEW.subject
+          OR OLD.body IS DISTINCT FROM NEW.body
+          OR OLD.sender_name IS DISTINCT FROM NEW.sender_name
+          OR OLD.email_from IS DISTINCT FROM NEW.email_from)
+    EXECUTE PROCEDURE bridge_messages_search_update_trg();
+
+DROP TRIGGER IF EXISTS trg_bridge_attachments_search_insert ON bridge_attachments;
+CREATE TRIGGER trg_bridge_attachments_search_insert
+    AFTER INSERT ON bridge_attachments
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE bridge_attachments_search_insert_trg();
+
+DROP TRIGGER IF EXISTS trg_bridge_attachments_search_delete ON bridge_attachments;
+CREATE TRIGGER trg_bridge_attachments_search_delete
+    AFTER DELETE ON bridge_attachments
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE bridge_attachments_search_delete_trg();
+
+-- Начальное заполнение по уже накопленной переписке идёт не здесь, а пачками из приложения
+-- (bridge _backfill_search_documents): одним запросом на всю таблицу миграция держала бы
+-- блокировки на всё время пересчёта. next_id — наибольший id, ещё не попавший в поиск;
+-- сообщения новее него индексируют триггеры выше. 0 — заполнение закончено.
+CREATE TABLE IF NOT EXISTS bridge_search_backfill (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    next_id INTEGER NOT NULL
+);
+
+INSERT INTO bridge_search_backfill (id, next_id)
+SELECT 1, COALESCE(MAX(id), 0) FROM bridge_messages
+ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,4 @@
+-- Перенос переписки адресата в папку (move_message) ищет письма по адресу без учёта регистра:
+-- без этих индексов каждый перенос читал всю почту партнёра
+CREATE INDEX IF NOT EXISTS idx_bridge_messages_from_lower ON bridge_messages(partner_id, LOWER(email_from)) WHERE channel = 'email';
+CREATE INDEX IF NOT EXISTS idx_bridge_messages_to_lower ON bridge_messages(partner_id, LOWER(email_to)) WHERE channel = 'email';
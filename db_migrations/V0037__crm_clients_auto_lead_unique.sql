@@ -0,0 +1,18 @@
+-- Автосоздание лидов по письмам: один лид на адрес отправителя у партнёра. Синхронизация
+-- создаёт лиды пачкой через INSERT ... ON CONFLICT по этому индексу, поэтому параллельные
+-- проходы (несколько ящиков, фоновый таймер и ручная кнопка) больше не заводят дубликаты.
+-- Карточки, заведённые вручную, индекс не ограничивает.
+
+-- Уже накопленные дубли автолидов: самый ранний остаётся автолидом, остальные становятся
+-- обычными карточками (ничего не удаляется — к ним могут быть привязаны письма и сделки)
+UPDATE crm_clients c SET auto_created = FALSE
+FROM (
+    SELECT id, ROW_NUMBER() OVER (PARTITION BY partner_id, LOWER(email) ORDER BY id) AS rn
+    FROM crm_clients
+    WHERE auto_created AND email IS NOT NULL
+) d
+WHERE c.id = d.id AND d.rn > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_crm_clients_auto_lead_email
+    ON crm_clients(partner_id, LOWER(email))
+    WHERE auto_created;
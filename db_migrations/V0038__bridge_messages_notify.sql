@@ -0,0 +1,26 @@
+-- Долгий опрос уведомлений (resource=notifications&wait=N): запрос подписывается на канал
+-- bridge_messages_<partner_id> и просыпается, когда в переписку партнёра пришло новое
+-- входящее сообщение, вместо того чтобы опрашивать таблицу по таймеру.
+-- Один NOTIFY на партнёра за запрос вставки (письма синхронизации вставляются пачкой).
+CREATE OR REPLACE FUNCTION bridge_messages_notify_trg() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('bridge_messages_' || n.partner_id, n.last_id::TEXT)
+    FROM (
+        SELECT partner_id, MAX(id) AS last_id FROM new_rows
+        WHERE direction = 'in' AND NOT is_duplicate
+        GROUP BY partner_id
+    ) n;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_bridge_messages_notify ON bridge_messages;
+CREATE TRIGGER trg_bridge_messages_notify
+    AFTER INSERT ON bridge_messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE bridge_messages_notify_trg();
+
+-- Выборка писем без уведомления читает только их, а не всю входящую почту партнёра
+CREATE INDEX IF NOT EXISTS idx_bridge_messages_unnotified
+    ON bridge_messages(partner_id, created_at)
+    WHERE direction = 'in' AND notified = FALSE AND is_duplicate = FALSE;
@@ -0,0 +1,16 @@
+-- Кэш извлечённого текста загруженных в generate-kp файлов (ТЗ, тендерная документация, сканы).
+-- Ключ — sha256 содержимого, экстрактор и его версия: повторная загрузка того же файла
+-- (parse_files, запуск задачи КП, другая сессия) не разбирает PDF/DOCX заново и не платит
+-- за OCR. При изменении вывода экстрактора его версия в коде увеличивается — старые записи
+-- просто перестают совпадать. Хранится полный текст, без обрезки под лимит ответа.
+CREATE TABLE IF NOT EXISTS kp_extracted_texts (
+    sha256 CHAR(64) NOT NULL,
+    extractor VARCHAR(20) NOT NULL,
+    extractor_version INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    page_count INTEGER,
+    ocr_model VARCHAR(100),
+    size_bytes BIGINT NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (sha256, extractor, extractor_version)
+);
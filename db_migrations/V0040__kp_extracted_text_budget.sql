@@ -0,0 +1,5 @@
+-- Разбор PDF останавливается, набрав нужное вызывающему число символов (parse_files — 15000,
+-- generate_section — 3000), поэтому в кэше может лежать только начало текста. char_budget —
+-- бюджет, с которым извлекали запись (NULL — текст полный): запись подходит запросу с тем же
+-- или меньшим бюджетом, а более полный разбор её заменяет.
+ALTER TABLE kp_extracted_texts ADD COLUMN IF NOT EXISTS char_budget INTEGER;
@@ -0,0 +1,7 @@
+-- Строка очереди bridge_outbox живёт, пока живёт письмо: delete_message / delete_conversation
+-- удаляют только bridge_messages, и без каскада удаление любого исходящего письма (у каждого
+-- теперь есть строка в очереди) падало на внешнем ключе.
+ALTER TABLE bridge_outbox DROP CONSTRAINT IF EXISTS bridge_outbox_message_id_fkey;
+ALTER TABLE bridge_outbox
+    ADD CONSTRAINT bridge_outbox_message_id_fkey
+    FOREIGN KEY (message_id) REFERENCES bridge_messages(id) ON DELETE CASCADE;
@@ -0,0 +1,4 @@
+-- Опрос изменений переписки идёт по курсору (updated_at, id): строки одного массового UPDATE
+-- получают одинаковый updated_at, и без id страница с LIMIT теряла бы остаток такой группы
+CREATE INDEX IF NOT EXISTS idx_bridge_messages_client_updated_id ON bridge_messages(client_id, updated_at, id);
+DROP INDEX IF EXISTS idx_bridge_messages_client_updated;
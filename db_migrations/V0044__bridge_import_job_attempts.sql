@@ -0,0 +1,9 @@
+-- Сбой шага импорта (обрыв IMAP, таймаут) больше не переводит задание в error навсегда:
+-- оно остаётся running, attempts считает сбои подряд, error хранит последний из них.
+-- error_kind — род последней ошибки: 'transient' (сбой связи; задание в error после
+-- IMPORT_MAX_ATTEMPTS таких сбоев можно продолжить повторным запуском) или 'fatal' (ящик
+-- убран из настроек, папку пересоздали). У заданий, упавших до этой миграции, он NULL —
+-- их род неизвестен, такие задания не продолжаются, а запускаются заново.
+ALTER TABLE bridge_import_jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE bridge_import_jobs ADD COLUMN IF NOT EXISTS error_kind VARCHAR(20)
+    CHECK (error_kind IN ('transient', 'fatal'));
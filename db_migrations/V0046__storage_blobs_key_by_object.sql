@@ -0,0 +1,6 @@
+-- storage_blobs был уникален по одному sha256: тот же файл, загруженный другим модулем,
+-- получал чужую ссылку (документ депозитария — crew/avatars/<hash>.png). Теперь запись
+-- ищется по ключу объекта (префикс модуля / sha256 / расширение): повтор внутри модуля
+-- по-прежнему не загружается, а у каждого модуля и расширения свой объект.
+ALTER TABLE storage_blobs DROP CONSTRAINT IF EXISTS storage_blobs_pkey;
+ALTER TABLE storage_blobs ADD PRIMARY KEY (s3_key);
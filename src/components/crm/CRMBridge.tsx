@@ -39,6 +39,8 @@ const fmtTime = (d?: string) =>
 
 type ViewTab = 'chat' | 'inbox' | 'sent' | 'folders';
 
+const CONVERSATIONS_PAGE = 50; // диалогов на странице списка
+
 interface CRMBridgeProps {
   partnerId?: number;
   initialClientId?: number | null;
@@ -50,6 +52,12 @@ export const CRMBridge = ({ partnerId, initialClientId }: CRMBridgeProps = {}) =
   const [mailboxFilter, setMailboxFilter] = useState<string>('');
 
   const [conversations, setConversations] = useState<BridgeConversation[]>([]);
+  const [conversationsCursor, setConversationsCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
+  // сколько диалогов уже показано: фоновое обновление перечитывает их одним запросом
+  const conversationsShownRef = useRef(CONVERSATIONS_PAGE);
+  // диалог, открытый из карточки клиента, но не попавший на загруженные страницы
+  const [pinnedConversation, setPinnedConversation] = useState<BridgeConversation | null>(null);
   const [filterChannel, setFilterChannel] = useState<BridgeChannel | 'all'>('all');
   const [selectedClientId, setSelectedClientId] = useState<number | null>(initialClientId ?? null);
   const [messages, setMessages] = useState<BridgeMessage[]>([]);
@@ -101,8 +109,10 @@ export const CRMBridge = ({ partnerId, initialClientId }: CRMBridgeProps = {}) =
         filterChannel === 'all' ? undefined : filterChannel,
         mailboxFilter || undefined,
         partnerId,
+        { limit: conversationsShownRef.current },
       );
       setConversations(res.conversations);
+      setConversationsCursor(res.next_cursor ?? null);
     } catch (error) {
       console.error('Error loading conversations:', error);
     } finally {
@@ -110,6 +120,34 @@ export const CRMBridge = ({ partnerId, initialClientId }: CRMBridgeProps = {}) =
     }
   }, [filterChannel, mailboxFilter, partnerId]);
 
+  const loadMoreConversations = async () => {
+    if (!conversationsCursor) return;
+    setLoadingMore(true);
+    try {
+      const res = await bridgeApi.getConversations(
+        filterChannel === 'all' ? undefined : filterChannel,
+        mailboxFilter || undefined,
+        partnerId,
+        { limit: CONVERSATIONS_PAGE, before: conversationsCursor },
+      );
+      setConversations((prev) => {
+        const next = [...prev, ...res.conversations.filter((c) => !prev.some((p) => p.client_id === c.client_id))];
+        conversationsShownRef.current = Math.max(CONVERSATIONS_PAGE, next.length);
+        return next;
+      });
+      setConversationsCursor(res.next_cursor ?? null);
+    } catch (error) {
+      console.error('Error loading conversations:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  // при смене фильтра список снова начинается с первой страницы
+  useEffect(() => {
+    conversationsShownRef.current = CONVERSATIONS_PAGE;
+  }, [filterChannel, mailboxFilter, partnerId]);
+
   useEffect(() => {
     if (tab === 'chat') loadConversations();
   }, [tab, loadConversations]);
@@ -120,25 +158,38 @@ export const CRMBridge = ({ partnerId, initialClientId }: CRMBridgeProps = {}) =
     return () => clearInterval(interval);
   }, [tab, loadConversations]);
 
-  // Уведомления о новых письмах: показываем название папки, если письмо в неё отсортировано
+  // Уведомления о новых письмах: показываем название папки, если письмо в неё отсортировано.
+  // Долгий опрос: следующий запрос уходит сразу после ответа, сервер ждёт новое письмо сам.
+  // При ошибке или если сервер не ждал (long_poll: false — подключения к БД заняты,
+  // или ответил пустым списком без ожидания) — пауза, как у прежнего таймера
   useEffect(() => {
-    const check = async () => {
-      try {
-        const res = await bridgeApi.getNotifications(partnerId);
-        res.notifications.forEach((n) => {
-          const title = n.folder_name ? `Новое письмо · ${n.folder_name}` : 'Новое письмо';
-          toast(title, {
-            description: `${n.sender_name || n.email_from || 'Отправитель'} — ${n.subject || 'без темы'}`,
+    let stopped = false;
+    const controller = new AbortController();
+    const pause = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+    const listen = async () => {
+      while (!stopped) {
+        const startedAt = Date.now();
+        try {
+          const res = await bridgeApi.getNotifications(partnerId, 10, controller.signal);
+          res.notifications.forEach((n) => {
+            const title = n.folder_name ? `Новое письмо · ${n.folder_name}` : 'Новое письмо';
+            toast(title, {
+              description: `${n.sender_name || n.email_from || 'Отправитель'} — ${n.subject || 'без темы'}`,
+            });
           });
-        });
-        if (res.notifications.length) playSound();
-      } catch {
-        /* уведомления не критичны */
+          if (res.notifications.length) playSound();
+          if (res.long_poll === false || (!res.notifications.length && Date.now() - startedAt < 1_000)) await pause(20_000);
+        } catch {
+          /* уведомления не критичны */
+          if (!stopped) await pause(20_000);
+        }
       }
     };
-    check();
-    const interval = setInterval(check, 20_000);
-    return () => clearInterval(interval);
+    listen();
+    return () => {
+      stopped = true;
+      controller.abort();
+    };
   }, [partnerId, playSound]);
 
   const loadMessages = useCallback(async (clientId: number) => {
@@ -197,7 +248,16 @@ export const CRMBridge = ({ partnerId, initialClientId }: CRMBridgeProps = {}) =
     if (tab === 'sent') loadFlatList('out');
   }, [tab, loadFlatList]);
 
-  const selectedConversation = conversations.find((c) => c.client_id === selectedClientId) || null;
+  const listedConversation = conversations.find((c) => c.client_id === selectedClientId) || null;
+  const selectedConversation =
+    listedConversation || (pinnedConversation?.client_id === selectedClientId ? pinnedConversation : null);
+
+  useEffect(() => {
+    if (!selectedClientId || loading || listedConversation) return;
+    bridgeApi.getConversations(undefined, undefined, partnerId, { clientId: selectedClientId })
+      .then((res) => setPinnedConversation(res.conversations[0] ?? null))
+      .catch(() => {});
+  }, [selectedClientId, loading, listedConversation, partnerId]);
 
   const handleSync = async () => {
     setSyncing(true);
@@ -593,6 +653,15 @@ export const CRMBridge = ({ partnerId, initialClientId }: CRMBridgeProps = {}) =
                   </button>
                 ))
               )}
+              {!loading && conversationsCursor && (
+                <button
+                  onClick={loadMoreConversations}
+                  disabled={loadingMore}
+                  className="w-full p-3 text-xs text-[#66FCF1] hover:bg-[#45A29E]/5 disabled:opacity-50"
+                >
+                  {loadingMore ? 'Загрузка…' : 'Показать ещё'}
+                </button>
+              )}
             </div>
           </div>
 
@@ -693,6 +762,10 @@ export const CRMBridge = ({ partnerId, initialClientId }: CRMBridgeProps = {}) =
                               {m.folder_name}
                             </span>
                           )}
+                          {m.delivery_status === 'queued' && <span title="Письмо в очереди на отправку">· отправляется…</span>}
+                          {m.delivery_status === 'failed' && (
+                            <span className="text-red-400" title={m.delivery_error || undefined}>· не доставлено</span>
+                          )}
                           <span className="ml-auto">{fmtTime(m.created_at)}</span>
                         </div>
                         {m.subject && <div className="text-xs font-semibold mb-1 text-[#66FCF1]">{m.subject}</div>}
@@ -28,6 +28,7 @@ export interface BridgeMessage {
   telegram_username: string | null;
   is_read: boolean;
   created_at: string;
+  updated_at?: string;
   attachments: BridgeAttachment[];
   company_name?: string;
   contact_person?: string;
@@ -38,6 +39,20 @@ export interface BridgeMessage {
   email_in_reply_to?: string | null;
   email_cc?: string | null;
   email_to_all?: string | null;
+  // Исходящее письмо: queued — в очереди на отправку, sent — доставлено на SMTP, failed — не доставлено
+  delivery_status?: 'queued' | 'sent' | 'failed' | null;
+  delivery_error?: string | null;
+}
+
+export interface BridgeSearchResult
+  extends Pick<
+    BridgeMessage,
+    | 'id' | 'partner_id' | 'client_id' | 'channel' | 'direction' | 'sender_name' | 'subject'
+    | 'email_from' | 'email_to' | 'mailbox' | 'folder_id' | 'telegram_username' | 'is_read'
+    | 'created_at' | 'attachments' | 'company_name' | 'contact_person' | 'folder_name' | 'folder_color'
+  > {
+  rank: number;
+  snippet: string;
 }
 
 export interface BridgeFolder {
@@ -95,6 +110,26 @@ export interface BridgeConversation {
   last_message_created_at: string;
 }
 
+export interface BridgeImportJob {
+  id: number;
+  partner_id: number;
+  mailbox: string;
+  folder: 'INBOX' | 'SENT';
+  real_folder: string | null;
+  date_from: string;
+  date_to: string;
+  cursor_pos: number;
+  total: number;
+  imported: number;
+  status: 'running' | 'done' | 'error';
+  // при status == 'running' — последний сбой шага, который будет повторён (attempts — сбоев подряд)
+  error: string | null;
+  error_kind: 'transient' | 'fatal' | null;
+  attempts: number;
+  created_at: string;
+  updated_at: string;
+}
+
 export interface BridgeAttachmentInput {
   name: string;
   mime: string;
@@ -139,14 +174,41 @@ async function call(url: string, options: RequestInit = {}): Promise<any> {
 export const bridgeApi = {
   getPartnerId,
 
-  getConversations: (channel?: BridgeChannel, mailbox?: string, partnerId?: number): Promise<{ conversations: BridgeConversation[] }> => {
+  // Без page возвращается весь список диалогов; с page.limit — страница и next_cursor,
+  // который передаётся как page.before для загрузки следующей страницы; page.clientId —
+  // только диалог одного клиента.
+  getConversations: (
+    channel?: BridgeChannel,
+    mailbox?: string,
+    partnerId?: number,
+    page?: { limit?: number; before?: string | null; clientId?: number },
+  ): Promise<{ conversations: BridgeConversation[]; next_cursor?: string | null }> => {
     const pid = partnerId ?? getPartnerId();
-    const q = (channel ? `&channel=${channel}` : '') + (mailbox ? `&mailbox=${encodeURIComponent(mailbox)}` : '');
+    const q =
+      (channel ? `&channel=${channel}` : '') +
+      (mailbox ? `&mailbox=${encodeURIComponent(mailbox)}` : '') +
+      (page?.limit ? `&limit=${page.limit}` : '') +
+      (page?.before ? `&before=${encodeURIComponent(page.before)}` : '') +
+      (page?.clientId ? `&client_id=${page.clientId}` : '');
     return call(`${BRIDGE_URL}?resource=conversations&partner_id=${pid}${q}`);
   },
 
-  getMessages: (client_id: number, channel?: BridgeChannel): Promise<{ messages: BridgeMessage[] }> => {
-    const q = channel ? `&channel=${channel}` : '';
+  // Без page — вся история. page.limit + page.before листают назад (next_cursor),
+  // page.after — сообщения новее курсора, page.updated_since — только новые и изменённые
+  // с прошлого опроса (в ответе updated_until — курсор для следующего запроса; пока has_more,
+  // запрашивать сразу). Курсор захватывает последнюю минуту с запасом: уже полученные
+  // сообщения приходят повторно и заменяют прежние по id.
+  getMessages: (
+    client_id: number,
+    channel?: BridgeChannel,
+    page?: { limit?: number; before?: string | null; after?: string | null; updated_since?: string | null },
+  ): Promise<{ messages: BridgeMessage[]; next_cursor?: string | null; has_more?: boolean; updated_until?: string }> => {
+    const q =
+      (channel ? `&channel=${channel}` : '') +
+      (page?.limit ? `&limit=${page.limit}` : '') +
+      (page?.before ? `&before=${encodeURIComponent(page.before)}` : '') +
+      (page?.after ? `&after=${encodeURIComponent(page.after)}` : '') +
+      (page?.updated_since ? `&updated_since=${encodeURIComponent(page.updated_since)}` : '');
     return call(`${BRIDGE_URL}?resource=messages&client_id=${client_id}${q}`);
   },
 
@@ -159,6 +221,23 @@ export const bridgeApi = {
     return call(`${BRIDGE_URL}?resource=email_list&partner_id=${pid}&direction=${direction}${q}`);
   },
 
+  // Полнотекстовый поиск по переписке; snippet — HTML с совпадениями в <mark>, остальной текст экранирован.
+  // indexing: true — старая переписка ещё индексируется, результаты могут быть неполными
+  search: (
+    q: string,
+    filters?: { mailbox?: string; folderId?: number | 'none' | null; channel?: BridgeChannel; limit?: number; offset?: number },
+    partnerId?: number,
+  ): Promise<{ messages: BridgeSearchResult[]; has_more: boolean; next_offset: number | null; indexing?: boolean }> => {
+    const pid = partnerId ?? getPartnerId();
+    const f =
+      (filters?.mailbox ? `&mailbox=${encodeURIComponent(filters.mailbox)}` : '') +
+      (filters?.folderId ? `&folder_id=${filters.folderId}` : '') +
+      (filters?.channel ? `&channel=${filters.channel}` : '') +
+      (filters?.limit ? `&limit=${filters.limit}` : '') +
+      (filters?.offset ? `&offset=${filters.offset}` : '');
+    return call(`${BRIDGE_URL}?resource=search&partner_id=${pid}&q=${encodeURIComponent(q)}${f}`);
+  },
+
   getMailboxes: (): Promise<{ mailboxes: { address: string }[] }> => {
     return call(`${BRIDGE_URL}?resource=mailboxes`);
   },
@@ -180,9 +259,40 @@ export const bridgeApi = {
     partnerId?: number,
   ): Promise<{ success: boolean; message: BridgeMessage; client_id: number | null }> => {
     const pid = partnerId ?? getPartnerId();
+    // Первая попытка доставки идёт в этом же запросе (итог — в message.delivery_status);
+    // письмо, отложенное на повтор, отправит фоновый drainOutbox
     return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'send_email', partner_id: pid, ...payload }) });
   },
 
+  // Рассылка одного письма нескольким клиентам CRM (не больше 100 за запрос): каждому ставится
+  // в очередь отдельное письмо и отправляется в этом же запросе; sent — ушло, undelivered —
+  // отклонено окончательно, pending — осталось в очереди на повтор (drainOutbox).
+  // Клиенты без email возвращаются в failed.
+  sendBulkEmail: (
+    payload: {
+      client_ids: number[];
+      subject?: string;
+      body: string;
+      mailbox?: string;
+      attachments?: BridgeAttachmentInput[];
+      depo_files?: BridgeDepoFileInput[];
+      signature_id?: number | null;
+    },
+    partnerId?: number,
+  ): Promise<{
+    success: boolean; queued: number; message_ids: number[]; failed: { client_id: number; error: string }[];
+    sent: number; undelivered: number; pending: number;
+  }> => {
+    const pid = partnerId ?? getPartnerId();
+    return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'send_bulk_email', partner_id: pid, ...payload }) });
+  },
+
+  // Повторная отправка писем, отложенных после временной ошибки SMTP (вызывается фоновым таймером CRM)
+  drainOutbox: (partnerId?: number): Promise<{ success: boolean; sent: number; failed: number; retried: number }> => {
+    const pid = partnerId ?? getPartnerId();
+    return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'drain_outbox', partner_id: pid }) });
+  },
+
   getFolders: (partnerId?: number): Promise<{ folders: BridgeFolder[] }> => {
     const pid = partnerId ?? getPartnerId();
     return call(`${BRIDGE_URL}?resource=folders&partner_id=${pid}`);
@@ -198,6 +308,22 @@ export const bridgeApi = {
     return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'move_message', partner_id: pid, ...payload }) });
   },
 
+  // Правило автосортировки: точный адрес, домен (@firma.ru) или шаблон со звёздочкой (*@*.gov.ru)
+  saveFolderRule: (payload: { folder_id: number; pattern: string; apply?: boolean }, partnerId?: number): Promise<{ moved: number }> => {
+    const pid = partnerId ?? getPartnerId();
+    return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'save_folder_rule', partner_id: pid, ...payload }) });
+  },
+
+  deleteFolderRule: (pattern: string, partnerId?: number) => {
+    const pid = partnerId ?? getPartnerId();
+    return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'delete_folder_rule', partner_id: pid, pattern }) });
+  },
+
+  applyFolderRules: (folderId?: number, partnerId?: number): Promise<{ moved: number }> => {
+    const pid = partnerId ?? getPartnerId();
+    return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'apply_folder_rules', partner_id: pid, folder_id: folderId }) });
+  },
+
   getSignatures: (partnerId?: number): Promise<{ signatures: BridgeSignature[] }> => {
     const pid = partnerId ?? getPartnerId();
     return call(`${BRIDGE_URL}?resource=signatures&partner_id=${pid}`);
@@ -219,9 +345,12 @@ export const bridgeApi = {
     return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'upload_attachment', ...payload }) });
   },
 
-  getNotifications: (partnerId?: number): Promise<{ notifications: BridgeNotification[] }> => {
+  // wait — долгий опрос: сервер держит запрос до wait секунд и отвечает, как только придёт новое сообщение
+  // wait — долгий опрос (сервер ждёт не дольше 10 с); long_poll: false — сервер не ждал,
+  // потому что подключения к БД заняты, и следующий запрос стоит отложить
+  getNotifications: (partnerId?: number, wait?: number, signal?: AbortSignal): Promise<{ notifications: BridgeNotification[]; long_poll?: boolean }> => {
     const pid = partnerId ?? getPartnerId();
-    return call(`${BRIDGE_URL}?resource=notifications&partner_id=${pid}`);
+    return call(`${BRIDGE_URL}?resource=notifications&partner_id=${pid}${wait ? `&wait=${wait}` : ''}`, { signal });
   },
 
   sendTelegram: (payload: { client_id: number; body: string }, partnerId?: number) => {
@@ -247,11 +376,21 @@ export const bridgeApi = {
     return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'mark_read', client_id }) });
   },
 
-  importRange: (payload: { mailbox: string; date_from: string; date_to: string }) => {
+  // Импорт исторической почты идёт серверным заданием: первый вызов создаёт задание,
+  // следующие передают job_id и продолжают с сохранённого курсора, пока has_more == true.
+  // offset/next_offset в ответе — позиция задания до и после шага (как в прежнем API).
+  importRange: (
+    payload: { mailbox?: string; date_from?: string; date_to?: string; folder?: 'INBOX' | 'SENT'; job_id?: number },
+  ): Promise<{ success: boolean; job_id: number; job: BridgeImportJob; imported: number; total: number; offset: number; next_offset: number; has_more: boolean; linked?: number; error?: string; retry_error?: string }> => {
     const pid = getPartnerId();
     return call(BRIDGE_URL, { method: 'POST', body: JSON.stringify({ resource: 'import_range', partner_id: pid, ...payload }) });
   },
 
+  getImportJob: (jobId: number, partnerId?: number): Promise<{ job: BridgeImportJob }> => {
+    const pid = partnerId ?? getPartnerId();
+    return call(`${BRIDGE_URL}?resource=import_job&partner_id=${pid}&job_id=${jobId}`);
+  },
+
   getFolderMessages: (folderId: number, partnerId?: number): Promise<{ messages: BridgeMessage[] }> => {
     const pid = partnerId ?? getPartnerId();
     return call(`${BRIDGE_URL}?resource=folder_messages&partner_id=${pid}&folder_id=${folderId}`);
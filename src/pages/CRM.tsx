@@ -119,6 +119,8 @@ const CRM = () => {
       } catch {
         // тихо — почта могла быть временно недоступна, попробуем на следующем цикле
       }
+      // письма, отложенные после временной ошибки SMTP, повторяются отдельным запросом
+      bridgeApi.drainOutbox().catch(() => undefined);
     };
 
     const interval = setInterval(syncMail, 60_000);